@@ -0,0 +1,129 @@
+'''
+Semantic cache of generated answers for converse.py.
+
+Every question in converse.py runs a search plus a full LLM generation in the
+retrieval_augmented_generation processor, which takes seconds. When traffic
+repeats (FAQ-style questions, reworded), most of those generations produce an
+answer the bot has already given. SemanticAnswerCache embeds each question
+with the dense model and compares it with the questions it has already
+answered. When the closest one is at least threshold (cosine similarity), it
+returns that question's answer without calling the LLM.
+
+The cache is local to the process: a few thousand entries of one embedding
+each take a few MB, and scoring them is a single matrix-vector product.
+Entries expire ttl_seconds after they were stored, and once the cache holds
+max_size entries, the least recently used entry is evicted.
+
+The cache key is the question alone. A follow-up that depends on the
+conversation ("what about the sequel?") can match an earlier, unrelated
+follow-up, so keep the threshold high.
+'''
+
+
+from collections import OrderedDict
+import logging
+import model_utils
+import numpy as np
+from opensearchpy import OpenSearch
+from query_token_cache import normalize_text
+import threading
+import time
+
+
+DEFAULT_THRESHOLD = 0.92
+DEFAULT_TTL_SECONDS = 3600
+DEFAULT_MAX_SIZE = 1000
+
+
+class SemanticAnswerCache:
+  '''
+  Caches answers by question embedding.
+
+  Args:
+      os_client (OpenSearch): Client for the _predict calls
+      model_id (str): The deployed dense embedding model
+      threshold (float): Minimum cosine similarity for a hit
+      ttl_seconds (float): Seconds an answer stays valid
+      max_size (int): Answers to keep
+  '''
+  def __init__(self, os_client: OpenSearch, model_id,
+               threshold=DEFAULT_THRESHOLD, ttl_seconds=DEFAULT_TTL_SECONDS,
+               max_size=DEFAULT_MAX_SIZE, clock=time.monotonic):
+    self.os_client = os_client
+    self.model_id = model_id
+    self.threshold = threshold
+    self.ttl_seconds = ttl_seconds
+    self.max_size = max_size
+    self.clock = clock
+    self.hits = 0
+    self.misses = 0
+    # normalized question -> (unit embedding, answer, stored at)
+    self._entries = OrderedDict()
+    # The last question embedded, so that put() after a miss in get() doesn't
+    # call the model again.
+    self._last = (None, None)
+    # converse.py's batch mode shares one cache across conversations
+    self._lock = threading.RLock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def _embedding(self, key):
+    # Called outside the lock: it's a _predict round trip. Another thread can
+    # replace _last meanwhile, which only costs a second model call.
+    last_key, last_vector = self._last
+    if last_key == key:
+      return last_vector
+    vector = np.asarray(model_utils.create_embedding(self.os_client, self.model_id,
+                                                     key), dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    vector = vector / norm if norm else vector
+    self._last = (key, vector)
+    return vector
+
+  def _expire(self):
+    cutoff = self.clock() - self.ttl_seconds
+    for key in [key for key, (_, _, stored) in self._entries.items()
+                if stored < cutoff]:
+      del self._entries[key]
+
+  def get(self, question):
+    '''Returns (answer, similarity, cached question) for the most similar
+    cached question at or above the threshold, or None.'''
+    key = normalize_text(question)
+    with self._lock:
+      self._expire()
+      if key in self._entries:
+        # Identical question, no need to embed it
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key][1], 1.0, key
+      if not self._entries:
+        self.misses += 1
+        return None
+      keys = list(self._entries)
+      matrix = np.stack([self._entries[cached][0] for cached in keys])
+    # Embed without the lock, so conversations don't wait on each other's
+    # model calls
+    similarities = matrix @ self._embedding(key)
+    best = int(np.argmax(similarities))
+    with self._lock:
+      # Another conversation may have evicted the entry meanwhile
+      if similarities[best] < self.threshold or keys[best] not in self._entries:
+        self.misses += 1
+        return None
+      self._entries.move_to_end(keys[best])
+      self.hits += 1
+      return self._entries[keys[best]][1], float(similarities[best]), keys[best]
+
+  def put(self, question, answer):
+    '''Stores the answer for question, evicting the least recently used
+    answers beyond max_size.'''
+    key = normalize_text(question)
+    vector = self._embedding(key)
+    with self._lock:
+      self._entries[key] = (vector, answer, self.clock())
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_size:
+        evicted, _ = self._entries.popitem(last=False)
+        logging.debug(f"Evicted cached answer for '{evicted}'")
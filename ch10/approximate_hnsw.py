@@ -26,14 +26,15 @@ Configuration:
 """
 import argparse
 from auto_incrementing_counter import AutoIncrementingCounter
+import batch_search
 from copy import deepcopy
-import jsonpath_ng.ext
 import index_utils
 import logging
 import model_utils
 import movie_source
 from os_client_factory import OSClientFactory
 import opensearchpy.helpers
+from query_templates import QueryTemplate, Slot
 
 
 # NOTE: Much of the code is duplicated across the various examples. Better
@@ -100,13 +101,20 @@ ingest_pipeline_definition = {
 }
 
 
-simple_ann_query={
+# The approximate kNN query, compiled once into a builder (see
+# query_templates.py). Set the filters slot to a query clause for efficient
+# filtering.
+simple_ann_query = QueryTemplate({
   "query": {
     "knn": {
       EMBEDDING_FIELD_NAME: {
-        "vector": [],
-        "k": 10
-}}}}
+        "vector": Slot('vector'),
+        "k": Slot('k', default=10),
+        "filter": Slot('filters', optional=True)
+}}}})
+# With --search-template, the script stores simple_ann_query in the cluster
+# under this id, and sends only the parameters with each query.
+SEARCH_TEMPLATE_ID = 'approximate_hnsw_knn'
 
 
 # Definition for the hybrid search pipeline. It specifies the normalization and
@@ -114,9 +122,11 @@ simple_ann_query={
 #
 # Experiment with the ratio of lexical and vector by adjusting the weights. The
 # weights' order matches the hybrid query's clauses. The first is the match
-# query, the second is the neural query
+# query, the second is the neural query. Bump the version when you change the
+# definition, so that the script replaces the stored pipeline.
 HYBRID_PIPELINE_NAME = 'hybrid_pipeline'
 hybrid_pipeline_definition = {
+  "version": 1,
   "phase_results_processors": [
     {
       "normalization-processor": {
@@ -132,28 +142,32 @@ hybrid_pipeline_definition = {
 ]}}}}]}
 
 
-# A hybrid query 
-hybrid_query={
+# A hybrid query. The query_text slot fills both the lexical and the neural
+# clause.
+hybrid_query = QueryTemplate({
   "query": {
     "hybrid": {
       "queries": [
         {
-          "match": { "title": { "query": "" }}
+          "match": { "title": { "query": Slot('query_text') }}
         },
         {
           "neural": {
             EMBEDDING_FIELD_NAME: {
-              "query_text": "",
-              "k": 10,
-              "model_id": ""
-}}}]}}}
+              "query_text": Slot('query_text'),
+              "k": Slot('k', default=10),
+              "model_id": Slot('model_id')
+}}}]}}})
         
 
 # Main function. Finds or loads the embedding model, creates the index (unless
 # --skip-indexing is a command-line paramater), creates an embedding for the
 # query "Sci-fi about the force and jedis" and then runs the exact query and
 # prints the search response.
-def main(skip_indexing=False, hybrid=False, user_query=None):
+def main(skip_indexing=False, hybrid=False, user_query=None,
+         search_template=False,
+         queries_file=None, batch_size=batch_search.MSEARCH_BATCH_SIZE,
+         output_path='-', retain=index_utils.RETAINED_VERSIONS):
   # See os_client_factory.py for details on the set up for the opensearch-py
   # client.
   os_client = OSClientFactory().client()
@@ -178,11 +192,11 @@ def main(skip_indexing=False, hybrid=False, user_query=None):
     pipeline_definition['processors'][0]['text_embedding']['model_id'] = model_id
     os_client.ingest.put_pipeline(id=PIPELINE_NAME, body=pipeline_definition)
 
-    # Create an index with the pipeline
-    logging.info(f"Creating index {INDEX_NAME}")
-    index_utils.delete_then_create_index(
+    # Create a new version of the index, with the pipeline, next to the live one
+    logging.info(f"Creating a new version of index {INDEX_NAME}")
+    version_name = index_utils.create_next_version(
       os_client=os_client,
-      index_name=INDEX_NAME,
+      alias_name=INDEX_NAME,
       ingest_pipeline_name=PIPELINE_NAME,
       additional_fields=FAISS_HNSW_FIELD
     )
@@ -190,40 +204,55 @@ def main(skip_indexing=False, hybrid=False, user_query=None):
     # Read and add documents to the index with the opensearch-py bulk helper.
     logging.info(f"Indexing documents")
     counter = AutoIncrementingCounter()
-    for bulk in movie_source.bulks(BULK_SIZE, INDEX_NAME):
+    for bulk in movie_source.bulks(BULK_SIZE, version_name):
       logging.info(f"Indexing bulk {str(counter)} / {TOTAL_NUMBER_OF_BULKS}")
       opensearchpy.helpers.bulk(os_client, bulk, timeout=600, max_retries=10)
+
+    # Point the INDEX_NAME alias, which all queries use, at the new version,
+    # and delete old versions (see index_utils.py)
+    index_utils.publish_version(os_client, INDEX_NAME, version_name, retain)
   else:
     logging.info(f"Skipping indexing")
 
+  # With --queries-file, run every query in the file as batched _msearch
+  # requests and write the results as NDJSON, instead of the single query. Batch mode
+  # runs the kNN query, --hybrid applies to single queries only.
+  if queries_file:
+    batch_search.run_queries_file(
+      os_client=os_client, index_name=INDEX_NAME,
+      template=simple_ann_query,
+      queries_file=queries_file, output_path=output_path, model_id=model_id,
+      batch_size=batch_size)
+    return
+
   # Run the query. If it's a hybrid query, set up the search pipeline first. The
   # hybrid query is a combined lexical and vector query. The vector query is a
   # neural query, which automatically encodes the query text as a vector
   logging.info(f"Running query")
   if hybrid:
-    # Create a search pipeline for the two-phase, neural processor
-    os_client.transport.perform_request(
-      'PUT', f'/_search/pipeline/{HYBRID_PIPELINE_NAME}',
-      body=hybrid_pipeline_definition)
-    # Replace placeholders with values
-    query = deepcopy(hybrid_query)
-    query['query']['hybrid']['queries'][0]['match']['title']['query'] = \
-      user_query if user_query else "Sci-fi about the force and jedis"
-    query['query']['hybrid']['queries'][1]['neural'][EMBEDDING_FIELD_NAME]['model_id'] = \
-      model_id
-    query['query']['hybrid']['queries'][1]['neural'][EMBEDDING_FIELD_NAME]['query_text'] = \
-      user_query if user_query else "Sci-fi about the force and jedis"
+    # Create the search pipeline for the two-phase, neural processor, unless
+    # the cluster already has this version of it
+    index_utils.ensure_search_pipeline(os_client, HYBRID_PIPELINE_NAME,
+                                       hybrid_pipeline_definition)
+    # Fill in the template's slots
+    query = hybrid_query.build(
+      query_text=user_query if user_query else "Sci-fi about the force and jedis",
+      model_id=model_id)
     # Run the query. This uses the search_pipeline parameter to engage the
     # pipeline
     response = os_client.search(index=INDEX_NAME, body=query,
                                 search_pipeline=HYBRID_PIPELINE_NAME)
   else:
-    query = deepcopy(simple_ann_query)
     query_embedding = model_utils.create_embedding(os_client, model_id, user_query)
-
-    expr = jsonpath_ng.ext.parser.parse(f'query.knn.{EMBEDDING_FIELD_NAME}.vector')
-    query = expr.update(query, query_embedding)
-    response = os_client.search(index=INDEX_NAME, body=query)
+    if search_template:
+      simple_ann_query.register(os_client, SEARCH_TEMPLATE_ID)
+      response = os_client.search_template(
+        index=INDEX_NAME,
+        body=simple_ann_query.search_template_body(SEARCH_TEMPLATE_ID,
+                                                   vector=query_embedding))
+    else:
+      query = simple_ann_query.build(vector=query_embedding)
+      response = os_client.search(index=INDEX_NAME, body=query)
 
   # Print the search response.
   logging.info(f"Query response")
@@ -248,9 +277,29 @@ if __name__ == "__main__":
   )
   parser.add_argument("--skip-indexing", default=False, action="store_true")
   parser.add_argument("--hybrid", default=False, action="store_true")
+  parser.add_argument("--search-template", default=False, action="store_true",
+                      help="Register the kNN query as a stored search template "
+                      "and query through it")
   parser.add_argument("--query", default="Sci-fi about the force and jedis",
                       action="store")
+  parser.add_argument("--queries-file", default=None, action="store",
+                      help="Run every query in this file (one per line) with "
+                      "_msearch, instead of --query")
+  parser.add_argument("--batch-size", default=batch_search.MSEARCH_BATCH_SIZE,
+                      type=int, action="store",
+                      help="Queries per _msearch request for --queries-file")
+  parser.add_argument("--output", default="-", action="store",
+                      help="NDJSON results file for --queries-file, - for stdout")
+  parser.add_argument("--retain", default=index_utils.RETAINED_VERSIONS,
+                      type=int, action="store",
+                      help="Index versions to keep after the alias swap, "
+                      "including the live one")
   args = parser.parse_args()
   main(skip_indexing=args.skip_indexing,
        hybrid=args.hybrid,
-       user_query=args.query)
+       user_query=args.query,
+       search_template=args.search_template,
+       queries_file=args.queries_file,
+       batch_size=args.batch_size,
+       output_path=args.output,
+       retain=args.retain)
@@ -13,8 +13,8 @@ Command-line Arguments:
 """
 import argparse
 from auto_incrementing_counter import AutoIncrementingCounter
+import batch_search
 from copy import deepcopy
-import jsonpath_ng.ext
 import index_utils
 import ivf_pq_training
 import logging
@@ -22,6 +22,7 @@ import model_utils
 import movie_source
 from os_client_factory import OSClientFactory
 import opensearchpy.helpers
+from query_templates import QueryTemplate, Slot
 
 
 # NOTE: Much of the code is duplicated across the various examples. Better
@@ -80,16 +81,22 @@ ingest_pipeline_definition = {
 }
 
 
-simple_ann_query={
+# The approximate kNN query, compiled once into a builder (see
+# query_templates.py). Set the filters slot to a query clause for efficient
+# filtering.
+simple_ann_query = QueryTemplate({
   "query": {
     "knn": {
       EMBEDDING_FIELD_NAME: {
-        "vector": [],
-        "k": 10
-}}}}
+        "vector": Slot('vector'),
+        "k": Slot('k', default=10),
+        "filter": Slot('filters', optional=True)
+}}}})
 
 
-def main(skip_indexing=False, user_query=None):
+def main(skip_indexing=False, user_query=None,
+         queries_file=None, batch_size=batch_search.MSEARCH_BATCH_SIZE,
+         output_path='-', retain=index_utils.RETAINED_VERSIONS):
   # See os_client_factory.py for details on the set up for the opensearch-py
   # client.
   os_client = OSClientFactory().client()
@@ -109,12 +116,17 @@ def main(skip_indexing=False, user_query=None):
   # read the movies data (movie_source.py) and send it to the index.
   if not skip_indexing:
 
-    # Create an IVF model
+    # Train a model for the new version. Each version has its own model,
+    # <model>_v<N> for <index>_v<N>, so the live version keeps serving on its
+    # model while this one trains (see index_utils.version_model_name).
+    version_name = index_utils.next_version_name(os_client, INDEX_NAME)
     training_model = ivf_pq_training.train(
       os_client=os_client,
       embedding_model_id=model_id,
       model_dimensions=model_utils.DENSE_MODELS_HF[MODEL_SHORT_NAME]['dimensions'],
-      skip_if_exists=False
+      skip_if_exists=False,
+      model_name=index_utils.version_model_name(
+        ivf_pq_training.TRAINING_MODEL_NAME, version_name)
     )
 
     # Create an ingest pipeline
@@ -122,13 +134,13 @@ def main(skip_indexing=False, user_query=None):
     pipeline_definition['processors'][0]['text_embedding']['model_id'] = model_id
     os_client.ingest.put_pipeline(id=PIPELINE_NAME, body=pipeline_definition)
 
-    # Create an index with the pipeline
-    logging.info(f"Creating index {INDEX_NAME}")
+    # Create a new version of the index, with the pipeline, next to the live one
+    logging.info(f"Creating a new version of index {INDEX_NAME}")
     faiss_ivf_field = deepcopy(FAISS_IVF_FIELD)
     faiss_ivf_field['embedding']['model_id'] = training_model
-    index_utils.delete_then_create_index(
+    version_name = index_utils.create_next_version(
       os_client=os_client,
-      index_name=INDEX_NAME,
+      alias_name=INDEX_NAME,
       ingest_pipeline_name=PIPELINE_NAME,
       additional_fields=faiss_ivf_field
     )
@@ -136,20 +148,36 @@ def main(skip_indexing=False, user_query=None):
     # Read and add documents to the index with the opensearch-py bulk helper.
     logging.info(f"Indexing documents")
     counter = AutoIncrementingCounter()
-    for bulk in movie_source.bulks(BULK_SIZE, INDEX_NAME):
+    for bulk in movie_source.bulks(BULK_SIZE, version_name):
       logging.info(f"Indexing bulk {str(counter)} / {TOTAL_NUMBER_OF_BULKS}")
       opensearchpy.helpers.bulk(os_client, bulk, timeout=600, max_retries=10)
+
+    # Point the INDEX_NAME alias, which all queries use, at the new version,
+    # and delete old versions (see index_utils.py)
+    index_utils.publish_version(os_client, INDEX_NAME, version_name, retain)
+
+    # Delete the models of the versions publish_version deleted. The retained
+    # versions keep theirs.
+    index_utils.delete_retired_models(os_client, INDEX_NAME,
+                                      ivf_pq_training.TRAINING_MODEL_NAME)
   else:
     logging.info(f"Skipping indexing")
 
+  # With --queries-file, run every query in the file as batched _msearch
+  # requests and write the results as NDJSON, instead of the single query.
+  if queries_file:
+    batch_search.run_queries_file(
+      os_client=os_client, index_name=INDEX_NAME,
+      template=simple_ann_query,
+      queries_file=queries_file, output_path=output_path, model_id=model_id,
+      batch_size=batch_size)
+    return
+
   # Run a query. Calls the LLM to generate a vector embedding for the question
   # (see model_utils.py) and then adds that embedding to the OpenSearch query.
   logging.info(f"Running query")
-  query = deepcopy(simple_ann_query)
   query_embedding = model_utils.create_embedding(os_client, model_id, user_query)
-
-  expr = jsonpath_ng.ext.parser.parse(f'query.knn.{EMBEDDING_FIELD_NAME}.vector')
-  query = expr.update(query, query_embedding)
+  query = simple_ann_query.build(vector=query_embedding)
   response = os_client.search(index=INDEX_NAME, body=query)
 
   # Print the search response. The response contains the top 4 hits (the query
@@ -178,6 +206,22 @@ if __name__ == "__main__":
   parser.add_argument("--skip-indexing", default=False, action="store_true")
   parser.add_argument("--query", default="Sci-fi about the force and jedis",
                       action="store")
+  parser.add_argument("--queries-file", default=None, action="store",
+                      help="Run every query in this file (one per line) with "
+                      "_msearch, instead of --query")
+  parser.add_argument("--batch-size", default=batch_search.MSEARCH_BATCH_SIZE,
+                      type=int, action="store",
+                      help="Queries per _msearch request for --queries-file")
+  parser.add_argument("--output", default="-", action="store",
+                      help="NDJSON results file for --queries-file, - for stdout")
+  parser.add_argument("--retain", default=index_utils.RETAINED_VERSIONS,
+                      type=int, action="store",
+                      help="Index versions to keep after the alias swap, "
+                      "including the live one")
   args = parser.parse_args()
   main(skip_indexing=args.skip_indexing,
-       user_query=args.query)
+       user_query=args.query,
+       queries_file=args.queries_file,
+       batch_size=args.batch_size,
+       output_path=args.output,
+       retain=args.retain)
@@ -0,0 +1,162 @@
+'''
+Batch query mode for the ch10 search scripts.
+
+The example scripts run a single --query. With --queries-file, they instead
+read many queries, embed them with batched _predict calls, and send them to
+OpenSearch as _msearch requests of --batch-size queries each. Results go out as
+NDJSON, one line per query, with the server-side took for that query.
+
+The queries file has one query per line. A line is either plain query text, or
+a JSON object with a "query" field and an optional "id" field:
+
+    Sci-fi about the force and jedis
+    {"id": "q2", "query": "A heist that goes wrong"}
+
+Each output line looks like:
+
+    {"id": "q2", "query": "A heist that goes wrong", "took": 12,
+     "hits": [{"_id": "...", "_score": 0.87, "title": "..."}, ...]}
+
+Failed queries get an "error" field instead of "hits".
+
+Functions:
+    read_queries(queries_file): Reads the queries file
+    msearch(os_client, index_name, bodies, batch_size): Yields one response
+        per query body, sending batch_size bodies per _msearch call
+    run_queries_file(...): Embeds, queries and writes the results
+'''
+
+
+import json
+import logging
+import model_utils
+from opensearchpy import OpenSearch
+import sys
+import time
+
+
+# Queries per _msearch request. Larger batches amortize the request overhead,
+# but the whole batch waits for its slowest query.
+MSEARCH_BATCH_SIZE = 50
+# Texts per _predict request when embedding the queries.
+EMBEDDING_BATCH_SIZE = 32
+
+
+def read_queries(queries_file):
+  '''Reads a queries file, returning a list of {"id": ..., "query": ...}
+  dicts. Queries without an id are numbered by line.'''
+  queries = []
+  with open(queries_file, 'r') as f:
+    for line_number, line in enumerate(f, start=1):
+      line = line.strip()
+      if not line:
+        continue
+      if line.startswith('{'):
+        data = json.loads(line)
+        queries.append({"id": str(data.get('id', line_number)),
+                        "query": data['query']})
+      else:
+        queries.append({"id": str(line_number), "query": line})
+  return queries
+
+
+def msearch(os_client: OpenSearch, index_name, bodies, batch_size=MSEARCH_BATCH_SIZE):
+  '''Sends the query bodies as _msearch requests of batch_size queries each.
+  Yields the per-query responses in order.'''
+  for start in range(0, len(bodies), batch_size):
+    request = []
+    for body in bodies[start:start + batch_size]:
+      request.append({"index": index_name})
+      request.append(body)
+    response = os_client.msearch(body=request)
+    for item in response['responses']:
+      yield item
+
+
+# Converts one _msearch response item to an output record.
+def _result_record(query, response):
+  record = {"id": query['id'], "query": query['query']}
+  if 'error' in response:
+    record['error'] = response['error']
+    return record
+  record['took'] = response['took']
+  record['hits'] = [{"_id": hit['_id'],
+                     "_score": hit['_score'],
+                     "title": hit.get('_source', {}).get('title')}
+                    for hit in response['hits']['hits']]
+  return record
+
+
+def run_queries_file(os_client: OpenSearch, index_name, template, queries_file,
+                     output_path='-', model_id=None,
+                     batch_size=MSEARCH_BATCH_SIZE, token_cache=None,
+                     **slot_values):
+  '''
+  Runs every query in queries_file against index_name and writes NDJSON.
+
+  Args:
+      os_client (OpenSearch): OpenSearch client
+      index_name (str): Index (or alias) to query
+      template (QueryTemplate): Query template. If it has a vector slot, the
+          queries are embedded with model_id. If it has a query_text slot, it
+          gets the query text, and a model_id slot gets model_id.
+      queries_file (str): Path to the queries file
+      output_path (str): Where to write the NDJSON results, '-' for stdout
+      model_id (str): Model for embedding the queries, or for the template's
+          model_id slot
+      batch_size (int): Queries per _msearch request
+      token_cache (QueryTokenCache): Fills a query_tokens slot with each
+          query's sparse tokens, see query_token_cache.py
+      slot_values: Values for the template's other slots, e.g. model_id for
+          a neural_sparse query
+
+  Returns:
+      int: The number of queries that failed
+  '''
+  queries = read_queries(queries_file)
+  texts = [query['query'] for query in queries]
+  logging.info(f"Read {len(queries)} queries from {queries_file}")
+
+  vectors = None
+  if 'vector' in template.slots:
+    start = time.perf_counter()
+    vectors = model_utils.create_embeddings(os_client, model_id, texts,
+                                            batch_size=EMBEDDING_BATCH_SIZE)
+    logging.info(f"Embedded {len(texts)} queries in "
+                 f"{time.perf_counter() - start:.2f}s")
+
+  tokens = None
+  if 'query_tokens' in template.slots:
+    tokens = token_cache.get_many(texts)
+
+  bodies = []
+  for i, text in enumerate(texts):
+    values = dict(slot_values)
+    if vectors is not None:
+      values['vector'] = vectors[i]
+    if tokens is not None:
+      values['query_tokens'] = tokens[i]
+    if 'query_text' in template.slots:
+      values['query_text'] = text
+    if 'model_id' in template.slots:
+      values.setdefault('model_id', model_id)
+    bodies.append(template.build(**values))
+
+  errors = 0
+  start = time.perf_counter()
+  output = sys.stdout if output_path == '-' else open(output_path, 'w')
+  try:
+    for query, response in zip(queries,
+                               msearch(os_client, index_name, bodies, batch_size)):
+      record = _result_record(query, response)
+      if 'error' in record:
+        errors += 1
+      output.write(json.dumps(record) + '\n')
+  finally:
+    if output is not sys.stdout:
+      output.close()
+  elapsed = time.perf_counter() - start
+  logging.info(f"Ran {len(queries)} queries in {elapsed:.2f}s "
+               f"({len(queries) / elapsed if elapsed else 0:.1f} queries/s), "
+               f"{errors} errors")
+  return errors
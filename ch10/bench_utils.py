@@ -0,0 +1,190 @@
+'''
+Shared helpers for the ch10 benchmark tools.
+
+The benchmark scripts (load_generator.py and friends) replay query sets against
+the indices that the example scripts build. This module holds the pieces they
+share: the list of benchmark targets, turning query texts into query bodies
+for a target, latency percentiles, and text/JSON report output.
+
+Constants:
+    BENCH_TARGETS: Short name to index name, query type and space type for
+        each index the example scripts build
+    KNN_QUERY: Approximate kNN query template with the query-time knobs
+
+Functions:
+    query_bodies(os_client, target, texts): Query bodies for a target
+    timed_searches(os_client, index_name, bodies): Sequential searches with
+        client latency
+    pareto_frontier(rows, minimize, maximize): Non-dominated rows
+    percentile(sorted_values, pct): Interpolated percentile
+    latency_summary(values): Count, mean, max and p50/p90/p99/p99.9
+    format_table(rows, columns): Fixed-width text table
+    write_json(path, data): Writes a report as JSON
+'''
+
+
+import exact
+import json
+import logging
+import math
+import model_utils
+from opensearchpy import OpenSearch
+from query_templates import QueryTemplate, Slot
+import sparse
+import time
+
+
+# The indices built by the example scripts. If you change INDEX_NAME in one of
+# the scripts, change it here as well (and in cleanup.py). The IVF scripts
+# can't be imported directly because of their circular import with the
+# training modules, so the names are repeated here rather than imported.
+#
+# query_type is one of
+#   script - exact kNN with a knn_score script (exact.py)
+#   knn - approximate kNN query
+#   neural_sparse - sparse query, OpenSearch encodes the query text
+BENCH_TARGETS = {
+  "exact": {"index": exact.INDEX_NAME, "query_type": "script",
+            "space_type": "cosinesimil"},
+  "hnsw": {"index": 'approximate_movies_hnsw', "query_type": "knn",
+           "space_type": "l2"},
+  "ivf": {"index": 'approximate_movies_ivf', "query_type": "knn",
+          "space_type": "l2"},
+  "ivf_pq": {"index": 'approximate_movies_ivf_pq', "query_type": "knn",
+             "space_type": "l2"},
+  "sq": {"index": 'approximate_movies_sq', "query_type": "knn",
+         "space_type": "l2"},
+  "on_disk": {"index": 'approximate_on_disk', "query_type": "knn",
+              "space_type": "l2"},
+  "sparse": {"index": sparse.INDEX_NAME, "query_type": "neural_sparse",
+             "space_type": None},
+  "sparse_seismic": {"index": sparse.SEISMIC_INDEX_NAME,
+                     "query_type": "neural_sparse", "space_type": None},
+}
+
+
+# The approximate kNN query used by the benchmarks. It's the examples'
+# simple_ann_query with optional slots for the query-time knobs the sweeps
+# turn: method_parameters (ef_search, nprobes) and rescore (on-disk
+# oversampling).
+KNN_QUERY = QueryTemplate({
+  "query": {
+    "knn": {
+      exact.EMBEDDING_FIELD_NAME: {
+        "vector": Slot('vector'),
+        "k": Slot('k', default=10),
+        "filter": Slot('filters', optional=True),
+        "method_parameters": Slot('method_parameters', optional=True),
+        "rescore": Slot('rescore', optional=True)
+}}}})
+
+
+# All of the dense examples use the same embedding model.
+DENSE_MODEL_NAME = model_utils.DENSE_MODELS_HF[exact.MODEL_SHORT_NAME]['name']
+SPARSE_MODEL_NAME = model_utils.SPARSE_MODELS_HF[sparse.MODEL_SHORT_NAME]['name']
+
+
+def query_bodies(os_client: OpenSearch, target, texts, k=10, vectors=None,
+                 **slot_values):
+  '''Builds one query body per text for the target (a BENCH_TARGETS value).
+  Dense targets embed the texts with batched _predict calls, unless you pass
+  the vectors. Embedding happens here, up front, so that benchmarks measure
+  only the search. slot_values go to KNN_QUERY's optional slots.'''
+  if target['query_type'] == 'neural_sparse':
+    model_id = model_utils.model_id_for(os_client, SPARSE_MODEL_NAME)
+    return [sparse.sparse_query.build(query_text=text, model_id=model_id)
+            for text in texts]
+
+  if vectors is None:
+    model_id = model_utils.model_id_for(os_client, DENSE_MODEL_NAME)
+    if model_id is None:
+      raise ValueError(f'Model {DENSE_MODEL_NAME} is not deployed. Run one of '
+                       'the example scripts first.')
+    logging.info(f"Embedding {len(texts)} queries")
+    vectors = model_utils.create_embeddings(os_client, model_id, texts)
+  if target['query_type'] == 'script':
+    return [exact.script_query.build(vector=vector) for vector in vectors]
+  return [KNN_QUERY.build(vector=vector, k=k, **slot_values) for vector in vectors]
+
+
+def timed_searches(os_client: OpenSearch, index_name, bodies, **search_args):
+  '''Runs the query bodies one at a time, so they don't compete with each
+  other, and returns (responses, client latencies in ms). search_args go to
+  the search call, e.g. search_pipeline.'''
+  responses = []
+  latencies = []
+  for body in bodies:
+    start = time.perf_counter()
+    responses.append(os_client.search(index=index_name, body=body, **search_args))
+    latencies.append((time.perf_counter() - start) * 1000)
+  return responses, latencies
+
+
+def pareto_frontier(rows, minimize=(), maximize=()):
+  '''Returns the rows that no other row dominates. A row dominates another
+  when it is at least as good on every metric and better on at least one.'''
+  def at_least_as_good(a, b):
+    return (all(a[m] <= b[m] for m in minimize) and
+            all(a[m] >= b[m] for m in maximize))
+
+  def dominates(a, b):
+    return at_least_as_good(a, b) and not at_least_as_good(b, a)
+
+  return [row for row in rows
+          if not any(dominates(other, row) for other in rows if other is not row)]
+
+
+def percentile(sorted_values, pct):
+  '''Returns the pct percentile (0-100) of an already sorted list, linearly
+  interpolating between the closest ranks. Returns None for an empty list.'''
+  if not sorted_values:
+    return None
+  rank = (len(sorted_values) - 1) * pct / 100.0
+  low = math.floor(rank)
+  high = math.ceil(rank)
+  if low == high:
+    return sorted_values[int(rank)]
+  return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+
+def latency_summary(values):
+  '''Summarizes a list of latencies with count, mean, max, and the p50, p90,
+  p99 and p99.9 percentiles.'''
+  ordered = sorted(values)
+  return {
+    "count": len(ordered),
+    "mean": sum(ordered) / len(ordered) if ordered else None,
+    "p50": percentile(ordered, 50),
+    "p90": percentile(ordered, 90),
+    "p99": percentile(ordered, 99),
+    "p99.9": percentile(ordered, 99.9),
+    "max": ordered[-1] if ordered else None,
+  }
+
+
+def _format_cell(value):
+  if value is None:
+    return '-'
+  if isinstance(value, float):
+    return f'{value:.3f}' if abs(value) < 1000 else f'{value:.0f}'
+  return str(value)
+
+
+def format_table(rows, columns):
+  '''Formats a list of dicts as a fixed-width text table, with one column per
+  key in columns.'''
+  cells = [[_format_cell(row.get(column)) for column in columns] for row in rows]
+  widths = [max([len(column)] + [len(row[i]) for row in cells])
+            for i, column in enumerate(columns)]
+  lines = ['  '.join(column.rjust(width) for column, width in zip(columns, widths)),
+           '  '.join('-' * width for width in widths)]
+  for row in cells:
+    lines.append('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
+  return '\n'.join(lines)
+
+
+def write_json(path, data):
+  '''Writes a benchmark report as indented JSON.'''
+  with open(path, 'w') as f:
+    json.dump(data, f, indent=2)
+  logging.info(f"Wrote {path}")
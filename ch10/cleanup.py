@@ -22,6 +22,7 @@ Notes:
 """
 import argparse
 import connector_utils
+import index_utils
 from copy import deepcopy
 import opensearchpy
 from os_client_factory import OSClientFactory
@@ -53,6 +54,8 @@ APPROXIMATE_IVF_PQ = 'approximate_movies_ivf_pq'
 APPROXIMATE_ON_DISK = 'approximate_on_disk'
 CONVERSATIONAL_MOVIES = 'conversational_movies'
 EXACT = 'exact_movies'
+SPARSE = 'sparse_movies'
+SPARSE_SEISMIC = 'sparse_movies_seismic'
 IVF_TRAINING = 'ivf_training'
 IVF_PQ_TRAINING = 'ivf_pq_training'
 # Training models 
@@ -71,45 +74,45 @@ def delete_indices(os_client: opensearchpy.OpenSearch):
                      APPROXIMATE_ON_DISK,
                      CONVERSATIONAL_MOVIES,
                      EXACT,
+                     SPARSE,
+                     SPARSE_SEISMIC,
                      # Important to delete these after their target indices!
                      IVF_TRAINING,
                      IVF_PQ_TRAINING,
                      ]:
     if os_client.indices.exists(index=index_name):
-      logging.info(f'Deleting index {index_name}')
-      os_client.indices.delete(index=index_name)
+      # The example scripts build versions behind an alias (see
+      # index_utils.py), and an alias can't be deleted as an index
+      index_utils.delete_versions(os_client, index_name)
       time.sleep(1)
-  try:
-    os_client.transport.perform_request(
-    'DELETE', f'/_plugins/_knn/models/{IVF_TRAINING_MODEL_NAME}')
-  except opensearchpy.exceptions.NotFoundError:
-    logging.info(f'Model {IVF_TRAINING_MODEL_NAME} not found, skipping')
-
-  try:
-    os_client.transport.perform_request(
-    'DELETE', f'/_plugins/_knn/models/{IVF_PQ_TRAINING_MODEL_NAME}')
-  except opensearchpy.exceptions.NotFoundError:
-    logging.info(f'Model {IVF_PQ_TRAINING_MODEL_NAME} not found, skipping')
+  # The IVF scripts train a model per index version, <model>_v<N>. With the
+  # versions gone, none of the models is in use.
+  index_utils.delete_retired_models(os_client, APPROXIMATE_IVF,
+                                    IVF_TRAINING_MODEL_NAME)
+  index_utils.delete_retired_models(os_client, APPROXIMATE_IVF_PQ,
+                                    IVF_PQ_TRAINING_MODEL_NAME)
 
 
 def delete_connectors(os_client: opensearchpy.OpenSearch):
-  connector_id = connector_utils.connector_id_for(os_client=os_client,
-                                                  connector_name='Amazon Bedrock')
-  while connector_id:
-    logging.info(f'Deleting model for connector {connector_id}')
-    model_id = connector_utils.connector_model_id_for_connector(os_client=os_client,
-                                                  connector_id=connector_id)
-    logging.info(f'Model id "{model_id}"')
-    os_client.transport.perform_request('POST', f'/_plugins/_ml/models/{model_id}/_undeploy')
-    # This sleep prevents overwhelming the cluster with too many tasks and
-    # responding with HTTP status 429
-    time.sleep(1)
-    os_client.transport.perform_request('DELETE', f'/_plugins/_ml/models/{model_id}')
-
-    logging.info(f'Deleting connector {connector_id}')
-    os_client.transport.perform_request('DELETE', f'/_plugins/_ml/connectors/{connector_id}')
+  for connector_name in [connector_utils.CONNECTOR_NAME,
+                         connector_utils.STUB_CONNECTOR_NAME]:
     connector_id = connector_utils.connector_id_for(os_client=os_client,
-                                                    connector_name='Amazon Bedrock')
+                                                    connector_name=connector_name)
+    while connector_id:
+      logging.info(f'Deleting model for connector {connector_id}')
+      model_id = connector_utils.connector_model_id_for_connector(os_client=os_client,
+                                                    connector_id=connector_id)
+      logging.info(f'Model id "{model_id}"')
+      os_client.transport.perform_request('POST', f'/_plugins/_ml/models/{model_id}/_undeploy')
+      # This sleep prevents overwhelming the cluster with too many tasks and
+      # responding with HTTP status 429
+      time.sleep(1)
+      os_client.transport.perform_request('DELETE', f'/_plugins/_ml/models/{model_id}')
+
+      logging.info(f'Deleting connector {connector_id}')
+      os_client.transport.perform_request('DELETE', f'/_plugins/_ml/connectors/{connector_id}')
+      connector_id = connector_utils.connector_id_for(os_client=os_client,
+                                                      connector_name=connector_name)
 
 
 def main(clean_models=False, clean_indices=False, clean_connectors=False):
@@ -18,6 +18,7 @@ connectors and models before creating new ones.
 
 Constants:
     CONNECTOR_NAME: Default name for the Bedrock connector
+    STUB_CONNECTOR_NAME: Name for the connector to stub_llm_server.py
     CONNECTOR_REGISTER_BODY: Template for connector registration
 """
 
@@ -29,6 +30,7 @@ import time
 
 
 CONNECTOR_NAME = 'Amazon Bedrock'
+STUB_CONNECTOR_NAME = 'Stub LLM'
 CONNECTOR_REGISTER_BODY = {
     "name": '',
     "function_name": 'remote',
@@ -1,13 +1,26 @@
+import answer_cache
+from answer_cache import SemanticAnswerCache
 import argparse
 from auto_incrementing_counter import AutoIncrementingCounter
+import batch_search
+import bench_utils
 import boto3
 import copy
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import connector_utils
+import exact
 import index_utils
+import json
 import logging
+import model_utils
 import movie_source
-from os_client_factory import OSClientFactory, AWS_REGION
+import rag_context
+from os_client_factory import (OSClientFactory, AWS_REGION,
+                               TRUSTED_ENDPOINTS_SETTING, trusted_endpoints)
 import opensearchpy.helpers
+import re
+import time
 import uuid
 
 
@@ -57,6 +70,29 @@ CONNECTOR_BODY = {
 }
 
 
+# The connector for stub_llm_server.py, a stand-in for Bedrock for offline load
+# tests. It sends the same request body over plain HTTP, and the stub answers
+# in Bedrock Claude's format. The url is filled in from --stub-llm-url.
+STUB_CONNECTOR_BODY = {
+  "name": connector_utils.STUB_CONNECTOR_NAME,
+  "description": "Connector for the local stub LLM",
+  "version": 1,
+  "protocol": "http",
+  "parameters": {},
+  "actions": [
+      {
+        "action_type": "predict",
+        "method": "POST",
+        "headers": {
+            "content-type": "application/json"
+        },
+        "url": '',
+        "request_body": CONNECTOR_BODY['actions'][0]['request_body']
+      }
+  ]
+}
+
+
 # The search pipeline calls out to a text generation model to create a response
 # based on the search results for the query. 
 SEARCH_PIPELINE_BODY={
@@ -109,6 +145,91 @@ def create_search_pipeline(os_client, pipeline_name, pipeline_body):
     body=pipeline_body)
 
 
+@contextmanager
+def trusted_stub_endpoint(os_client, url):
+  '''While the with block runs, adds url to the trusted connector endpoints
+  and lets connectors reach private addresses, where the stub usually runs.
+  Afterwards, removes url and restores
+  plugins.ml_commons.connector.private_ip_enabled. Does nothing without url.
+
+  Both are cluster-wide settings: during the run, any connector on the
+  cluster may call private addresses. If the process is killed before it
+  restores them, reset private_ip_enabled to null and remove the stub from
+  the trusted endpoints with the cluster settings API.'''
+  if not url:
+    yield
+    return
+  private_ip_setting = 'plugins.ml_commons.connector.private_ip_enabled'
+  previous = os_client.cluster.get_settings(flat_settings=True)['persistent'].get(
+    private_ip_setting)
+  endpoint = f"^{re.escape(url.rstrip('/'))}/.*$"
+  trusted = trusted_endpoints(os_client)
+  os_client.cluster.put_settings(body={"persistent": {
+    TRUSTED_ENDPOINTS_SETTING: [regex for regex in trusted if regex != endpoint] + [endpoint],
+    private_ip_setting: True
+  }})
+  try:
+    yield
+  finally:
+    logging.info(f"Restoring the connector endpoint settings")
+    # Re-read the list, in case another script added to it during the run
+    os_client.cluster.put_settings(body={"persistent": {
+      TRUSTED_ENDPOINTS_SETTING: [regex for regex in trusted_endpoints(os_client)
+                                  if regex != endpoint],
+      private_ip_setting: previous
+    }})
+
+
+def setup_connector(os_client, stub_llm_url=None):
+  '''Creates the LLM connector, for Amazon Bedrock or for the stub LLM at
+  stub_llm_url, and the RAG search pipeline that calls it'''
+  if stub_llm_url:
+    # main() trusts the endpoint for the run (see trusted_stub_endpoint)
+    logging.info(f"Creating connector for the stub LLM at {stub_llm_url}")
+    connector_name = connector_utils.STUB_CONNECTOR_NAME
+    connector_body = copy.deepcopy(STUB_CONNECTOR_BODY)
+    connector_body['actions'][0]['url'] = f"{stub_llm_url.rstrip('/')}/invoke"
+  else:
+    # Set up the connector for Amazon Bedrock. This uses the default profile
+    # for the AWS CLI. If you want to use a different profile, you can
+    # specify it in the AWS_DEFAULT_PROFILE environment variable.
+    #
+    # IMPORTANT! You must have Bedrock model access configured to give you
+    # access to Anthropic Claude in the AWS_REGION specified in
+    # os_client_factory.py
+    logging.info(f"Creating connector")
+    # Secure token service (sts) provides temporary credentials based on the
+    # account specified by aws configure, See the boto docs for details and
+    # alternative ways to specify credentials.
+    session = boto3.client('sts', AWS_REGION).get_session_token()
+    connector_name = connector_utils.CONNECTOR_NAME
+    connector_body = copy.deepcopy(CONNECTOR_BODY)
+    connector_body['credential'] = {
+      "access_key": session['Credentials']['AccessKeyId'],
+      "secret_key": session['Credentials']['SecretAccessKey'],
+      "session_token": session['Credentials']['SessionToken']
+    }
+  # This locates the connector by searching the connectors API for the
+  # connector name, deletes any connectors and their associated model, then
+  # creates a new connector with the body above
+  #
+  # The session token is embedded in the connector and expires after an hour.
+  # By deleting any existing model, the code ensures that the session
+  # credentials are active.
+  deployed_connector = connector_utils.delete_then_create_connector(
+    os_client=os_client,
+    connector_name=connector_name,
+    connector_body=connector_body
+  )
+
+  # The retrieval_augmented_generation processor accesses the connector
+  # through its associated model id. 
+  model_id = deployed_connector['model_id']
+  search_pipeline_body = copy.deepcopy(SEARCH_PIPELINE_BODY)
+  search_pipeline_body['response_processors'][0]['retrieval_augmented_generation']['model_id'] = model_id
+  create_search_pipeline(os_client, SEARCH_PIPELINE_NAME, search_pipeline_body)
+
+
 def create_conversation_memory(os_client):
   '''Creates a memory for the conversation'''
   conversation_name = f'conversation-{str(uuid.uuid1())[:8]}'
@@ -119,7 +240,203 @@ def create_conversation_memory(os_client):
   return response['memory_id']
 
 
-def main(skip_indexing=False):
+def add_interaction(os_client, memory_id, question, answer):
+  '''Records an answer that didn't come from the processor (cached, or
+  generated from a trimmed prompt) in the conversation memory, as the
+  processor would have, so later questions still see it in their history'''
+  os_client.transport.perform_request(
+    'POST', f'/_plugins/_ml/memory/{memory_id}/messages',
+    body={"input": question, "response": answer}
+  )
+
+
+def rag_model_id(os_client):
+  '''The connector model id, from the RAG search pipeline'''
+  pipeline = os_client.transport.perform_request(
+    'GET', f'/_search/pipeline/{SEARCH_PIPELINE_NAME}')
+  return (pipeline[SEARCH_PIPELINE_NAME]['response_processors'][0]
+          ['retrieval_augmented_generation']['model_id'])
+
+
+def conversation_history(os_client, memory_id, message_size):
+  '''The last message_size (question, answer) pairs in the memory, oldest
+  first'''
+  response = os_client.transport.perform_request(
+    'GET', f'/_plugins/_ml/memory/{memory_id}/messages',
+    params={"max_results": message_size})
+  messages = sorted(response.get('messages', []),
+                    key=lambda message: message.get('create_time', ''))
+  return [(message.get('input'), message.get('response'))
+          for message in messages[-message_size:]]
+
+
+def escape_parameter(text):
+  '''Escapes text for a connector parameter. ml-commons substitutes
+  ${parameters.inputs} into the request_body template as is, so quotes,
+  backslashes and newlines in the prompt would break the JSON it sends. The
+  RAG processor escapes its own prompt.'''
+  return json.dumps(text)[1:-1]
+
+
+def client_answer(os_client, question, memory_id, model_id, trim=None,
+                  token_budget=rag_context.DEFAULT_TOKEN_BUDGET,
+                  sentences_per_hit=rag_context.DEFAULT_SENTENCES_PER_HIT):
+  '''Answers the question without the RAG processor. Runs the retrieval
+  query without the search pipeline, builds the prompt from the hits and
+  calls the LLM through the connector model directly. With trim (highlight or
+  sentences), the prompt holds only snippets of the plots, up to
+  token_budget tokens (see rag_context.py), otherwise the full plots, like
+  the processor. Returns a dict with the answer and hits, the estimated prompt
+  tokens with full plots and as sent, and the retrieval and generation times
+  in ms.'''
+  generative_parameters = CONVERSATION_SEARCH_QUERY['ext']['generative_qa_parameters']
+  search_query = copy.deepcopy(CONVERSATION_SEARCH_QUERY)
+  del search_query['ext']
+  search_query['query']['simple_query_string']['query'] = question
+  search_query['size'] = generative_parameters['context_size']
+  if trim == 'highlight':
+    search_query['highlight'] = rag_context.HIGHLIGHT
+  start = time.perf_counter()
+  response = os_client.search(index=INDEX_NAME, body=search_query,
+                              search_pipeline='_none', timeout=60)
+  retrieval_ms = (time.perf_counter() - start) * 1000
+  hits = response['hits']['hits']
+
+  processor = SEARCH_PIPELINE_BODY['response_processors'][0]['retrieval_augmented_generation']
+  history = conversation_history(os_client, memory_id,
+                                 generative_parameters['message_size'])
+  full_prompt = rag_context.build_prompt(
+    rag_context.full_context(hits), question, processor['system_prompt'],
+    processor['user_instructions'], history)
+  prompt = full_prompt
+  if trim:
+    prompt = rag_context.build_prompt(
+      rag_context.build_context(hits, question, trim, token_budget,
+                                sentences_per_hit),
+      question, processor['system_prompt'], processor['user_instructions'],
+      history)
+
+  start = time.perf_counter()
+  prediction = os_client.transport.perform_request(
+    'POST', f'/_plugins/_ml/models/{model_id}/_predict',
+    body={"parameters": {"inputs": escape_parameter(prompt)}})
+  generation_ms = (time.perf_counter() - start) * 1000
+  # The Bedrock Claude connector (and stub_llm_server.py) respond with
+  # {"completion": ...}
+  output = prediction['inference_results'][0]['output'][0]['dataAsMap']
+  answer = output.get('completion', output.get('response', '')).strip()
+  add_interaction(os_client, memory_id, question, answer)
+  return {"answer": answer, "hits": hits,
+          "full_tokens": rag_context.estimate_tokens(full_prompt),
+          "prompt_tokens": rag_context.estimate_tokens(prompt),
+          "retrieval_ms": retrieval_ms, "generation_ms": generation_ms}
+
+
+def pipeline_answer(os_client, question, memory_id):
+  '''Answers the question through the RAG search pipeline, in one request.
+  Returns the answer and hits.'''
+  search_query = copy.deepcopy(CONVERSATION_SEARCH_QUERY)
+  search_query['query']['simple_query_string']['query'] = question
+  search_query['ext']['generative_qa_parameters']['llm_question'] = question
+  search_query['ext']['generative_qa_parameters']['memory_id'] = memory_id
+  response = os_client.search(index=INDEX_NAME, body=search_query, timeout=60)
+  return {"answer": response['ext']['retrieval_augmented_generation']['answer'],
+          "hits": response['hits']['hits']}
+
+
+def _ask(os_client, question, memory_id, executor, llm_model_id, cache, trim,
+         token_budget, sentences_per_hit):
+  '''Answers one batch question and returns its timings'''
+  start = time.perf_counter()
+  cached = cache.get(question) if cache else None
+  if cached:
+    add_interaction(os_client, memory_id, question, cached[0])
+    result = {"answer": cached[0], "cached": True}
+  elif executor == 'client':
+    result = client_answer(os_client, question, memory_id, llm_model_id, trim,
+                           token_budget, sentences_per_hit)
+  else:
+    result = pipeline_answer(os_client, question, memory_id)
+  total_ms = (time.perf_counter() - start) * 1000
+  if cache and not cached:
+    cache.put(question, result['answer'])
+  return {"cached": result.get('cached', False),
+          "retrieval_ms": result.get('retrieval_ms'),
+          "generation_ms": result.get('generation_ms'),
+          "total_ms": total_ms,
+          "prompt_tokens": result.get('prompt_tokens'),
+          "answer": result['answer']}
+
+
+def run_batch(os_client, questions, concurrency=4, executor='client',
+              cache=None, trim=None, token_budget=rag_context.DEFAULT_TOKEN_BUDGET,
+              sentences_per_hit=rag_context.DEFAULT_SENTENCES_PER_HIT):
+  '''Answers the questions in concurrency conversations at once. Questions
+  are dealt to the conversations round robin, each conversation has its own
+  memory and asks its questions in order. With the client executor (see
+  client_answer), each row has the retrieval, generation and total time of a
+  question. The pipeline executor sends each question through the RAG
+  pipeline in one request, so it has only the total. Returns the rows, in
+  question order, and the wall clock seconds.'''
+  llm_model_id = rag_model_id(os_client) if executor == 'client' else None
+  conversations = [questions[i::concurrency] for i in range(concurrency)]
+
+  def converse(position):
+    memory_id = create_conversation_memory(os_client)
+    rows = []
+    for question in conversations[position]:
+      row = _ask(os_client, question['query'], memory_id, executor, llm_model_id,
+                 cache, trim, token_budget, sentences_per_hit)
+      rows.append(dict(row, conversation=position, id=question['id'],
+                       question=question['query']))
+      logging.info(f"Conversation {position}, question {question['id']}: "
+                   f"{row['total_ms']:.0f}ms")
+    return rows
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as pool:
+    results = list(pool.map(converse, range(len(conversations))))
+  seconds = time.perf_counter() - start
+  order = {question['id']: position for position, question in enumerate(questions)}
+  rows = sorted((row for rows in results for row in rows),
+                key=lambda row: order[row['id']])
+  return rows, seconds
+
+
+def batch_summary(rows, seconds):
+  '''One latency summary row per stage, with the throughput'''
+  summary = []
+  for stage in ['retrieval_ms', 'generation_ms', 'total_ms']:
+    values = [row[stage] for row in rows if row[stage] is not None]
+    if values:
+      summary.append(dict(bench_utils.latency_summary(values), stage=stage))
+  for row in summary:
+    row['questions_per_second'] = len(rows) / seconds if seconds else None
+  return summary
+
+
+def create_answer_cache(os_client, threshold, ttl_seconds, max_size):
+  '''Finds or deploys the dense model and returns a semantic answer cache
+  that embeds questions with it'''
+  logging.info(f"Finding or deploying model {exact.MODEL_SHORT_NAME}")
+  model_id = model_utils.find_or_deploy_model(
+    os_client=os_client,
+    model_name=model_utils.DENSE_MODELS_HF[exact.MODEL_SHORT_NAME]['name'],
+    body=exact.MODEL_REGISTER_BODY
+  )
+  return SemanticAnswerCache(os_client, model_id, threshold=threshold,
+                             ttl_seconds=ttl_seconds, max_size=max_size)
+
+
+def main(skip_indexing=False, semantic_cache=False,
+         cache_threshold=answer_cache.DEFAULT_THRESHOLD,
+         cache_ttl=answer_cache.DEFAULT_TTL_SECONDS,
+         cache_size=answer_cache.DEFAULT_MAX_SIZE, trim=None,
+         token_budget=rag_context.DEFAULT_TOKEN_BUDGET,
+         sentences_per_hit=rag_context.DEFAULT_SENTENCES_PER_HIT,
+         stub_llm_url=None, questions_file=None, concurrency=4,
+         executor='client', output_path=None,
+         retain=index_utils.RETAINED_VERSIONS):
   '''Sets up and runs a conversational chat bot using OpenSearch and Amazon Bedrock.
 
     This function performs the following operations:
@@ -134,98 +451,134 @@ def main(skip_indexing=False):
     Args:
         skip_indexing (bool, optional): If True, skips the index creation and 
             data loading steps. Defaults to False.
+        semantic_cache (bool, optional): If True, answers questions similar
+            to one already answered from a local cache (see answer_cache.py),
+            without calling the LLM. Defaults to False.
+        trim (str, optional): highlight or sentences to send the LLM only
+            snippets of the retrieved plots, up to token_budget tokens (see
+            rag_context.py), instead of the full plots. Defaults to None.
+        stub_llm_url (str, optional): Base URL of stub_llm_server.py, to use
+            instead of Bedrock. The cluster trusts it, and lets connectors
+            reach private addresses, only until main() returns (see
+            trusted_stub_endpoint). Defaults to None.
+        questions_file (str, optional): Instead of the interactive loop,
+            answers the questions in this file (see batch_search.py) in
+            concurrency concurrent conversations, and reports their
+            latencies (see run_batch). Defaults to None.
 
     Note:
         Requires valid AWS credentials with Bedrock access configured for 
         Anthropic Claude in the specified AWS region.'''
   # See os_client_factory.py for details on the set up for the opensearch-py
   # client. 
-  os_client = OSClientFactory().client()
+  os_client = OSClientFactory(pool_maxsize=max(10, concurrency)).client()
 
-  # The conversation memory is automatically maintained by the search
-  # processor. The id is injected into the query processor before the query is
-  # executed
-  conversation_memory_id = create_conversation_memory(os_client)
+  # The stub LLM's endpoint is trusted only while main() runs (see
+  # trusted_stub_endpoint)
+  with trusted_stub_endpoint(os_client, stub_llm_url):
+    # The conversation memory is automatically maintained by the search
+    # processor. The id is injected into the query processor before the query is
+    # executed
+    conversation_memory_id = create_conversation_memory(os_client)
 
-  if not skip_indexing:
-    # Set up the connector for Amazon Bedrock. This uses the default profile
-    # for the AWS CLI. If you want to use a different profile, you can
-    # specify it in the AWS_DEFAULT_PROFILE environment variable.
-    #
-    # IMPORTANT! You must have Bedrock model access configured to give you
-    # access to Anthropic Claude in the AWS_REGION specified in
-    # os_client_factory.py
-    logging.info(f"Creating connector")
-    # Secure token service (sts) provides temporary credentials based on the
-    # account specified by aws configure, See the boto docs for details and
-    # alternative ways to specify credentials.
-    session = boto3.client('sts', AWS_REGION).get_session_token()
-    connector_body = copy.deepcopy(CONNECTOR_BODY)
-    connector_body['credential'] = {
-      "access_key": session['Credentials']['AccessKeyId'],
-      "secret_key": session['Credentials']['SecretAccessKey'],
-      "session_token": session['Credentials']['SessionToken']
-    }
-    # This locates the connector by searching the connectors API for the
-    # CONNECTOR_NAME, deletes any connectors and their associated model, then
-    # creates a new connector with the body above
-    #
-    # The session token is embedded in the connector and expires after an hour.
-    # By deleting any existing model, the code ensures that the session
-    # credentials are active.
-    deployed_connector = connector_utils.delete_then_create_connector(
-      os_client=os_client,
-      connector_name=connector_utils.CONNECTOR_NAME,
-      connector_body=connector_body
-    )
-
-    # The retrieval_augmented_generation processor accesses the connector
-    # through its associated model id. 
-    model_id = deployed_connector['model_id']
-    search_pipeline_body = copy.deepcopy(SEARCH_PIPELINE_BODY)
-    search_pipeline_body['response_processors'][0]['retrieval_augmented_generation']['model_id'] = model_id
-    create_search_pipeline(os_client, SEARCH_PIPELINE_NAME, search_pipeline_body)
-
-    # Create the index. The search pipeline defined above is the default
-    # pipeline for this index. All queries that go to the index will run this
-    # pipeline. 
-    logging.info(f"Creating index {INDEX_NAME}")
-    index_utils.delete_then_create_index(
-      os_client=os_client,
-      index_name=INDEX_NAME,
-      search_pipeline_name=SEARCH_PIPELINE_NAME
-    )
+    # The stub connector is quick to set up and doesn't expire, so it's set up
+    # even with --skip-indexing.
+    if not skip_indexing or stub_llm_url:
+      setup_connector(os_client, stub_llm_url)
+
+    if not skip_indexing:
+      # Create a new version of the index. The search pipeline created by
+      # setup_connector is the default pipeline for this index. All queries that
+      # go to the index will run this pipeline.
+      logging.info(f"Creating a new version of index {INDEX_NAME}")
+      version_name = index_utils.create_next_version(
+        os_client=os_client,
+        alias_name=INDEX_NAME,
+        search_pipeline_name=SEARCH_PIPELINE_NAME
+      )
     
-    # Read and add documents to the index with the opensearch-py bulk helper.
-    logging.info(f"Indexing documents")
-    counter = AutoIncrementingCounter()
-    for bulk in movie_source.bulks(BULK_SIZE, INDEX_NAME):
-      logging.info(f"Indexing bulk {str(counter)} / {TOTAL_NUMBER_OF_BULKS}")
-      opensearchpy.helpers.bulk(os_client, bulk, timeout=600, max_retries=10)
-  else:
-    logging.info(f"Skipping indexing")
-
-  while (True):
-    question = input("Enter your question (or 'q' to quit): ")
-    question = question.strip()
-    if question.lower() == 'q':
-      break
-    search_query = copy.deepcopy(CONVERSATION_SEARCH_QUERY)
-    search_query['query']['simple_query_string']['query'] = question
-    search_query['ext']['generative_qa_parameters']['llm_question'] = question
-    search_query['ext']['generative_qa_parameters']['memory_id'] = conversation_memory_id
-    response = os_client.search(index=INDEX_NAME, body=search_query, timeout=60)
-
-    logging.info(f"These are the movies retrieved for the question: {question}")
-    for hit in response['hits']['hits']:
-      logging.info(f"{hit['_source']['title']}")
-      logging.info(f"{hit['_source']['plot']}")
-    logging.info('')
-    logging.info('')
-    logging.info(f"Generated response for '{question}'")
-    logging.info(response['ext']['retrieval_augmented_generation']['answer'])
-    logging.info('')
-    logging.info('')
+      # Read and add documents to the index with the opensearch-py bulk helper.
+      logging.info(f"Indexing documents")
+      counter = AutoIncrementingCounter()
+      for bulk in movie_source.bulks(BULK_SIZE, version_name):
+        logging.info(f"Indexing bulk {str(counter)} / {TOTAL_NUMBER_OF_BULKS}")
+        opensearchpy.helpers.bulk(os_client, bulk, timeout=600, max_retries=10)
+
+      # Point the INDEX_NAME alias, which all queries use, at the new version,
+      # and delete old versions (see index_utils.py)
+      index_utils.publish_version(os_client, INDEX_NAME, version_name, retain)
+    else:
+      logging.info(f"Skipping indexing")
+
+    cache = None
+    if semantic_cache:
+      cache = create_answer_cache(os_client, cache_threshold, cache_ttl, cache_size)
+
+    if questions_file:
+      questions = batch_search.read_queries(questions_file)
+      executor = 'client' if trim else executor
+      logging.info(f"Answering {len(questions)} questions in {concurrency} "
+                   f"conversations with the {executor} executor")
+      rows, seconds = run_batch(os_client, questions, concurrency, executor, cache,
+                                trim, token_budget, sentences_per_hit)
+      summary = batch_summary(rows, seconds)
+      print(bench_utils.format_table(
+        summary, ['stage', 'count', 'mean', 'p50', 'p90', 'p99', 'max',
+                  'questions_per_second']))
+      if output_path:
+        bench_utils.write_json(output_path, {
+          "executor": executor, "concurrency": concurrency, "trim": trim,
+          "stub_llm_url": stub_llm_url, "seconds": seconds,
+          "summary": summary, "rows": rows})
+      return
+
+    llm_model_id = rag_model_id(os_client) if trim else None
+    full_tokens = trimmed_tokens = 0
+
+    while (True):
+      question = input("Enter your question (or 'q' to quit): ")
+      question = question.strip()
+      if question.lower() == 'q':
+        break
+
+      cached = cache.get(question) if cache else None
+      if cached:
+        answer, similarity, cached_question = cached
+        add_interaction(os_client, conversation_memory_id, question, answer)
+        logging.info(f"Cached response for '{question}' (matched "
+                     f"'{cached_question}', similarity {similarity:.3f})")
+        logging.info(answer)
+        logging.info('')
+        logging.info('')
+        continue
+
+      if trim:
+        result = client_answer(os_client, question, conversation_memory_id,
+                               llm_model_id, trim, token_budget, sentences_per_hit)
+        full_tokens += result['full_tokens']
+        trimmed_tokens += result['prompt_tokens']
+        logging.info(f"Prompt size: ~{result['full_tokens']} tokens with full "
+                     f"plots, ~{result['prompt_tokens']} trimmed ({trim})")
+      else:
+        result = pipeline_answer(os_client, question, conversation_memory_id)
+      answer, hits = result['answer'], result['hits']
+
+      logging.info(f"These are the movies retrieved for the question: {question}")
+      for hit in hits:
+        logging.info(f"{hit['_source']['title']}")
+        logging.info(f"{hit['_source']['plot']}")
+      logging.info('')
+      logging.info('')
+      logging.info(f"Generated response for '{question}'")
+      logging.info(answer)
+      if cache:
+        cache.put(question, answer)
+      logging.info('')
+      logging.info('')
+
+    if trim and full_tokens:
+      logging.info(f"Total prompt size: ~{full_tokens} tokens with full plots, "
+                   f"~{trimmed_tokens} trimmed ({trimmed_tokens / full_tokens:.0%})")
 
 
 if __name__ == "__main__":
@@ -240,5 +593,51 @@ if __name__ == "__main__":
       description="Conversational chat bot.",
   )
   parser.add_argument("--skip-indexing", default=False, action="store_true")
+  parser.add_argument("--semantic-cache", default=False, action="store_true",
+                      help="Answer repeated or similar questions from a local "
+                      "cache instead of the LLM")
+  parser.add_argument("--cache-threshold", default=answer_cache.DEFAULT_THRESHOLD,
+                      type=float, help="Minimum cosine similarity for a cache hit")
+  parser.add_argument("--cache-ttl", default=answer_cache.DEFAULT_TTL_SECONDS,
+                      type=float, help="Seconds a cached answer stays valid")
+  parser.add_argument("--cache-size", default=answer_cache.DEFAULT_MAX_SIZE,
+                      type=int, help="Maximum number of cached answers")
+  parser.add_argument("--trim", default=None, choices=rag_context.TRIM_MODES,
+                      help="Send the LLM plot highlights or top sentences "
+                      "instead of full plots")
+  parser.add_argument("--token-budget", default=rag_context.DEFAULT_TOKEN_BUDGET,
+                      type=int, help="Maximum estimated tokens of trimmed context")
+  parser.add_argument("--sentences-per-hit",
+                      default=rag_context.DEFAULT_SENTENCES_PER_HIT, type=int)
+  parser.add_argument("--stub-llm-url", default=None, action="store",
+                      help="Use stub_llm_server.py at this URL instead of "
+                      "Bedrock, e.g. http://10.0.0.5:8088")
+  parser.add_argument("--questions-file", default=None, action="store",
+                      help="Answer the questions in this file concurrently "
+                      "and report latencies, instead of the interactive loop")
+  parser.add_argument("--concurrency", default=4, type=int,
+                      help="Concurrent conversations for --questions-file")
+  parser.add_argument("--executor", default='client',
+                      choices=['client', 'pipeline'],
+                      help="client times retrieval and generation separately, "
+                      "pipeline sends each question through the RAG pipeline")
+  parser.add_argument("--output", default=None, action="store")
+  parser.add_argument("--retain", default=index_utils.RETAINED_VERSIONS,
+                      type=int, action="store",
+                      help="Index versions to keep after the alias swap, "
+                      "including the live one")
   args = parser.parse_args()
-  main(skip_indexing=args.skip_indexing)
+  main(skip_indexing=args.skip_indexing,
+       semantic_cache=args.semantic_cache,
+       cache_threshold=args.cache_threshold,
+       cache_ttl=args.cache_ttl,
+       cache_size=args.cache_size,
+       trim=args.trim,
+       token_budget=args.token_budget,
+       sentences_per_hit=args.sentences_per_hit,
+       stub_llm_url=args.stub_llm_url,
+       questions_file=args.questions_file,
+       concurrency=args.concurrency,
+       executor=args.executor,
+       output_path=args.output,
+       retain=args.retain)
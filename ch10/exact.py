@@ -20,14 +20,15 @@ For Amazon OpenSearch Service deployments, set port to 443.
 
 import argparse
 from auto_incrementing_counter import AutoIncrementingCounter
+import batch_search
 from copy import deepcopy
-import jsonpath_ng.ext
 import index_utils
 import logging
 import model_utils
 import movie_source
 from os_client_factory import OSClientFactory
 import opensearchpy.helpers
+from query_templates import QueryTemplate, Slot
 
 
 # NOTE: Much of the code is duplicated across the various examples. Better
@@ -88,8 +89,8 @@ ingest_pipeline_definition = {
 
 
 # An exact kNN query. Uses a match_all query along with a Painless script to
-# compute the score.
-script_query = {
+# compute the score. The template is compiled once, see query_templates.py.
+script_query = QueryTemplate({
   "query": {
     "script_score": {
       "query": {
@@ -100,18 +101,19 @@ script_query = {
         "lang": "knn",
         "params": {
           "field": EMBEDDING_FIELD_NAME,
-          "query_value": [],
+          "query_value": Slot('vector'),
           "space_type": "cosinesimil"
-}}}}}
+}}}}})
 
 
 # An exact kNN query with a bool filter for SciFi movies. First filters the
-# movies for SciFi and then computes a score based on vector distance.
-filtered_script_query = {
+# movies for SciFi and then computes a score based on vector distance. Pass a
+# different filter query in the filters slot to change the filter.
+filtered_script_query = QueryTemplate({
   "sort": [{"_score": "asc"}],
   "query": {
     "script_score": {
-      "query": {
+      "query": Slot('filters', default={
         "bool": {
           "filter": [
             { "term": {
@@ -119,15 +121,15 @@ filtered_script_query = {
             }},
             { "range": {"rating": {"gte": 6.0}}}]
         }
-      },
+      }),
       "script": {
         "source": "knn_score",
         "lang": "knn",
         "params": {
           "field": EMBEDDING_FIELD_NAME,
-          "query_value": [],
+          "query_value": Slot('vector'),
           "space_type": "l2"
-}}}}}
+}}}}})
 
 
 # Main function. Finds or loads the embedding model, creates the index (unless
@@ -135,7 +137,9 @@ filtered_script_query = {
 # query "A sweeping space opera about good and evil centered around a powerful
 # family set in the future" and then runs the exact query and prints the search
 # response.
-def main(skip_indexing=False, filtered=False, user_query=None):
+def main(skip_indexing=False, filtered=False, user_query=None,
+         queries_file=None, batch_size=batch_search.MSEARCH_BATCH_SIZE,
+         output_path='-', retain=index_utils.RETAINED_VERSIONS):
   logging.info(f"Query: {user_query}")
 
   # See os_client_factory.py for details on the set up for the opensearch-py
@@ -162,11 +166,11 @@ def main(skip_indexing=False, filtered=False, user_query=None):
     pipeline_definition['processors'][0]['text_embedding']['model_id'] = model_id
     os_client.ingest.put_pipeline(id=PIPELINE_NAME, body=pipeline_definition)
 
-    # Create an index with the pipeline
-    logging.info(f"Creating index {INDEX_NAME}")
-    index_utils.delete_then_create_index(
+    # Create a new version of the index, with the pipeline, next to the live one
+    logging.info(f"Creating a new version of index {INDEX_NAME}")
+    version_name = index_utils.create_next_version(
       os_client=os_client,
-      index_name=INDEX_NAME,
+      alias_name=INDEX_NAME,
       ingest_pipeline_name=PIPELINE_NAME,
       additional_fields=KNN_FIELDS
     )
@@ -174,24 +178,35 @@ def main(skip_indexing=False, filtered=False, user_query=None):
     # Read and add documents to the index with the opensearch-py bulk helper.
     logging.info(f"Indexing documents")
     counter = AutoIncrementingCounter()
-    for bulk in movie_source.bulks(BULK_SIZE, INDEX_NAME):
+    for bulk in movie_source.bulks(BULK_SIZE, version_name):
       logging.info(f"Indexing bulk {str(counter)} / {TOTAL_NUMBER_OF_BULKS}")
       opensearchpy.helpers.bulk(os_client, bulk, timeout=600, max_retries=10)
+
+    # Point the INDEX_NAME alias, which all queries use, at the new version,
+    # and delete old versions (see index_utils.py)
+    index_utils.publish_version(os_client, INDEX_NAME, version_name, retain)
   else:
     logging.info(f"Skipping indexing")
 
+  # With --queries-file, run every query in the file as batched _msearch
+  # requests and write the results as NDJSON, instead of the single query.
+  if queries_file:
+    batch_search.run_queries_file(
+      os_client=os_client, index_name=INDEX_NAME,
+      template=filtered_script_query if filtered else script_query,
+      queries_file=queries_file, output_path=output_path, model_id=model_id,
+      batch_size=batch_size)
+    return
+
   # Run a query. Calls the LLM to generate a vector embedding for the user query
   # (see model_utils.py) and then adds that embedding to the OpenSearch query.
   logging.info(f"Running query")
-  if filtered:
-    query = deepcopy(filtered_script_query)
-  else:
-    query = deepcopy(script_query)
   question = user_query if user_query else "Sci-fi about the force and jedis"
   query_embedding = model_utils.create_embedding(os_client, model_id, question)
-
-  expr = jsonpath_ng.ext.parser.parse('query.script_score.script.params.query_value')
-  query = expr.update(query, query_embedding)
+  if filtered:
+    query = filtered_script_query.build(vector=query_embedding)
+  else:
+    query = script_query.build(vector=query_embedding)
   response = os_client.search(index=INDEX_NAME, body=query)
 
   # Print the search response.
@@ -219,7 +234,23 @@ if __name__ == "__main__":
   parser.add_argument("--filtered", default=False, action="store_true")
   parser.add_argument("--query", default="Sci-fi about the force and jedis",
                       action="store")
+  parser.add_argument("--queries-file", default=None, action="store",
+                      help="Run every query in this file (one per line) with "
+                      "_msearch, instead of --query")
+  parser.add_argument("--batch-size", default=batch_search.MSEARCH_BATCH_SIZE,
+                      type=int, action="store",
+                      help="Queries per _msearch request for --queries-file")
+  parser.add_argument("--output", default="-", action="store",
+                      help="NDJSON results file for --queries-file, - for stdout")
+  parser.add_argument("--retain", default=index_utils.RETAINED_VERSIONS,
+                      type=int, action="store",
+                      help="Index versions to keep after the alias swap, "
+                      "including the live one")
   args = parser.parse_args()
   main(skip_indexing=args.skip_indexing,
        filtered=args.filtered,
-       user_query=args.query)
+       user_query=args.query,
+       queries_file=args.queries_file,
+       batch_size=args.batch_size,
+       output_path=args.output,
+       retain=args.retain)
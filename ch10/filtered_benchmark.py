@@ -0,0 +1,232 @@
+"""
+Filtered kNN benchmark across filter selectivities.
+
+Filtered vector search behaves very differently depending on how much of the
+index the filter matches. This benchmark builds filters at fixed target
+selectivities (0.1% to 90% by default) from the movies' own field
+distributions, and runs each one against the approximate indices in every
+filtering mode:
+
+    - efficient: the filter inside the knn query, once for each
+      knn.advanced.filtered_exact_search_threshold value. The threshold is the
+      filtered set size at or below which the k-NN plugin scores the matching
+      documents exactly instead of searching the graph (-1 never does)
+    - post_filter: an unfiltered knn query for k / selectivity candidates, with
+      the filter as a post_filter (see filtered_knn_planner.py)
+
+Filters come from the source index (exact_movies by default). For each target
+selectivity the benchmark considers rating >= x and year >= x at the matching
+percentile, and a term filter on each genre, and keeps the one whose _count is
+closest to the target. The actual selectivity is reported with the results.
+
+Recall is against the exact top k among the documents that match the filter,
+computed locally from the cached corpus vectors. The documents that match are
+read from the source index by movie id.
+
+The threshold setting is changed on each index during the run and restored
+afterwards.
+
+Usage:
+    python filtered_benchmark.py --queries-file queries.txt
+    python filtered_benchmark.py --queries-file queries.txt --targets hnsw sq \\
+        --selectivity 0.01 0.5 --thresholds -1 1000
+"""
+
+
+import argparse
+import batch_search
+from bench_utils import BENCH_TARGETS
+import bench_utils
+import filtered_knn_planner
+import logging
+import math
+import numpy as np
+from opensearchpy import OpenSearch
+import opensearchpy.helpers
+from os_client_factory import OSClientFactory
+import recall_benchmark
+import vector_cache
+
+
+DEFAULT_TARGETS = ['hnsw', 'ivf', 'sq', 'on_disk']
+DEFAULT_SELECTIVITIES = [0.001, 0.01, 0.05, 0.2, 0.5, 0.9]
+DEFAULT_THRESHOLDS = [-1, 1000, 10000]
+THRESHOLD_SETTING = 'index.knn.advanced.filtered_exact_search_threshold'
+RANGE_FIELDS = ['rating', 'year']
+GENRE_FIELD = 'genres.keyword'
+
+
+def _count(os_client: OpenSearch, index_name, filters):
+  return os_client.count(index=index_name, body={"query": filters})['count']
+
+
+def candidate_filters(os_client: OpenSearch, index_name, selectivities):
+  '''Candidate filters from the field distributions: for each range field, a
+  gte filter at the percentile that leaves each target selectivity above it,
+  and a term filter for each genre.'''
+  percents = sorted({100 * (1 - selectivity) for selectivity in selectivities})
+  aggs = {field: {"percentiles": {"field": field, "percents": percents}}
+          for field in RANGE_FIELDS}
+  aggs['genres'] = {"terms": {"field": GENRE_FIELD, "size": 100}}
+  response = os_client.search(index=index_name,
+                              body={"size": 0, "aggs": aggs})['aggregations']
+  candidates = []
+  for field in RANGE_FIELDS:
+    for value in response[field]['values'].values():
+      if value is not None:
+        candidates.append((f"{field}>={value:g}",
+                           {"range": {field: {"gte": value}}}))
+  for bucket in response['genres']['buckets']:
+    candidates.append((f"genre={bucket['key']}",
+                       {"term": {GENRE_FIELD: bucket['key']}}))
+  return candidates
+
+
+def filters_for(os_client: OpenSearch, index_name, selectivities):
+  '''For each target selectivity, the candidate filter whose matching
+  fraction is closest to it, by ratio. Returns a list of (target, name,
+  filter, actual selectivity).'''
+  total = os_client.count(index=index_name)['count']
+  counted = []
+  for name, filters in candidate_filters(os_client, index_name, selectivities):
+    count = _count(os_client, index_name, filters)
+    if count:
+      counted.append((name, filters, count / total))
+  chosen = []
+  for target in selectivities:
+    name, filters, actual = min(
+      counted, key=lambda candidate: abs(math.log(candidate[2] / target)))
+    logging.info(f"Target selectivity {target:.1%}: {name} ({actual:.2%})")
+    chosen.append((target, name, filters, actual))
+  return chosen
+
+
+def matching_ids(os_client: OpenSearch, index_name, filters):
+  '''The movie ids of the documents that match filters.'''
+  return np.array([hit['fields']['id'][0] for hit in opensearchpy.helpers.scan(
+    os_client, index=index_name, size=vector_cache.SCROLL_SIZE,
+    query={"_source": False, "docvalue_fields": ["id"], "query": filters})],
+    dtype=np.int64)
+
+
+def filtered_ground_truth(corpus_ids, corpus, query_matrix, k, allowed_ids,
+                          space_type='l2'):
+  '''The exact top k movie ids for each query among allowed_ids.'''
+  rows = np.flatnonzero(np.isin(corpus_ids, allowed_ids))
+  if not len(rows):
+    return [[] for _ in range(len(query_matrix))]
+  return recall_benchmark.ground_truth(corpus_ids[rows], corpus[rows],
+                                       query_matrix, k, space_type)
+
+
+def _threshold(os_client: OpenSearch, index_name):
+  settings = os_client.indices.get_settings(index=index_name, name=THRESHOLD_SETTING,
+                                            flat_settings=True)
+  return next(iter(settings.values()))['settings'].get(THRESHOLD_SETTING)
+
+
+def _set_threshold(os_client: OpenSearch, index_name, threshold):
+  os_client.indices.put_settings(index=index_name,
+                                 body={THRESHOLD_SETTING: threshold})
+
+
+def filter_bodies(os_client: OpenSearch, query_matrix, k, filters, selectivity):
+  '''Query bodies for one filter: (efficient, post_filter). The post_filter
+  bodies ask the knn query for enough candidates that about k match.'''
+  target = BENCH_TARGETS['hnsw']
+  efficient = recall_benchmark.id_query_bodies(os_client, target, query_matrix, k,
+                                               filters=filters)
+  post_k = min(filtered_knn_planner.MAX_K, math.ceil(
+    k / selectivity * filtered_knn_planner.POST_FILTER_OVERSAMPLE))
+  post_filter = [dict(body, size=k, post_filter=filters) for body in
+                 recall_benchmark.id_query_bodies(os_client, target, query_matrix,
+                                                  post_k)]
+  return efficient, post_filter
+
+
+def main(queries_file, targets=DEFAULT_TARGETS,
+         selectivities=DEFAULT_SELECTIVITIES, thresholds=DEFAULT_THRESHOLDS,
+         k=10, source_index=None, output_path=None):
+  os_client = OSClientFactory().client()
+  source_index = source_index or vector_cache.DEFAULT_SOURCE_INDEX
+  corpus_ids, corpus = vector_cache.corpus_vectors(os_client, index_name=source_index)
+  texts = [query['query'] for query in batch_search.read_queries(queries_file)]
+  query_matrix = vector_cache.query_vectors(os_client, texts)
+
+  filters = []
+  for target, name, filter_query, actual in filters_for(os_client, source_index,
+                                                        selectivities):
+    allowed = matching_ids(os_client, source_index, filter_query)
+    filters.append((target, name, filter_query, actual, allowed))
+
+  rows = []
+  for target_name in targets:
+    index_name = BENCH_TARGETS[target_name]['index']
+    if not os_client.indices.exists(index=index_name):
+      logging.warning(f"Index {index_name} does not exist, skipping {target_name}")
+      continue
+    space_type = recall_benchmark.space_type_for(os_client, index_name)
+    original_threshold = _threshold(os_client, index_name)
+    try:
+      for target, name, filter_query, actual, allowed in filters:
+        truth = filtered_ground_truth(corpus_ids, corpus, query_matrix, k,
+                                      allowed, space_type)
+        efficient, post_filter = filter_bodies(os_client, query_matrix, k,
+                                               filter_query, actual)
+        row = {"target": target_name, "selectivity": target, "filter": name,
+               "actual_selectivity": actual}
+        for threshold in thresholds:
+          _set_threshold(os_client, index_name, threshold)
+          logging.info(f"Measuring {target_name}, {name}, threshold {threshold}")
+          rows.append(dict(row, mode="efficient", threshold=threshold,
+                           **recall_benchmark.measure_bodies(
+                             os_client, index_name, efficient, truth, k)))
+        logging.info(f"Measuring {target_name}, {name}, post_filter")
+        rows.append(dict(row, mode="post_filter", threshold=None,
+                         **recall_benchmark.measure_bodies(
+                           os_client, index_name, post_filter, truth, k)))
+    finally:
+      _set_threshold(os_client, index_name, original_threshold)
+
+  columns = ['target', 'selectivity', 'filter', 'actual_selectivity', 'mode',
+             'threshold', 'latency_p50', 'latency_p99', 'recall']
+  print(bench_utils.format_table(rows, columns))
+  if output_path:
+    bench_utils.write_json(output_path, {"k": k, "rows": rows})
+  return rows
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Measures filtered kNN latency and recall across filter "
+      "selectivities, with efficient filtering at several exact search "
+      "thresholds and with post-filtering.",
+  )
+  parser.add_argument("--queries-file", required=True, action="store")
+  parser.add_argument("--targets", nargs='+', default=DEFAULT_TARGETS,
+                      choices=sorted(t for t, v in BENCH_TARGETS.items()
+                                     if v['query_type'] == 'knn'))
+  parser.add_argument("--selectivity", nargs='+', type=float,
+                      default=DEFAULT_SELECTIVITIES)
+  parser.add_argument("--thresholds", nargs='+', type=int,
+                      default=DEFAULT_THRESHOLDS,
+                      help="filtered_exact_search_threshold values, -1 disables "
+                      "exact search")
+  parser.add_argument("--k", default=10, type=int)
+  parser.add_argument("--source-index", default=None, action="store")
+  parser.add_argument("--output", default=None, action="store")
+  args = parser.parse_args()
+  main(queries_file=args.queries_file,
+       targets=args.targets,
+       selectivities=args.selectivity,
+       thresholds=args.thresholds,
+       k=args.k,
+       source_index=args.source_index,
+       output_path=args.output)
@@ -0,0 +1,196 @@
+"""
+Chooses how to run a filtered kNN query from the filter's selectivity.
+
+There are three ways to combine a filter with vector search, and which one is
+fast depends on how many documents the filter matches:
+
+    - exact: script_score over the filter (exact.py --filtered). Cost grows
+      with the matching documents, so it's the fastest for a small filtered
+      set, and its recall is perfect
+    - efficient: a knn query with the filter inside it. The k-NN plugin
+      applies the filter while it searches the graph. Good in the middle
+      range
+    - post_filter: an unfiltered knn query for k / selectivity candidates
+      (with some headroom), with the filter as a post_filter. When most
+      documents match, the graph search barely needs to change, and the
+      oversampled k makes up for the candidates the filter removes
+
+The planner estimates selectivity with _count, caching the count for each
+filter for COUNT_TTL_SECONDS, and logs which strategy it picked and why.
+
+index_utils.BASE_SETTINGS sets knn.advanced.filtered_exact_search_threshold
+to 0, so the k-NN plugin never switches to exact search on its own. The
+planner makes that choice on the client, where it can also pick
+post-filtering.
+
+Usage:
+    python filtered_knn_planner.py --query "space opera"
+    python filtered_knn_planner.py --query "heist" --filter-json \\
+        '{"range": {"year": {"gte": 2015}}}' --index approximate_movies_sq
+"""
+
+
+import argparse
+from bench_utils import BENCH_TARGETS, KNN_QUERY
+import bench_utils
+import exact
+import json
+import logging
+import math
+import model_utils
+from opensearchpy import OpenSearch
+from os_client_factory import OSClientFactory
+import time
+
+
+# Filters matching at most this many documents run as exact script scoring.
+EXACT_MAX_DOCS = 2000
+# Filters matching at least this fraction of the index run as post filters.
+POST_FILTER_MIN_SELECTIVITY = 0.5
+# Headroom on the post_filter k, over k / selectivity.
+POST_FILTER_OVERSAMPLE = 1.5
+MAX_K = 10000
+COUNT_TTL_SECONDS = 300
+
+# The Sci-Fi, rating >= 6 filter from exact.py.
+DEFAULT_FILTER = exact.filtered_script_query.slots['filters'].default
+
+
+class FilteredKnnPlanner:
+  '''
+  Plans and runs filtered kNN queries against one index.
+
+  Args:
+      os_client (OpenSearch): Client for _count and _search
+      index_name (str): An index with a knn_vector field named
+          exact.EMBEDDING_FIELD_NAME
+      exact_max_docs (int): The largest filtered set to score exactly
+      post_filter_min_selectivity (float): The smallest matching fraction to
+          post filter
+      count_ttl (float): Seconds to cache each filter's count
+  '''
+  def __init__(self, os_client: OpenSearch, index_name,
+               exact_max_docs=EXACT_MAX_DOCS,
+               post_filter_min_selectivity=POST_FILTER_MIN_SELECTIVITY,
+               count_ttl=COUNT_TTL_SECONDS):
+    self.os_client = os_client
+    self.index_name = index_name
+    self.exact_max_docs = exact_max_docs
+    self.post_filter_min_selectivity = post_filter_min_selectivity
+    self.count_ttl = count_ttl
+    self._counts = {}
+
+  def count(self, filters=None):
+    '''Documents matching filters (all documents for None), from the cache if
+    the count is newer than count_ttl.'''
+    key = json.dumps(filters, sort_keys=True)
+    cached = self._counts.get(key)
+    if cached and time.monotonic() - cached[1] < self.count_ttl:
+      return cached[0]
+    body = {"query": filters} if filters else None
+    count = self.os_client.count(index=self.index_name, body=body)['count']
+    self._counts[key] = (count, time.monotonic())
+    return count
+
+  def plan(self, filters, k=10):
+    '''Returns the plan for a filter: strategy, reason, the matching and
+    total document counts, and selectivity.'''
+    matching = self.count(filters)
+    total = self.count()
+    selectivity = matching / total if total else 0.0
+    if matching <= self.exact_max_docs:
+      strategy = 'exact'
+      reason = (f"{matching} matching docs <= {self.exact_max_docs}, exact "
+                "scoring is cheap")
+    elif selectivity >= self.post_filter_min_selectivity:
+      strategy = 'post_filter'
+      reason = (f"selectivity {selectivity:.1%} >= "
+                f"{self.post_filter_min_selectivity:.0%}, few candidates are "
+                "filtered out")
+    else:
+      strategy = 'efficient'
+      reason = f"selectivity {selectivity:.1%}, {matching} matching docs"
+    logging.info(f"Filtered kNN on {self.index_name}: {strategy} ({reason})")
+    return {"strategy": strategy, "reason": reason, "matching": matching,
+            "total": total, "selectivity": selectivity}
+
+  def query(self, vector, filters, k=10):
+    '''Returns (plan, query body) for a filtered kNN query.'''
+    plan = self.plan(filters, k)
+    if plan['strategy'] == 'exact':
+      body = exact.filtered_script_query.build(vector=vector, filters=filters)
+      # knn_score scores are higher for closer vectors, so keep the default
+      # descending sort rather than the template's.
+      body.pop('sort', None)
+    elif plan['strategy'] == 'post_filter':
+      oversampled_k = min(MAX_K, math.ceil(
+        k / max(plan['selectivity'], 1e-9) * POST_FILTER_OVERSAMPLE))
+      plan['k'] = oversampled_k
+      body = KNN_QUERY.build(vector=vector, k=oversampled_k)
+      body['post_filter'] = filters
+    else:
+      body = KNN_QUERY.build(vector=vector, k=k, filters=filters)
+    body['size'] = k
+    return plan, body
+
+  def search(self, vector, filters, k=10):
+    '''Plans and runs a filtered kNN query. Returns (plan, response).'''
+    plan, body = self.query(vector, filters, k)
+    return plan, self.os_client.search(index=self.index_name, body=body)
+
+
+def main(user_query, filters=None, index_name=None, k=10,
+         exact_max_docs=EXACT_MAX_DOCS,
+         post_filter_min_selectivity=POST_FILTER_MIN_SELECTIVITY):
+  os_client = OSClientFactory().client()
+  model_id = model_utils.model_id_for(os_client, bench_utils.DENSE_MODEL_NAME)
+  if model_id is None:
+    raise ValueError(f'Model {bench_utils.DENSE_MODEL_NAME} is not deployed. Run '
+                     'one of the example scripts first.')
+  planner = FilteredKnnPlanner(os_client,
+                               index_name or BENCH_TARGETS['hnsw']['index'],
+                               exact_max_docs=exact_max_docs,
+                               post_filter_min_selectivity=post_filter_min_selectivity)
+  query_embedding = model_utils.create_embedding(os_client, model_id, user_query)
+  plan, response = planner.search(query_embedding, filters or DEFAULT_FILTER, k)
+
+  # Print the plan and the search response.
+  logging.info(f"Plan: {plan}")
+  logging.info(f"took: {response['took']} ms")
+  for hit in response['hits']['hits']:
+    logging.info(f"score: {hit['_score']}")
+    logging.info(f"title: {hit['_source']['title']}")
+    logging.info(f"plot: {hit['_source']['plot']}\n")
+  return plan, response
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Runs a filtered kNN query, choosing exact scoring, "
+      "efficient filtering or post-filtering from the filter's selectivity.",
+  )
+  parser.add_argument("--query", default="Sci-fi about the force and jedis",
+                      action="store")
+  parser.add_argument("--filter-json", default=None, action="store",
+                      help="Filter query clause as JSON, defaults to exact.py's "
+                      "Sci-Fi, rating >= 6 filter")
+  parser.add_argument("--index", default=None, action="store",
+                      help="Index to search, defaults to the HNSW example index")
+  parser.add_argument("--k", default=10, type=int)
+  parser.add_argument("--exact-max-docs", default=EXACT_MAX_DOCS, type=int)
+  parser.add_argument("--post-filter-min-selectivity",
+                      default=POST_FILTER_MIN_SELECTIVITY, type=float)
+  args = parser.parse_args()
+  main(user_query=args.query,
+       filters=json.loads(args.filter_json) if args.filter_json else None,
+       index_name=args.index,
+       k=args.k,
+       exact_max_docs=args.exact_max_docs,
+       post_filter_min_selectivity=args.post_filter_min_selectivity)
@@ -0,0 +1,156 @@
+"""
+HNSW parameter sweep for the ch10 movies vectors.
+
+approximate_hnsw.py and approximate_faiss_sq.py both hard-code m=64,
+ef_construction=512 and ef_search=16. m=64 is expensive: each vector carries
+up to 2*m neighbor links at layer 0. This sweep builds one index per (m,
+ef_construction) pair in a grid, from the cached corpus vectors rather than
+from text, and records for each one:
+
+    - indexing throughput (bulk + refresh) and force merge time
+    - native graph memory from the k-NN stats API
+    - query latency and recall@k for each ef_search in the grid (ef_search is
+      a query-time method parameter, so it doesn't need a rebuild)
+
+It then prints the Pareto frontier over memory, p99 latency and recall: the
+configurations for which no other configuration is at least as good on all
+three and better on one. Pick production values from the frontier.
+
+Usage:
+    python hnsw_sweep.py --queries-file queries.txt
+    python hnsw_sweep.py --queries-file queries.txt --m 8 16 32 \\
+        --ef-construction 128 256 --ef-search 16 64 256 --encoder sq
+
+The sweep indices are named hnsw_sweep_m<m>_efc<ef_construction> and are
+deleted after they are measured, unless you pass --keep-indices.
+"""
+
+
+import argparse
+import batch_search
+import bench_utils
+import logging
+from os_client_factory import OSClientFactory
+import recall_benchmark
+import vector_cache
+import vector_index_builder
+
+
+INDEX_PREFIX = 'hnsw_sweep'
+DEFAULT_M = [8, 16, 32, 64]
+DEFAULT_EF_CONSTRUCTION = [128, 256, 512]
+DEFAULT_EF_SEARCH = [16, 32, 64, 128, 256]
+SPACE_TYPE = 'l2'
+
+# The encoders the sweep can apply to the graph's vectors. flat keeps full
+# float32 vectors, like approximate_hnsw.py. sq is the fp16 scalar quantizer,
+# like approximate_faiss_sq.py.
+ENCODERS = {
+  "flat": None,
+  "sq": {"name": "sq", "parameters": {"type": "fp16", "clip": True}},
+}
+
+
+def hnsw_field(dimension, m, ef_construction, encoder=None):
+  '''The knn_vector mapping for one point in the grid.'''
+  parameters = {"m": m, "ef_construction": ef_construction}
+  if encoder:
+    parameters['encoder'] = encoder
+  return {
+    vector_index_builder.FIELD_NAME: {
+      "type": "knn_vector",
+      "dimension": dimension,
+      "method": {
+        "name": "hnsw",
+        "engine": "faiss",
+        "space_type": SPACE_TYPE,
+        "parameters": parameters
+  }}}
+
+
+def main(queries_file, ms=DEFAULT_M, ef_constructions=DEFAULT_EF_CONSTRUCTION,
+         ef_searches=DEFAULT_EF_SEARCH, k=10, encoder='flat', source_index=None,
+         keep_indices=False, output_path=None):
+  os_client = OSClientFactory().client()
+  corpus_ids, corpus = vector_cache.corpus_vectors(
+    os_client, index_name=source_index or vector_cache.DEFAULT_SOURCE_INDEX)
+  texts = [query['query'] for query in batch_search.read_queries(queries_file)]
+  query_matrix = vector_cache.query_vectors(os_client, texts)
+  truth = recall_benchmark.ground_truth(corpus_ids, corpus, query_matrix, k,
+                                        SPACE_TYPE)
+
+  rows = []
+  for m in ms:
+    for ef_construction in ef_constructions:
+      index_name = f'{INDEX_PREFIX}_m{m}_efc{ef_construction}'
+      if encoder != 'flat':
+        index_name += f'_{encoder}'
+      build = vector_index_builder.build_index(
+        os_client, index_name,
+        hnsw_field(corpus.shape[1], m, ef_construction, ENCODERS[encoder]),
+        corpus_ids, corpus)
+      memory_kb = vector_index_builder.native_memory_kb(os_client, index_name)
+      for ef_search in ef_searches:
+        logging.info(f"Measuring {index_name} at ef_search={ef_search}")
+        metrics = recall_benchmark.measure_knn(
+          os_client, index_name, query_matrix, truth, k,
+          method_parameters={"ef_search": ef_search})
+        row = {"m": m, "ef_construction": ef_construction,
+               "ef_search": ef_search, "encoder": encoder,
+               "docs_per_second": build['docs_per_second'],
+               "merge_seconds": build['merge_seconds'],
+               "memory_mb": memory_kb / 1024}
+        row.update(metrics)
+        rows.append(row)
+      if not keep_indices:
+        os_client.indices.delete(index=index_name)
+
+  columns = ['m', 'ef_construction', 'ef_search', 'docs_per_second',
+             'memory_mb', 'latency_p50', 'latency_p99', 'recall', 'ndcg']
+  print("\nAll configurations")
+  print(bench_utils.format_table(rows, columns))
+  frontier = bench_utils.pareto_frontier(
+    rows, minimize=['memory_mb', 'latency_p99'], maximize=['recall'])
+  frontier.sort(key=lambda row: row['recall'])
+  print("\nPareto frontier (memory, p99 latency, recall)")
+  print(bench_utils.format_table(frontier, columns))
+  if output_path:
+    bench_utils.write_json(output_path, {"k": k, "rows": rows,
+                                         "frontier": frontier})
+  return rows, frontier
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Builds HNSW indices over a grid of m and ef_construction, "
+      "measures build speed, memory, latency and recall at each ef_search, and "
+      "prints the Pareto frontier.",
+  )
+  parser.add_argument("--queries-file", required=True, action="store")
+  parser.add_argument("--m", nargs='+', type=int, default=DEFAULT_M)
+  parser.add_argument("--ef-construction", nargs='+', type=int,
+                      default=DEFAULT_EF_CONSTRUCTION)
+  parser.add_argument("--ef-search", nargs='+', type=int, default=DEFAULT_EF_SEARCH)
+  parser.add_argument("--k", default=10, type=int)
+  parser.add_argument("--encoder", default="flat", choices=sorted(ENCODERS))
+  parser.add_argument("--source-index", default=None, action="store",
+                      help="Index to read the corpus vectors from")
+  parser.add_argument("--keep-indices", default=False, action="store_true")
+  parser.add_argument("--output", default=None, action="store")
+  args = parser.parse_args()
+  main(queries_file=args.queries_file,
+       ms=args.m,
+       ef_constructions=args.ef_construction,
+       ef_searches=args.ef_search,
+       k=args.k,
+       encoder=args.encoder,
+       source_index=args.source_index,
+       keep_indices=args.keep_indices,
+       output_path=args.output)
@@ -0,0 +1,265 @@
+"""
+Client-side hybrid search, and a latency benchmark against the server-side
+hybrid pipeline.
+
+approximate_hnsw.py --hybrid sends a hybrid query through hybrid_pipeline. The
+neural clause makes OpenSearch run the embedding model for the query text on
+every request, and the normalization processor fuses the match and neural
+results on the coordinating node. HybridSearcher does the same work on the
+client:
+
+    - it embeds the query text once, and keeps the embedding in an LRU cache,
+      so repeated queries skip the model entirely
+    - it sends the lexical match query and the knn query together in one
+      _msearch, so they run in parallel on the cluster
+    - it fuses the two result lists with min_max or l2 normalization and a
+      weighted arithmetic mean (like the normalization processor), or with
+      weighted reciprocal rank fusion (rrf)
+
+The weights and normalization default to the ones in
+approximate_hnsw.hybrid_pipeline_definition.
+
+Usage:
+    python hybrid_search.py --query "Sci-fi about the force and jedis"
+    python hybrid_search.py --queries-file queries.txt --technique rrf
+
+With --queries-file, it runs every query through both the server pipeline and
+HybridSearcher (twice, with a cold and then a warm embedding cache), and
+prints their latency and the overlap of their top k.
+
+Functions:
+    normalize(scores, technique): Normalized scores for one result list
+    fuse(result_lists, technique, weights, rank_constant): Fused ranking
+"""
+
+
+import approximate_hnsw
+import argparse
+import batch_search
+import bench_utils
+from collections import OrderedDict
+import index_utils
+import logging
+import math
+import model_utils
+from opensearchpy import OpenSearch
+from os_client_factory import OSClientFactory
+import time
+
+
+TECHNIQUES = ['min_max', 'l2', 'rrf']
+RRF_RANK_CONSTANT = 60
+EMBEDDING_CACHE_SIZE = 1024
+
+_combination = (approximate_hnsw.hybrid_pipeline_definition
+                ['phase_results_processors'][0]['normalization-processor'])
+DEFAULT_TECHNIQUE = _combination['normalization']['technique']
+DEFAULT_WEIGHTS = _combination['combination']['parameters']['weights']
+
+
+def normalize(scores, technique):
+  '''Normalizes one sub-query's scores, min_max to [0, 1] or l2 to unit
+  length.'''
+  if not scores:
+    return []
+  if technique == 'min_max':
+    low, high = min(scores), max(scores)
+    if high == low:
+      return [1.0] * len(scores)
+    return [(score - low) / (high - low) for score in scores]
+  if technique == 'l2':
+    norm = math.sqrt(sum(score * score for score in scores))
+    return [score / norm if norm else 0.0 for score in scores]
+  raise ValueError(f'Unknown normalization {technique}')
+
+
+def fuse(result_lists, technique=DEFAULT_TECHNIQUE, weights=DEFAULT_WEIGHTS,
+         rank_constant=RRF_RANK_CONSTANT):
+  '''
+  Fuses ranked result lists into one ranking.
+
+  Args:
+      result_lists (list): One list per sub-query of (doc_id, score) pairs,
+          best first
+      technique (str): min_max or l2 normalization with a weighted arithmetic
+          mean, or rrf. A document missing from a list scores 0 for that list
+      weights (list): One weight per list
+      rank_constant (int): The RRF constant, added to each rank
+
+  Returns:
+      list: (doc_id, fused score) pairs, best first
+  '''
+  fused = {}
+  if technique == 'rrf':
+    for weight, results in zip(weights, result_lists):
+      for rank, (doc_id, _) in enumerate(results, start=1):
+        fused[doc_id] = fused.get(doc_id, 0.0) + weight / (rank_constant + rank)
+  else:
+    total_weight = sum(weights)
+    for weight, results in zip(weights, result_lists):
+      normalized = normalize([score for _, score in results], technique)
+      for (doc_id, _), score in zip(results, normalized):
+        fused[doc_id] = fused.get(doc_id, 0.0) + weight * score / total_weight
+  return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+class HybridSearcher:
+  '''
+  Runs hybrid lexical + vector queries with client-side fusion.
+
+  Args:
+      os_client (OpenSearch): Client for _predict and _msearch
+      index_name (str): The HNSW index, with title and embedding fields
+      model_id (str): The deployed embedding model
+      technique (str): One of TECHNIQUES
+      weights (list): Weights for the match and knn results, in that order
+      k (int): Results to fetch from each sub-query and to return
+  '''
+  def __init__(self, os_client: OpenSearch, index_name, model_id,
+               technique=DEFAULT_TECHNIQUE, weights=DEFAULT_WEIGHTS, k=10,
+               cache_size=EMBEDDING_CACHE_SIZE):
+    self.os_client = os_client
+    self.index_name = index_name
+    self.model_id = model_id
+    self.technique = technique
+    self.weights = weights
+    self.k = k
+    self.cache_size = cache_size
+    self._embeddings = OrderedDict()
+
+  def embedding(self, text):
+    '''The query embedding, from the LRU cache when it's there.'''
+    if text in self._embeddings:
+      self._embeddings.move_to_end(text)
+      return self._embeddings[text]
+    vector = model_utils.create_embedding(self.os_client, self.model_id, text)
+    self._embeddings[text] = vector
+    if len(self._embeddings) > self.cache_size:
+      self._embeddings.popitem(last=False)
+    return vector
+
+  def sub_queries(self, text):
+    '''The match and knn query bodies for one query text.'''
+    return [
+      {"size": self.k, "_source": ["title"],
+       "query": {"match": {"title": {"query": text}}}},
+      dict(approximate_hnsw.simple_ann_query.build(vector=self.embedding(text),
+                                                   k=self.k),
+           size=self.k, _source=["title"])]
+
+  def search(self, text):
+    '''Runs the sub-queries in one _msearch and returns the fused hits, best
+    first, as dicts with _id, _score and title.'''
+    titles = {}
+    result_lists = []
+    for response in batch_search.msearch(self.os_client, self.index_name,
+                                         self.sub_queries(text)):
+      if 'error' in response:
+        raise RuntimeError(f"Hybrid sub-query failed: {response['error']}")
+      hits = response['hits']['hits']
+      for hit in hits:
+        titles[hit['_id']] = hit['_source'].get('title')
+      result_lists.append([(hit['_id'], hit['_score']) for hit in hits])
+    fused = fuse(result_lists, self.technique, self.weights)[:self.k]
+    return [{"_id": doc_id, "_score": score, "title": titles.get(doc_id)}
+            for doc_id, score in fused]
+
+
+def server_search(os_client: OpenSearch, text, model_id, k=10):
+  '''Runs the hybrid query through the server-side hybrid pipeline.'''
+  query = approximate_hnsw.hybrid_query.build(query_text=text, k=k,
+                                              model_id=model_id)
+  query['size'] = k
+  response = os_client.search(index=approximate_hnsw.INDEX_NAME, body=query,
+                              search_pipeline=approximate_hnsw.HYBRID_PIPELINE_NAME)
+  return [{"_id": hit['_id'], "_score": hit['_score'],
+           "title": hit['_source'].get('title')}
+          for hit in response['hits']['hits']]
+
+
+def _timed(search, texts):
+  results = []
+  latencies = []
+  for text in texts:
+    start = time.perf_counter()
+    results.append(search(text))
+    latencies.append((time.perf_counter() - start) * 1000)
+  return results, latencies
+
+
+def benchmark(os_client: OpenSearch, searcher, texts, model_id, k=10):
+  '''Times every query through the server pipeline and through searcher,
+  with a cold and then a warm embedding cache. Returns one row per executor
+  with latency percentiles and the mean top k overlap with the server
+  results.'''
+  server_results, server_latencies = _timed(
+    lambda text: server_search(os_client, text, model_id, k), texts)
+  rows = [dict(bench_utils.latency_summary(server_latencies),
+               executor="server_pipeline", overlap=1.0)]
+  for run in ['client_cold', 'client_warm']:
+    client_results, latencies = _timed(searcher.search, texts)
+    overlap = sum(
+      len({hit['_id'] for hit in server} & {hit['_id'] for hit in client}) / k
+      for server, client in zip(server_results, client_results)) / len(texts)
+    rows.append(dict(bench_utils.latency_summary(latencies), executor=run,
+                     overlap=overlap))
+  return rows
+
+
+def main(user_query=None, queries_file=None, technique=DEFAULT_TECHNIQUE,
+         weights=DEFAULT_WEIGHTS, k=10, output_path=None):
+  os_client = OSClientFactory().client()
+  model_id = model_utils.model_id_for(os_client, bench_utils.DENSE_MODEL_NAME)
+  if model_id is None:
+    raise ValueError(f'Model {bench_utils.DENSE_MODEL_NAME} is not deployed. Run '
+                     'approximate_hnsw.py first.')
+  searcher = HybridSearcher(os_client, approximate_hnsw.INDEX_NAME, model_id,
+                            technique=technique, weights=weights, k=k)
+
+  if not queries_file:
+    for hit in searcher.search(user_query):
+      logging.info(f"score: {hit['_score']:.4f} title: {hit['title']}")
+    return
+
+  index_utils.ensure_search_pipeline(os_client,
+                                     approximate_hnsw.HYBRID_PIPELINE_NAME,
+                                     approximate_hnsw.hybrid_pipeline_definition)
+  texts = [query['query'] for query in batch_search.read_queries(queries_file)]
+  rows = benchmark(os_client, searcher, texts, model_id, k)
+  print(bench_utils.format_table(
+    rows, ['executor', 'count', 'mean', 'p50', 'p90', 'p99', 'overlap']))
+  if output_path:
+    bench_utils.write_json(output_path, {"technique": technique,
+                                         "weights": weights, "k": k,
+                                         "rows": rows})
+  return rows
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Runs hybrid lexical + vector search with client-side fusion, "
+      "or with --queries-file compares its latency with the server-side hybrid "
+      "pipeline.",
+  )
+  parser.add_argument("--query", default="Sci-fi about the force and jedis",
+                      action="store")
+  parser.add_argument("--queries-file", default=None, action="store")
+  parser.add_argument("--technique", default=DEFAULT_TECHNIQUE, choices=TECHNIQUES)
+  parser.add_argument("--weights", nargs=2, type=float, default=DEFAULT_WEIGHTS,
+                      help="Weights for the match and knn results")
+  parser.add_argument("--k", default=10, type=int)
+  parser.add_argument("--output", default=None, action="store")
+  args = parser.parse_args()
+  main(user_query=args.query,
+       queries_file=args.queries_file,
+       technique=args.technique,
+       weights=args.weights,
+       k=args.k,
+       output_path=args.output)
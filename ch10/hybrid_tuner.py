@@ -0,0 +1,281 @@
+"""
+Offline tuner for the hybrid search normalization and weights.
+
+approximate_hnsw.hybrid_pipeline_definition fixes min_max normalization and an
+arithmetic mean with weights [0.4, 0.6]. Trying other settings against the
+cluster takes one hybrid query per query per grid point. This tuner queries
+the cluster only once per query:
+
+    1. It runs each query's lexical (match on title) and vector (knn)
+       sub-queries once, each for the top --window results, and caches the
+       raw scored lists in a local JSON file.
+    2. It fuses the cached lists locally for every technique (min_max, l2,
+       rrf) and lexical weight in the grid. For each query, the normalized
+       scores of the two lists are a 2 x N matrix, so every weight in the grid
+       is one matrix product.
+    3. It scores each fused ranking against a judgment file with nDCG@k and
+       recall@k, and prints the best settings and the pipeline definition that
+       applies them.
+
+The judgment file is in TREC qrels format, one judgment per line:
+
+    <query id> 0 <movie id> <grade>
+
+Query ids are the ids from the queries file (see batch_search.py), line numbers
+for plain text queries. Documents are identified by the movie id field, so the
+judgments stay valid when the index is rebuilt.
+
+Fusing a truncated list is an approximation: the cluster normalizes over the
+sub-query results it gathers, which for a hybrid query is also a top-k window.
+Use a --window at least as large as the k you serve.
+
+Usage:
+    python hybrid_tuner.py --queries-file queries.txt --judgments qrels.txt
+    python hybrid_tuner.py --queries-file queries.txt --judgments qrels.txt \\
+        --window 100 --k 10 --weight-step 0.05
+"""
+
+
+import approximate_hnsw
+import argparse
+import batch_search
+import bench_utils
+import hashlib
+import hybrid_search
+import json
+import logging
+import numpy as np
+from opensearchpy import OpenSearch
+import os
+from os_client_factory import OSClientFactory
+import vector_cache
+
+
+DEFAULT_WINDOW = 50
+DEFAULT_WEIGHT_STEP = 0.1
+SUB_QUERIES = ['lexical', 'vector']
+
+
+def read_judgments(judgments_file):
+  '''Reads TREC qrels into {query id: {movie id: grade}}.'''
+  judgments = {}
+  with open(judgments_file, 'r') as f:
+    for line in f:
+      parts = line.split()
+      if len(parts) != 4:
+        continue
+      query_id, _, doc_id, grade = parts
+      judgments.setdefault(query_id, {})[int(doc_id)] = float(grade)
+  return judgments
+
+
+def _sub_query_bodies(text, vector, window):
+  lexical = {"size": window, "_source": False, "docvalue_fields": ["id"],
+             "query": {"match": {"title": {"query": text}}}}
+  vector_body = dict(approximate_hnsw.simple_ann_query.build(vector=vector,
+                                                             k=window),
+                     size=window, _source=False, docvalue_fields=["id"])
+  return [lexical, vector_body]
+
+
+def sub_query_results(os_client: OpenSearch, index_name, queries, window,
+                      cache_path=None, refresh=False):
+  '''Runs each query's lexical and vector sub-queries once, and returns
+  {query id: {"lexical": [[movie id, score], ...], "vector": [...]}}. The
+  results are cached in cache_path, named from the index, window and queries
+  by default.'''
+  texts = [query['query'] for query in queries]
+  if cache_path is None:
+    key = '\n'.join([index_name, str(window)] + texts)
+    cache_path = f"hybrid_results_{hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]}.json"
+  if os.path.exists(cache_path) and not refresh:
+    logging.info(f"Loading sub-query results from {cache_path}")
+    with open(cache_path, 'r') as f:
+      return json.load(f)
+
+  query_matrix = vector_cache.query_vectors(os_client, texts)
+  bodies = []
+  for text, vector in zip(texts, query_matrix.tolist()):
+    bodies.extend(_sub_query_bodies(text, vector, window))
+  responses = list(batch_search.msearch(os_client, index_name, bodies))
+  results = {}
+  for position, query in enumerate(queries):
+    results[query['id']] = {}
+    for offset, name in enumerate(SUB_QUERIES):
+      response = responses[2 * position + offset]
+      if 'error' in response:
+        raise RuntimeError(f"{name} query for {query['id']} failed: "
+                           f"{response['error']}")
+      results[query['id']][name] = [[hit['fields']['id'][0], hit['_score']]
+                                    for hit in response['hits']['hits']]
+  with open(cache_path, 'w') as f:
+    json.dump(results, f)
+  logging.info(f"Cached sub-query results in {cache_path}")
+  return results
+
+
+def features(result_lists, technique, rank_constant=hybrid_search.RRF_RANK_CONSTANT):
+  '''Returns (doc ids, matrix) for one query. The matrix has one row per
+  sub-query and one column per document in either list, holding the
+  document's normalized score (or RRF term) in that list, 0 if it's missing.
+  A weighted fusion is then weights @ matrix.'''
+  doc_ids = sorted({doc_id for results in result_lists for doc_id, _ in results})
+  column = {doc_id: position for position, doc_id in enumerate(doc_ids)}
+  matrix = np.zeros((len(result_lists), len(doc_ids)), dtype=np.float64)
+  for row, results in enumerate(result_lists):
+    if technique == 'rrf':
+      values = [1.0 / (rank_constant + rank) for rank in range(1, len(results) + 1)]
+    else:
+      values = hybrid_search.normalize([score for _, score in results], technique)
+    for (doc_id, _), value in zip(results, values):
+      matrix[row, column[doc_id]] = value
+  return np.array(doc_ids, dtype=np.int64), matrix
+
+
+def _ideal_dcg(grades, discounts):
+  ideal = sorted(grades, reverse=True)[:len(discounts)]
+  return sum((2 ** grade - 1) * discounts[rank] for rank, grade in enumerate(ideal))
+
+
+def evaluate_grid(results, judgments, techniques, lexical_weights, k=10,
+                  rank_constant=hybrid_search.RRF_RANK_CONSTANT,
+                  equal_rrf_weights=False):
+  '''Fuses the cached results for every technique and lexical weight, and
+  returns one row per combination with mean nDCG@k and recall@k over the
+  judged queries. With equal_rrf_weights, RRF is scored at equal weights
+  only, for clusters whose score-ranker-processor doesn't take weights.'''
+  grid_weights = np.stack([lexical_weights, 1.0 - np.asarray(lexical_weights)],
+                          axis=1)
+  discounts = 1.0 / np.log2(np.arange(k) + 2)
+  judged = [query_id for query_id in results if judgments.get(query_id)]
+  rows = []
+  for technique in techniques:
+    weights = grid_weights
+    if technique == 'rrf' and equal_rrf_weights:
+      weights = np.array([[0.5, 0.5]])
+    ndcg = np.zeros(len(weights))
+    recall = np.zeros(len(weights))
+    for query_id in judged:
+      query_judgments = judgments[query_id]
+      doc_ids, matrix = features([results[query_id][name] for name in SUB_QUERIES],
+                                 technique, rank_constant)
+      if not len(doc_ids):
+        continue
+      # One fused score row per weight setting
+      fused = weights @ matrix
+      depth = min(k, len(doc_ids))
+      top = np.argsort(-fused, axis=1, kind='stable')[:, :depth]
+      grades = np.array([query_judgments.get(int(doc_id), 0.0) for doc_id in doc_ids])
+      top_grades = grades[top]
+      ideal = _ideal_dcg(list(query_judgments.values()), discounts)
+      if ideal:
+        ndcg += ((2 ** top_grades - 1) * discounts[:depth]).sum(axis=1) / ideal
+      relevant = sum(1 for grade in query_judgments.values() if grade > 0)
+      if relevant:
+        recall += (top_grades > 0).sum(axis=1) / min(k, relevant)
+    for position, (lexical_weight, vector_weight) in enumerate(weights):
+      rows.append({"technique": technique,
+                   "lexical_weight": round(float(lexical_weight), 4),
+                   "vector_weight": round(float(vector_weight), 4),
+                   "ndcg": float(ndcg[position] / len(judged)) if judged else None,
+                   "recall": float(recall[position] / len(judged)) if judged else None})
+  return rows
+
+
+def pipeline_definition(row):
+  '''The search pipeline definition that applies a tuned row. The grid
+  scores RRF with hybrid_search.fuse's weighted RRF, so the definition carries
+  the weights too. Older versions of the score-ranker-processor reject RRF
+  weights; for those, tune with --equal-rrf-weights.'''
+  if row['technique'] == 'rrf':
+    combination = {"technique": "rrf",
+                   "rank_constant": hybrid_search.RRF_RANK_CONSTANT}
+    # Equal weights are RRF's default, and need no parameters
+    if not np.isclose(row['lexical_weight'], row['vector_weight']):
+      combination['parameters'] = {"weights": [row['lexical_weight'],
+                                               row['vector_weight']]}
+    return {"phase_results_processors": [{"score-ranker-processor": {
+      "combination": combination}}]}
+  return {"phase_results_processors": [{"normalization-processor": {
+    "normalization": {"technique": row['technique']},
+    "combination": {"technique": "arithmetic_mean",
+                    "parameters": {"weights": [row['lexical_weight'],
+                                               row['vector_weight']]}}}}]}
+
+
+def main(queries_file, judgments_file, window=DEFAULT_WINDOW, k=10,
+         techniques=hybrid_search.TECHNIQUES, weight_step=DEFAULT_WEIGHT_STEP,
+         refresh_cache=False, top=10, equal_rrf_weights=False,
+         output_path=None):
+  os_client = OSClientFactory().client()
+  queries = batch_search.read_queries(queries_file)
+  judgments = read_judgments(judgments_file)
+  results = sub_query_results(os_client, approximate_hnsw.INDEX_NAME, queries,
+                              max(window, k), refresh=refresh_cache)
+  lexical_weights = np.round(np.arange(0.0, 1.0 + weight_step / 2, weight_step), 4)
+  rows = evaluate_grid(results, judgments, techniques, lexical_weights, k,
+                       equal_rrf_weights=equal_rrf_weights)
+  logging.info(f"Scored {len(rows)} combinations on "
+               f"{sum(1 for query_id in results if judgments.get(query_id))} "
+               "judged queries")
+
+  columns = ['technique', 'lexical_weight', 'vector_weight', 'ndcg', 'recall']
+  ranked = sorted(rows, key=lambda row: row['ndcg'] or 0.0, reverse=True)
+  print(f"\nTop {top} by nDCG@{k}")
+  print(bench_utils.format_table(ranked[:top], columns))
+  current = [row for row in rows
+             if row['technique'] == hybrid_search.DEFAULT_TECHNIQUE
+             and np.isclose(row['lexical_weight'], hybrid_search.DEFAULT_WEIGHTS[0])]
+  if current:
+    print("\nCurrent pipeline setting")
+    print(bench_utils.format_table(current, columns))
+  best = ranked[0] if ranked else None
+  if best:
+    print("\nPipeline definition for the best setting")
+    print(json.dumps(pipeline_definition(best), indent=2))
+  if output_path:
+    bench_utils.write_json(output_path, {"k": k, "window": window, "rows": rows,
+                                         "best": best})
+  return rows, best
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Tunes hybrid search normalization and weights offline, by "
+      "re-fusing cached lexical and vector results and scoring them against "
+      "relevance judgments.",
+  )
+  parser.add_argument("--queries-file", required=True, action="store")
+  parser.add_argument("--judgments", required=True, action="store",
+                      help="TREC qrels file: query_id 0 movie_id grade")
+  parser.add_argument("--window", default=DEFAULT_WINDOW, type=int,
+                      help="Results to fetch from each sub-query")
+  parser.add_argument("--k", default=10, type=int)
+  parser.add_argument("--techniques", nargs='+', default=hybrid_search.TECHNIQUES,
+                      choices=hybrid_search.TECHNIQUES)
+  parser.add_argument("--weight-step", default=DEFAULT_WEIGHT_STEP, type=float)
+  parser.add_argument("--refresh-cache", default=False, action="store_true",
+                      help="Query the cluster again instead of using the cache")
+  parser.add_argument("--top", default=10, type=int)
+  parser.add_argument("--equal-rrf-weights", default=False, action="store_true",
+                      help="Score RRF at equal weights only, for clusters "
+                      "whose score-ranker-processor takes no weights")
+  parser.add_argument("--output", default=None, action="store")
+  args = parser.parse_args()
+  main(queries_file=args.queries_file,
+       judgments_file=args.judgments,
+       window=args.window,
+       k=args.k,
+       techniques=args.techniques,
+       weight_step=args.weight_step,
+       refresh_cache=args.refresh_cache,
+       top=args.top,
+       equal_rrf_weights=args.equal_rrf_weights,
+       output_path=args.output)
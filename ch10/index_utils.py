@@ -16,13 +16,27 @@ processors.
 
 Functions:
     delete_then_create_index(os_client, index_name, pipeline_name,
-    additional_fields):
+    additional_fields, additional_settings):
         Deletes an existing index if present and creates a new one with the
         specified configuration
+    ensure_search_pipeline(os_client, pipeline_name, definition):
+        Creates or updates a search pipeline, unless the cluster already has
+        the same version
+    create_next_version(os_client, alias_name, ...): Creates the next
+        versioned index behind an alias
+    publish_version(os_client, alias_name, index_name, retain): Warms the
+        new version, swaps the alias to it and deletes old versions
+    version_model_name(model_name, index_name): The k-NN model name for a
+        version built on a trained model
+    delete_retired_models(os_client, alias_name, model_name): Deletes the
+        trained models no version uses any more
+    swap_alias(os_client, alias_name, index_name): Atomic alias swap
+    delete_versions(os_client, alias_name): Deletes every version
 
 Constants:
     BASE_SETTINGS: Dictionary containing the base mapping configuration for
     movie data
+    RETAINED_VERSIONS: Versions publish_version keeps by default
 
 Warning!
     The delete_then_create_index function will delete any existing index with
@@ -32,6 +46,8 @@ Warning!
 
 from copy import deepcopy
 import logging
+import opensearchpy.exceptions
+import re
 
 
 # The base mapping doesn't contain a knn field, or an embedding source field.
@@ -78,24 +94,201 @@ BASE_SETTINGS = {
     }}}
 
 
+def _index_body(ingest_pipeline_name=None, search_pipeline_name=None,
+                additional_fields=None, additional_settings=None):
+  settings = deepcopy(BASE_SETTINGS)
+  settings['settings']['default_pipeline'] = ingest_pipeline_name
+  if search_pipeline_name:
+    settings['settings']['search.default_pipeline'] = search_pipeline_name
+  if additional_fields:
+    settings['mappings']['properties'].update(additional_fields)
+  if additional_settings:
+    settings['settings'].update(additional_settings)
+  return settings
+
+
 def delete_then_create_index(os_client, 
                              index_name=None,
                              ingest_pipeline_name=None,
                              search_pipeline_name=None,
-                             additional_fields=None):
+                             additional_fields=None,
+                             additional_settings=None):
   # Delete the existing index
   if os_client.indices.exists(index_name):
     logging.info(f'Deleting existing index {index_name}')
     os_client.indices.delete(index_name)
 
   # Construct settings
-  settings = deepcopy(BASE_SETTINGS)
-  settings['settings']['default_pipeline'] = ingest_pipeline_name
-  if search_pipeline_name:
-    settings['settings']['search.default_pipeline'] = search_pipeline_name
-  if additional_fields:
-    settings['mappings']['properties'].update(additional_fields)
+  settings = _index_body(ingest_pipeline_name, search_pipeline_name,
+                         additional_fields, additional_settings)
 
   # Create the new index
   logging.info(f'Creating index {index_name}')
   os_client.indices.create(index_name, body=settings)
+
+
+# Versioned builds. Instead of deleting the live index and re-ingesting into a
+# new one with the same name, which fails every query until the ingest is
+# done, the example scripts build a new version, <alias>_v<N>, next to the
+# live one and point the alias at it once it's loaded and warm. Queries go to
+# the alias, so they always see a complete index. The swap is a single
+# _aliases call, so it's atomic. An index from before versioned builds, with
+# the alias's name, is removed in the same call.
+#
+#   index_name = create_next_version(os_client, 'movies', ...)
+#   ... bulk load index_name ...
+#   publish_version(os_client, 'movies', index_name)
+#
+# publish_version keeps the last RETAINED_VERSIONS versions (--retain on the
+# example scripts), so you can point the alias back at the previous one with
+# swap_alias.
+RETAINED_VERSIONS = 2
+
+
+# Returns [(version, index name)] for the alias's versions, oldest first.
+def index_versions(os_client, alias_name):
+  pattern = re.compile(rf'^{re.escape(alias_name)}_v(\d+)$')
+  indices = os_client.indices.get(index=f'{alias_name}_v*')
+  return sorted((int(match.group(1)), name) for name in indices
+                for match in [pattern.match(name)] if match)
+
+
+# The concrete indices the alias points to.
+def alias_targets(os_client, alias_name):
+  if not os_client.indices.exists_alias(name=alias_name):
+    return []
+  return list(os_client.indices.get_alias(name=alias_name))
+
+
+# The name create_next_version will give the alias's next version. Scripts
+# that need something built for the version first, like a trained k-NN model,
+# name it after this.
+def next_version_name(os_client, alias_name):
+  versions = index_versions(os_client, alias_name)
+  return f'{alias_name}_v{versions[-1][0] + 1 if versions else 1}'
+
+
+# Creates the next version of the alias's index, with the same arguments as
+# delete_then_create_index, and returns its name.
+def create_next_version(os_client, alias_name, ingest_pipeline_name=None,
+                        search_pipeline_name=None, additional_fields=None,
+                        additional_settings=None):
+  index_name = next_version_name(os_client, alias_name)
+  logging.info(f'Creating index {index_name} for alias {alias_name}')
+  os_client.indices.create(index_name, body=_index_body(
+    ingest_pipeline_name, search_pipeline_name, additional_fields,
+    additional_settings))
+  return index_name
+
+
+# Makes a freshly loaded index searchable and loads its k-NN graphs into
+# native memory, so the first queries after the swap don't pay for it.
+def warm_index(os_client, index_name):
+  os_client.indices.refresh(index=index_name)
+  settings = os_client.indices.get_settings(index=index_name, name='index.knn',
+                                            flat_settings=True)
+  if settings[index_name]['settings'].get('index.knn') == 'true':
+    logging.info(f'Warming up k-NN graphs for {index_name}')
+    os_client.transport.perform_request('GET', f'/_plugins/_knn/warmup/{index_name}')
+
+
+# Atomically points the alias at index_name, and only at index_name.
+def swap_alias(os_client, alias_name, index_name):
+  actions = [{"remove": {"index": target, "alias": alias_name}}
+             for target in alias_targets(os_client, alias_name)
+             if target != index_name]
+  if os_client.indices.exists(index=alias_name) and \
+     not os_client.indices.exists_alias(name=alias_name):
+    logging.info(f'Replacing index {alias_name} with an alias')
+    actions.append({"remove_index": {"index": alias_name}})
+  actions.append({"add": {"index": index_name, "alias": alias_name}})
+  os_client.indices.update_aliases(body={"actions": actions})
+  logging.info(f'Alias {alias_name} now points to {index_name}')
+
+
+# Warms index_name, points the alias at it, and deletes the versions older
+# than the last retain versions. The alias's target is never deleted. Returns
+# the names of the deleted versions.
+def publish_version(os_client, alias_name, index_name, retain=RETAINED_VERSIONS):
+  warm_index(os_client, index_name)
+  swap_alias(os_client, alias_name, index_name)
+  versions = [name for _, name in index_versions(os_client, alias_name)]
+  deleted = []
+  for name in versions[:-max(retain, 1)]:
+    if name != index_name:
+      logging.info(f'Deleting old version {name}')
+      os_client.indices.delete(index=name)
+      deleted.append(name)
+  return deleted
+
+
+# Indices built on a trained k-NN model (IVF, PQ) can't outlive it, so each
+# version gets its own model, <model_name>_v<N> for <alias>_v<N>. Retraining
+# for a new version then leaves the live version's model alone.
+def version_model_name(model_name, index_name):
+  return f"{model_name}_v{index_name.rsplit('_v', 1)[1]}"
+
+
+# Deletes the k-NN models named model_name or model_name_v<N> that no version
+# of the alias, and no index with the alias's name, uses any more. Call it
+# after publish_version, to delete the models of the retired versions.
+def delete_retired_models(os_client, alias_name, model_name):
+  pattern = re.compile(rf'^{re.escape(model_name)}(_v\d+)?$')
+  try:
+    response = os_client.transport.perform_request(
+      'POST', '/_plugins/_knn/models/_search',
+      body={"size": 1000, "_source": False, "query": {"match_all": {}}})
+  except opensearchpy.exceptions.NotFoundError:
+    # No model has been trained on the cluster
+    return
+  models = [hit['_id'] for hit in response['hits']['hits']
+            if pattern.match(hit['_id'])]
+  indices = [name for _, name in index_versions(os_client, alias_name)]
+  if os_client.indices.exists(index=alias_name) and \
+     not os_client.indices.exists_alias(name=alias_name):
+    indices.append(alias_name)
+  used = set()
+  for mapping in (os_client.indices.get_mapping(index=','.join(indices)).values()
+                  if indices else []):
+    for field in mapping['mappings'].get('properties', {}).values():
+      if 'model_id' in field:
+        used.add(field['model_id'])
+  for model in models:
+    if model not in used:
+      logging.info(f'Deleting k-NN model {model}, no version of {alias_name} uses it')
+      os_client.transport.perform_request('DELETE', f'/_plugins/_knn/models/{model}')
+
+
+# Deletes every version of the alias's index, and an index with the alias's
+# name from before versioned builds. Use this where an index must go away
+# entirely, e.g. before deleting the model it was built with. Indices can't
+# be deleted through an alias.
+def delete_versions(os_client, alias_name):
+  if os_client.indices.exists(index=alias_name) and \
+     not os_client.indices.exists_alias(name=alias_name):
+    logging.info(f'Deleting index {alias_name}')
+    os_client.indices.delete(index=alias_name)
+  for _, name in index_versions(os_client, alias_name):
+    logging.info(f'Deleting index {name}')
+    os_client.indices.delete(index=name)
+
+
+# Search pipelines only need to be created once. Creates or replaces
+# pipeline_name when it's missing or when the stored version differs from
+# definition's "version", and otherwise leaves it alone. Bump the version in
+# the definition when you change it. Returns True if it wrote the pipeline.
+def ensure_search_pipeline(os_client, pipeline_name, definition):
+  try:
+    existing = os_client.transport.perform_request(
+      'GET', f'/_search/pipeline/{pipeline_name}')
+    existing_version = existing.get(pipeline_name, {}).get('version')
+  except opensearchpy.exceptions.NotFoundError:
+    existing_version = None
+  if existing_version is not None and existing_version == definition.get('version'):
+    logging.info(f'Search pipeline {pipeline_name} is at version {existing_version}')
+    return False
+  logging.info(f'Putting search pipeline {pipeline_name} version '
+               f'{definition.get("version")}')
+  os_client.transport.perform_request(
+    'PUT', f'/_search/pipeline/{pipeline_name}', body=definition)
+  return True
@@ -4,13 +4,13 @@ in OpenSearch.
 
 This module handles the training process for IVF-PQ approximate k-NN search,
 which requires a separate training step before creating the search index. It
-loads sample movie data, generates vector embeddings, and trains the IVF-PQ
+samples movie data, generates vector embeddings, and trains the IVF-PQ
 model using those embeddings.
 
 Key Features:
     - Creates a training index for vector data
-    - Sets up an ingest pipeline for embedding generation
-    - Indexes a subset of documents for training (10% of total documents)
+    - Embeds the sample with batched _predict calls, cached locally
+    - Indexes a uniform random sample (10% of total documents) for training
     - Trains an IVF-PQ model with specified parameters
     - Monitors training completion status
 
@@ -21,34 +21,30 @@ Note:
       use
 """
 from copy import deepcopy
-import index_utils
 import logging
 import movie_source
 from opensearchpy import OpenSearch
 import opensearchpy.helpers
 import time
+import vector_cache
 
 
 # We recommend 10% of the total documents for training.
 MOVIES_TO_TRAIN = int(movie_source.TOTAL_MOVIES * .10)
 DOCS_PER_BULK = MOVIES_TO_TRAIN // 10
-TOTAL_NUMBER_OF_BULKS = int(MOVIES_TO_TRAIN / DOCS_PER_BULK)
 
 
 # Defines the training index name. The script loads raw vector data into this
 # index and calls the train API to prepare for creating the IVF PQ index
 TRAINING_INDEX_NAME = 'ivf_pq_training'
 TRAINING_MODEL_NAME = 'ivf_pq_model'
-TRAINING_SOURCE_FIELD_NAME = 'embedding_source'
 TRAINING_DEST_FIELD_NAME = 'embedding'
-TRAINING_PIPELINE_NAME = 'ivf_pq_pipeline'
-from approximate_ivf_pq import INDEX_NAME as DESTINATION_INDEX_NAME
 
 
-# Defines the index mapping for training data with basic movie metadata fields.
-# Note: This mapping deliberately excludes knn:true setting in the index settings
-# since you use raw vector data for training the IVF model.
-# The embedding vector field is added dynamically during index creation
+# Defines the index mapping for the training index. It holds only the vector
+# field, since training reads nothing else. Note: This mapping deliberately
+# excludes knn:true setting in the index settings since you use raw vector data
+# for training the model. The dimension is set during index creation.
 TRAINING_INDEX_MAPPING = {
     "settings": {
       "number_of_shards": 1,
@@ -57,44 +53,8 @@ TRAINING_INDEX_MAPPING = {
     },
     "mappings": {
       "properties": {
-        "id": {"type": "integer"},
-        "title": {"type": "text"},
-        "year": {"type": "integer"},
-        "duration": {"type": "integer"},
-        "genres": {"type": "text",
-                   "fields": {
-                    "keyword": {"type": "keyword", "ignore_above": 256}
-                   }},
-        "plot": {"type": "text"},
-        "rating": {"type": "float"},
-        "vote": {"type": "integer"},
-        "revenue": {"type": "float"},
-        "thumbnail": {"type": "keyword"},
-        "directors": {"type": "text",
-                      "fields": {
-                        "keyword": {"type": "keyword", "ignore_above": 256}
-                   }},
-        "actors": {"type": "text",
-                   "fields": {
-                    "keyword": {"type": "keyword", "ignore_above": 256}
-}}}}}
-
-
-# Ingest pipeline that the code uses to create the vector embeddings it loads
-# into the training index
-training_ingest_pipeline_definition = {
-  "description": "Embedding pipeline for training data",
-  "processors": [
-    {
-      "text_embedding": {
-        "model_id": "",
-        "field_map": {
-          TRAINING_SOURCE_FIELD_NAME: TRAINING_DEST_FIELD_NAME
-        }
-      }
-    }
-  ]
-}
+        TRAINING_DEST_FIELD_NAME: {"type": "knn_vector", "dimension": 0}
+}}}
 
 
 # The request body for the train API call. This body specifies the engine and
@@ -121,10 +81,10 @@ TRAINING_REQUEST_BODY = {
 # Returns:
 #     str or None: Current state of the model if it exists, None if the model
 #                 is not found
-def _get_model_state(os_client):
+def _get_model_state(os_client, model_name=TRAINING_MODEL_NAME):
   try:
     model_response = os_client.transport.perform_request(
-      'GET', f'/_plugins/_knn/models/{TRAINING_MODEL_NAME}?filter_path=state&pretty',
+      'GET', f'/_plugins/_knn/models/{model_name}?filter_path=state&pretty',
     )
     return model_response['state']
   except opensearchpy.exceptions.NotFoundError as e:
@@ -135,70 +95,74 @@ def _get_model_state(os_client):
 # function continuously monitors the training progress by checking the model
 # state at regular intervals. It will wait until the model leaves the training
 # state
-def _wait_for_training_completion(os_client, model_id, model_dimensions):
-  logging.info(f"Waiting for training to complete for model {TRAINING_MODEL_NAME}")
-  state = _get_model_state(os_client)
+def _wait_for_training_completion(os_client, model_id, model_dimensions,
+                                 model_name=TRAINING_MODEL_NAME):
+  logging.info(f"Waiting for training to complete for model {model_name}")
+  state = _get_model_state(os_client, model_name)
   while state and state == "training":
-    state = _get_model_state(os_client)
+    state = _get_model_state(os_client, model_name)
     time.sleep(1)
 
 
 # Main entry point. Call train to do the PQ training on 10% of the source data,
 # preparing for indexing the full corpus.
-def train(os_client: OpenSearch, embedding_model_id, model_dimensions, skip_if_exists=True):
+def train(os_client: OpenSearch, embedding_model_id, model_dimensions,
+          skip_if_exists=True, model_name=TRAINING_MODEL_NAME):
 
   # If the model already exists, and skip_if_exists is true, then don't create a
-  # new model. Otherwise, delete the existing model.
-  state = _get_model_state(os_client)
+  # new model. Otherwise, delete the existing model. The example scripts train
+  # a new model for each index version (see index_utils.version_model_name),
+  # so the model deleted here is never the one the live version uses.
+  state = _get_model_state(os_client, model_name)
   if state and state == 'created':
-    logging.info(f"Model {TRAINING_MODEL_NAME} already exists.")
+    logging.info(f"Model {model_name} already exists.")
     if skip_if_exists:
-      logging.info(f"Skipping training for {TRAINING_MODEL_NAME}")
-      return
+      logging.info(f"Skipping training for {model_name}")
+      return model_name
     else:
-      logging.info(f"Deleting model {TRAINING_MODEL_NAME}")
-      if os_client.indices.exists(index=DESTINATION_INDEX_NAME):
-        logging.info(f"Index {DESTINATION_INDEX_NAME} is using the model, deleting that index")
-        os_client.indices.delete(index=DESTINATION_INDEX_NAME)
+      logging.info(f"Deleting model {model_name}")
       os_client.transport.perform_request(
-        'DELETE', f'/_plugins/_knn/models/{TRAINING_MODEL_NAME}'
+        'DELETE', f'/_plugins/_knn/models/{model_name}'
       )
 
-  # Create an ingest pipeline
-  logging.info(f"Creating ingest pipeline {TRAINING_PIPELINE_NAME}")
-  pipeline_definition = deepcopy(training_ingest_pipeline_definition)
-  pipeline_definition['processors'][0]['text_embedding']['model_id'] = embedding_model_id
-  os_client.ingest.put_pipeline(id=TRAINING_PIPELINE_NAME, body=pipeline_definition)
+  # Sample the training documents uniformly from the whole file. Taking the
+  # first documents would train the centroids on whatever part of the corpus
+  # happens to come first.
+  logging.info(f"Sampling {MOVIES_TO_TRAIN} movies for training")
+  training_movies = movie_source.sample_movies(MOVIES_TO_TRAIN)
+
+  # Embed the sample with batched _predict calls. The embeddings are cached
+  # locally by movie id, so retraining doesn't run the model again.
+  vectors = vector_cache.movie_embeddings(os_client, embedding_model_id, training_movies)
 
-  # Create the training index
+  # Create the training index. The vectors are already computed, so it needs
+  # no ingest pipeline, and no fields other than the vector.
   logging.info(f"Creating training index {TRAINING_INDEX_NAME}")
-  index_utils.delete_then_create_index(os_client=os_client,
-                                        index_name=TRAINING_INDEX_NAME,
-                                        ingest_pipeline_name=TRAINING_PIPELINE_NAME,
-                                        additional_fields={
-                                          TRAINING_DEST_FIELD_NAME: {
-                                            "type": "knn_vector",
-                                            "dimension": model_dimensions
-                                        }})
-
-  # Index documents to the training index.
-  logging.info(f"Indexing documents for training")
-  bulks_sent = 0
-  for bulk in movie_source.bulks(DOCS_PER_BULK, TRAINING_INDEX_NAME):
-    logging.info(f"Indexing bulk {bulks_sent + 1} / {TOTAL_NUMBER_OF_BULKS}")
-    opensearchpy.helpers.bulk(os_client, bulk, timeout=600, max_retries=10)
-    bulks_sent += 1
-    if bulks_sent >= TOTAL_NUMBER_OF_BULKS:
-      break
+  if os_client.indices.exists(index=TRAINING_INDEX_NAME):
+    os_client.indices.delete(index=TRAINING_INDEX_NAME)
+  training_index_mapping = deepcopy(TRAINING_INDEX_MAPPING)
+  training_index_mapping['mappings']['properties'][TRAINING_DEST_FIELD_NAME]['dimension'] = model_dimensions
+  os_client.indices.create(index=TRAINING_INDEX_NAME, body=training_index_mapping)
+
+  # Index the vectors to the training index.
+  logging.info(f"Indexing {len(vectors)} vectors for training")
+  opensearchpy.helpers.bulk(
+    os_client,
+    ({"_op_type": "index", "_index": TRAINING_INDEX_NAME,
+      "_source": {TRAINING_DEST_FIELD_NAME: vector.tolist()}}
+     for vector in vectors),
+    chunk_size=DOCS_PER_BULK, timeout=600, max_retries=10)
+  os_client.indices.refresh(index=TRAINING_INDEX_NAME)
 
   # Train the model
-  logging.info(f"Sending train request for {TRAINING_MODEL_NAME}")
+  logging.info(f"Sending train request for {model_name}")
   training_request_body = deepcopy(TRAINING_REQUEST_BODY)
   training_request_body['dimension'] = model_dimensions
   os_client.transport.perform_request(
-    'POST', f'/_plugins/_knn/models/{TRAINING_MODEL_NAME}/_train',
+    'POST', f'/_plugins/_knn/models/{model_name}/_train',
     body=training_request_body
   )
-  logging.info(f"Waiting for training to complete for model {TRAINING_MODEL_NAME}")
-  _wait_for_training_completion(os_client, embedding_model_id, model_dimensions)
-  return TRAINING_MODEL_NAME
+  logging.info(f"Waiting for training to complete for model {model_name}")
+  _wait_for_training_completion(os_client, embedding_model_id, model_dimensions,
+                                model_name)
+  return model_name
@@ -0,0 +1,232 @@
+"""
+IVF and IVF-PQ tuning for the ch10 movies vectors.
+
+ivf_training.py trains with nlist=4 and nprobes=2 regardless of corpus size,
+so every query scans about half of the corpus. ivf_pq_training.py fixes the
+PQ encoder at m=8, code_size=8. This tool derives the IVF parameters from the
+data instead:
+
+    - Candidate nlist values are multiples of sqrt(N), where N is the corpus
+      size. sqrt(N) lists of sqrt(N) vectors each balance the cost of
+      comparing the query with the centroids against the cost of scanning the
+      lists.
+    - Each candidate gets a training sample sized to match: at least
+      MIN_POINTS_PER_CENTROID vectors per list (Faiss warns below 39), and
+      enough for the PQ codebooks when you tune PQ, drawn uniformly at random
+      from the whole corpus.
+    - For each trained model it builds an index from the cached corpus vectors
+      and measures recall@k and latency across nprobes values (a query-time
+      method parameter) and native memory.
+
+Finally it recommends the configuration with the best recall that fits under
+--memory-budget-mb and, if you set --min-recall, the fastest one that reaches
+that recall within the budget.
+
+Usage:
+    python ivf_tuning.py --queries-file queries.txt
+    python ivf_tuning.py --queries-file queries.txt --pq-m 8 16 32 \\
+        --pq-code-size 8 --memory-budget-mb 64 --min-recall 0.9
+"""
+
+
+import argparse
+import batch_search
+import bench_utils
+import logging
+import math
+import numpy as np
+from os_client_factory import OSClientFactory
+import recall_benchmark
+import vector_cache
+import vector_index_builder
+
+
+INDEX_PREFIX = 'ivf_tuning'
+TRAINING_INDEX_NAME = 'ivf_tuning_training'
+SPACE_TYPE = 'l2'
+NLIST_MULTIPLIERS = [1, 2, 4, 8]
+DEFAULT_NPROBES = [1, 2, 4, 8, 16, 32, 64]
+# Faiss k-means wants at least 39 training points per centroid, and gains
+# little beyond 256.
+MIN_POINTS_PER_CENTROID = 39
+POINTS_PER_CENTROID = 100
+
+
+def candidate_nlists(n_vectors, multipliers=NLIST_MULTIPLIERS):
+  '''nlist candidates around sqrt(n_vectors). Candidates that would leave
+  fewer than MIN_POINTS_PER_CENTROID vectors per list are dropped.'''
+  root = math.sqrt(n_vectors)
+  candidates = sorted({max(1, int(round(root * multiplier)))
+                       for multiplier in multipliers})
+  return [nlist for nlist in candidates
+          if nlist * MIN_POINTS_PER_CENTROID <= n_vectors]
+
+
+def training_sample_size(n_vectors, nlist, pq_code_size=None):
+  '''The number of vectors to train a model with nlist lists on. PQ codebooks
+  have 2^code_size centroids per sub-vector, which need training points too.'''
+  size = nlist * POINTS_PER_CENTROID
+  if pq_code_size:
+    size = max(size, (2 ** pq_code_size) * POINTS_PER_CENTROID)
+  return min(n_vectors, max(size, nlist * MIN_POINTS_PER_CENTROID))
+
+
+def ivf_method(nlist, pq_m=None, pq_code_size=None):
+  '''The method definition for the _train API.'''
+  parameters = {"nlist": nlist}
+  if pq_m:
+    parameters['encoder'] = {"name": "pq",
+                             "parameters": {"m": pq_m, "code_size": pq_code_size}}
+  return {"name": "ivf", "engine": "faiss", "parameters": parameters}
+
+
+def recommend(rows, memory_budget_mb=None, min_recall=None):
+  '''Picks the configuration to use. Within the memory budget, returns the
+  lowest p99 latency row that reaches min_recall if you set it, otherwise the
+  highest recall row. Returns None if nothing fits.'''
+  candidates = [row for row in rows
+                if memory_budget_mb is None or row['memory_mb'] <= memory_budget_mb]
+  if min_recall is not None:
+    passing = [row for row in candidates if row['recall'] >= min_recall]
+    if passing:
+      return min(passing, key=lambda row: (row['latency_p99'], row['memory_mb']))
+    logging.warning(f"No configuration reaches recall {min_recall} within the "
+                    "budget, recommending the highest recall instead")
+  if not candidates:
+    return None
+  return max(candidates, key=lambda row: (row['recall'], -row['latency_p99']))
+
+
+def train_ivf_model(os_client, model_name, corpus_ids, corpus, nlist, pq_m=None,
+                    pq_code_size=None, rng=None, training_index=TRAINING_INDEX_NAME):
+  '''Loads a random training sample sized for nlist (and the PQ code size)
+  into training_index and trains model_name on it. Returns (sample_size,
+  train_seconds).'''
+  rng = rng or np.random.default_rng()
+  n_vectors, dimension = corpus.shape
+  sample_size = training_sample_size(n_vectors, nlist, pq_code_size)
+  sample = rng.choice(n_vectors, size=sample_size, replace=False)
+  vector_index_builder.build_index(
+    os_client, training_index,
+    {vector_index_builder.FIELD_NAME: {"type": "knn_vector",
+                                       "dimension": dimension}},
+    corpus_ids[sample], corpus[sample], force_merge=False)
+  logging.info(f"Training {model_name} on {sample_size} vectors")
+  train_seconds = vector_index_builder.train_knn_model(
+    os_client, model_name, training_index, dimension,
+    ivf_method(nlist, pq_m, pq_code_size), space_type=SPACE_TYPE)
+  return sample_size, train_seconds
+
+
+def main(queries_file, nlists=None, nprobes=DEFAULT_NPROBES, pq_ms=(),
+         pq_code_sizes=(8,), k=10, memory_budget_mb=None, min_recall=None,
+         source_index=None, seed=0, output_path=None):
+  os_client = OSClientFactory().client()
+  corpus_ids, corpus = vector_cache.corpus_vectors(
+    os_client, index_name=source_index or vector_cache.DEFAULT_SOURCE_INDEX)
+  texts = [query['query'] for query in batch_search.read_queries(queries_file)]
+  query_matrix = vector_cache.query_vectors(os_client, texts)
+  truth = recall_benchmark.ground_truth(corpus_ids, corpus, query_matrix, k,
+                                        SPACE_TYPE)
+  n_vectors, dimension = corpus.shape
+  nlists = nlists or candidate_nlists(n_vectors)
+  logging.info(f"N={n_vectors}, sqrt(N)={math.sqrt(n_vectors):.0f}, "
+               f"nlist candidates {nlists}")
+
+  # Plain IVF, plus each valid PQ encoder. PQ's m has to divide the dimension.
+  encoders = [(None, None)]
+  for pq_m in pq_ms:
+    if dimension % pq_m:
+      logging.warning(f"Skipping PQ m={pq_m}, it doesn't divide {dimension}")
+      continue
+    encoders.extend((pq_m, code_size) for code_size in pq_code_sizes)
+
+  rng = np.random.default_rng(seed)
+  rows = []
+  for nlist in nlists:
+    for pq_m, pq_code_size in encoders:
+      name = f'{INDEX_PREFIX}_nlist{nlist}'
+      if pq_m:
+        name += f'_pq{pq_m}x{pq_code_size}'
+      sample_size, train_seconds = train_ivf_model(
+        os_client, name, corpus_ids, corpus, nlist, pq_m, pq_code_size, rng)
+
+      build = vector_index_builder.build_index(
+        os_client, name,
+        {vector_index_builder.FIELD_NAME: {"type": "knn_vector", "model_id": name}},
+        corpus_ids, corpus)
+      memory_kb = vector_index_builder.native_memory_kb(os_client, name)
+      for probes in nprobes:
+        if probes > nlist:
+          continue
+        logging.info(f"Measuring {name} at nprobes={probes}")
+        metrics = recall_benchmark.measure_knn(
+          os_client, name, query_matrix, truth, k,
+          method_parameters={"nprobes": probes})
+        row = {"nlist": nlist, "nprobes": probes, "pq_m": pq_m,
+               "pq_code_size": pq_code_size, "training_vectors": sample_size,
+               "train_seconds": train_seconds,
+               "docs_per_second": build['docs_per_second'],
+               "memory_mb": memory_kb / 1024}
+        row.update(metrics)
+        rows.append(row)
+
+      os_client.indices.delete(index=name)
+      vector_index_builder.delete_knn_model(os_client, name)
+  os_client.indices.delete(index=TRAINING_INDEX_NAME)
+
+  columns = ['nlist', 'nprobes', 'pq_m', 'pq_code_size', 'training_vectors',
+             'memory_mb', 'latency_p50', 'latency_p99', 'recall']
+  print(bench_utils.format_table(rows, columns))
+  best = recommend(rows, memory_budget_mb, min_recall)
+  if best:
+    print("\nRecommended configuration")
+    print(bench_utils.format_table([best], columns))
+    print("\nTraining method: " + str(ivf_method(best['nlist'], best['pq_m'],
+                                                 best['pq_code_size'])))
+    print(f"Query with method_parameters: {{'nprobes': {best['nprobes']}}}")
+  else:
+    print(f"\nNo configuration fits in {memory_budget_mb} MB")
+  if output_path:
+    bench_utils.write_json(output_path, {"k": k, "rows": rows, "recommended": best})
+  return rows, best
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Trains IVF and IVF-PQ models with nlist derived from the "
+      "corpus size, measures recall and latency across nprobes, and recommends "
+      "a configuration under a memory budget.",
+  )
+  parser.add_argument("--queries-file", required=True, action="store")
+  parser.add_argument("--nlist", nargs='+', type=int, default=None,
+                      help="nlist values to try, defaults to multiples of sqrt(N)")
+  parser.add_argument("--nprobes", nargs='+', type=int, default=DEFAULT_NPROBES)
+  parser.add_argument("--pq-m", nargs='+', type=int, default=[],
+                      help="Also try PQ with these m values")
+  parser.add_argument("--pq-code-size", nargs='+', type=int, default=[8])
+  parser.add_argument("--k", default=10, type=int)
+  parser.add_argument("--memory-budget-mb", default=None, type=float)
+  parser.add_argument("--min-recall", default=None, type=float)
+  parser.add_argument("--source-index", default=None, action="store")
+  parser.add_argument("--seed", default=0, type=int)
+  parser.add_argument("--output", default=None, action="store")
+  args = parser.parse_args()
+  main(queries_file=args.queries_file,
+       nlists=args.nlist,
+       nprobes=args.nprobes,
+       pq_ms=args.pq_m,
+       pq_code_sizes=args.pq_code_size,
+       k=args.k,
+       memory_budget_mb=args.memory_budget_mb,
+       min_recall=args.min_recall,
+       source_index=args.source_index,
+       seed=args.seed,
+       output_path=args.output)
@@ -0,0 +1,255 @@
+"""
+Query load generator for the indices that the ch10 example scripts build.
+
+Replays a query set against one index and reports throughput, error rate and
+latency percentiles. Use it to size clusters: find the concurrency or arrival
+rate at which latency starts to climb.
+
+Two modes:
+    closed - --concurrency workers each send a query, wait for the response,
+             then send the next. Throughput is whatever the cluster sustains.
+    open   - queries arrive at a fixed --rate (or a Poisson process with that
+             mean rate with --poisson), whether or not earlier queries have
+             finished. Latency is measured from each query's scheduled start
+             time, so a stall counts against every query that should have been
+             sent during it (coordinated-omission correction). Service time,
+             measured from the actual send, is reported alongside.
+
+Client latency is reported separately from the server's took, so you can tell
+time spent in OpenSearch from time spent on the network and in the client.
+
+The queries are embedded once before the run starts, so model inference is not
+part of the measurement.
+
+Usage:
+    python load_generator.py --target hnsw --queries-file queries.txt \\
+        --mode closed --concurrency 16 --duration 60
+    python load_generator.py --target on_disk --queries-file queries.txt \\
+        --mode open --rate 200 --duration 60 --output on_disk_200.json
+
+The queries file uses the batch_search.py format, one query per line.
+"""
+
+
+import argparse
+from bench_utils import BENCH_TARGETS
+import bench_utils
+import batch_search
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import logging
+from opensearchpy import OpenSearch
+from os_client_factory import OSClientFactory
+import random
+import threading
+import time
+
+
+# Per-request timeout, in seconds. Queries that take longer count as errors.
+REQUEST_TIMEOUT = 30
+# Upper bound on in-flight requests in open loop mode. When the cluster can't
+# keep up, requests wait for a free worker and that wait shows up in latency.
+MAX_OUTSTANDING = 256
+
+
+class _Recorder:
+  '''Collects one sample per request from the worker threads. A sample is
+  (scheduled start, actual start, end, server took in ms or None, error name or
+  None), times from time.perf_counter().'''
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.samples = []
+
+  def record(self, sample):
+    with self._lock:
+      self.samples.append(sample)
+
+
+def _run_one(os_client: OpenSearch, index_name, body, recorder, scheduled=None):
+  start = time.perf_counter()
+  took = None
+  error = None
+  try:
+    response = os_client.search(index=index_name, body=body,
+                                request_timeout=REQUEST_TIMEOUT)
+    took = response['took']
+    if response.get('timed_out'):
+      error = 'timed_out'
+  except Exception as e:
+    error = type(e).__name__
+  end = time.perf_counter()
+  recorder.record((scheduled if scheduled is not None else start,
+                   start, end, took, error))
+
+
+def closed_loop(os_client: OpenSearch, index_name, bodies, concurrency, run_seconds):
+  '''Runs concurrency workers, each sending queries back to back for
+  run_seconds. Returns the recorded samples.'''
+  recorder = _Recorder()
+  next_query = itertools.count()
+  deadline = time.perf_counter() + run_seconds
+
+  def worker():
+    while time.perf_counter() < deadline:
+      body = bodies[next(next_query) % len(bodies)]
+      _run_one(os_client, index_name, body, recorder)
+
+  threads = [threading.Thread(target=worker, daemon=True)
+             for _ in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return recorder.samples
+
+
+def open_loop(os_client: OpenSearch, index_name, bodies, rate, run_seconds,
+              poisson=False, max_outstanding=MAX_OUTSTANDING):
+  '''Schedules queries at rate per second for run_seconds, independent of
+  responses. Each sample carries its scheduled start time. Returns the
+  recorded samples.'''
+  recorder = _Recorder()
+  start = time.perf_counter()
+  scheduled = start
+  end = start + run_seconds
+  lagging = 0
+  with ThreadPoolExecutor(max_workers=max_outstanding) as executor:
+    for i in itertools.count():
+      if scheduled >= end:
+        break
+      delay = scheduled - time.perf_counter()
+      if delay > 0:
+        time.sleep(delay)
+      elif delay < -0.01:
+        lagging += 1
+      executor.submit(_run_one, os_client, index_name,
+                      bodies[i % len(bodies)], recorder, scheduled)
+      scheduled += random.expovariate(rate) if poisson else 1.0 / rate
+  if lagging:
+    logging.warning(f"The scheduler sent {lagging} queries more than 10ms late. "
+                    "The client machine may be the bottleneck.")
+  return recorder.samples
+
+
+def summarize(samples, window_start, window_seconds):
+  '''Reduces the samples scheduled inside the measurement window to
+  throughput, error rate and latency summaries, all latencies in ms.'''
+  window_end = window_start + window_seconds
+  measured = [s for s in samples if window_start <= s[0] < window_end]
+  ok = [s for s in measured if s[4] is None]
+  errors = {}
+  for s in measured:
+    if s[4] is not None:
+      errors[s[4]] = errors.get(s[4], 0) + 1
+  return {
+    "requests": len(measured),
+    "errors": sum(errors.values()),
+    "error_rate": sum(errors.values()) / len(measured) if measured else None,
+    "error_types": errors,
+    "qps": len(ok) / window_seconds,
+    "latency_ms": {
+      # From the scheduled start. Equal to service time in closed loop mode.
+      "response_time": bench_utils.latency_summary(
+        [(s[2] - s[0]) * 1000 for s in ok]),
+      "service_time": bench_utils.latency_summary(
+        [(s[2] - s[1]) * 1000 for s in ok]),
+      "server_took": bench_utils.latency_summary([s[3] for s in ok]),
+      "client_overhead": bench_utils.latency_summary(
+        [(s[2] - s[1]) * 1000 - s[3] for s in ok]),
+    }
+  }
+
+
+def main(target_name, queries_file, mode='closed', concurrency=8, rate=100.0,
+         poisson=False, duration=60, warmup=10, k=10, index_name=None,
+         output_path=None):
+  target = BENCH_TARGETS[target_name]
+  index_name = index_name or target['index']
+
+  pool_size = concurrency if mode == 'closed' else MAX_OUTSTANDING
+  os_client = OSClientFactory(pool_maxsize=pool_size).client()
+
+  texts = [query['query'] for query in batch_search.read_queries(queries_file)]
+  bodies = bench_utils.query_bodies(os_client, target, texts, k=k)
+  logging.info(f"Prepared {len(bodies)} queries for {index_name}")
+
+  logging.info(f"Running {mode} loop for {warmup}s warmup + {duration}s")
+  start = time.perf_counter()
+  if mode == 'closed':
+    samples = closed_loop(os_client, index_name, bodies, concurrency,
+                          warmup + duration)
+  else:
+    samples = open_loop(os_client, index_name, bodies, rate, warmup + duration,
+                        poisson=poisson)
+
+  report = {
+    "target": target_name,
+    "index": index_name,
+    "mode": mode,
+    "concurrency": concurrency if mode == 'closed' else None,
+    "rate": rate if mode == 'open' else None,
+    "poisson": poisson if mode == 'open' else None,
+    "duration": duration,
+    "warmup": warmup,
+  }
+  report.update(summarize(samples, start + warmup, duration))
+
+  logging.info(f"{index_name}: {report['qps']:.1f} queries/s, "
+               f"{report['requests']} requests, {report['errors']} errors "
+               f"({(report['error_rate'] or 0) * 100:.2f}%)")
+  if report['error_types']:
+    logging.info(f"Errors: {report['error_types']}")
+  rows = [dict(metric=name, **summary)
+          for name, summary in report['latency_ms'].items()]
+  print(bench_utils.format_table(
+    rows, ['metric', 'count', 'mean', 'p50', 'p90', 'p99', 'p99.9', 'max']))
+  if output_path:
+    bench_utils.write_json(output_path, report)
+  return report
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Replays a query set against one of the ch10 indices in a "
+      "closed or open loop and reports QPS, errors and latency percentiles.",
+  )
+  parser.add_argument("--target", required=True, choices=sorted(BENCH_TARGETS))
+  parser.add_argument("--index", default=None, action="store",
+                      help="Query this index or alias instead of the target's "
+                      "default index")
+  parser.add_argument("--queries-file", required=True, action="store")
+  parser.add_argument("--mode", default="closed", choices=["closed", "open"])
+  parser.add_argument("--concurrency", default=8, type=int,
+                      help="Workers in closed loop mode")
+  parser.add_argument("--rate", default=100.0, type=float,
+                      help="Queries per second in open loop mode")
+  parser.add_argument("--poisson", default=False, action="store_true",
+                      help="Poisson arrivals instead of evenly spaced, in open "
+                      "loop mode")
+  parser.add_argument("--duration", default=60, type=int,
+                      help="Measured seconds")
+  parser.add_argument("--warmup", default=10, type=int,
+                      help="Seconds of load before measuring starts")
+  parser.add_argument("--k", default=10, type=int)
+  parser.add_argument("--output", default=None, action="store",
+                      help="Also write the report to this JSON file")
+  args = parser.parse_args()
+  main(target_name=args.target,
+       queries_file=args.queries_file,
+       mode=args.mode,
+       concurrency=args.concurrency,
+       rate=args.rate,
+       poisson=args.poisson,
+       duration=args.duration,
+       warmup=args.warmup,
+       k=args.k,
+       index_name=args.index,
+       output_path=args.output)
@@ -0,0 +1,355 @@
+"""
+Estimates the native memory of the ch10 k-NN indices before building them.
+
+The k-NN plugin loads each segment's native index (faiss or nmslib) into
+off-heap memory when it's first searched, and refuses to load more than the
+circuit breaker limit (knn.memory.circuit_breaker.limit, by default 50% of the
+node's memory outside the JVM heap). The size of those structures follows from
+the mapping, the dimension d and the number of vectors n. With the formulas
+from the k-NN plugin's documentation, in bytes:
+
+    HNSW                 1.1 * (code_bytes + 8 * m) * n
+    HNSW with PQ         1.1 * ((pq_m * code_size / 8 + 24 + 8 * m) * n
+                                + segments * 2^code_size * 4 * d)
+    IVF                  1.1 * (code_bytes * n + segments * 4 * nlist * d)
+    IVF with PQ          1.1 * ((pq_m * code_size / 8 + 24) * n
+                                + segments * (2^code_size * 4 * d
+                                              + 4 * nlist * d))
+
+code_bytes is what one vector takes in memory: 4 * d for float vectors, 2 * d
+for the fp16 scalar quantizer (sq encoder, or compression_level 2x), and
+d * 32 / compression / 8 for the binary quantization of compression_level 8x,
+16x and 32x. mode on_disk defaults to 32x. compression_level 4x uses the Lucene
+engine, which doesn't use native memory, so the estimate is reported but
+doesn't count against the circuit breaker. The segments terms are the
+per-segment codebooks and centroids; they're small once the index is force
+merged.
+
+For each method (the example scripts' mappings, or --field-file with a mapping
+of your own), the estimator prints the estimate for --docs documents and
+--replicas replicas, and checks it against the data nodes' circuit breaker
+limits, less the graph memory already loaded. With --strict, a method that
+doesn't fit raises an error instead of a warning. Call check_fits() before
+a build to refuse it in code.
+
+With --compare, it warms up the index the example script built for each
+method, and compares the estimate for the index's actual document and segment
+counts with the graph memory the k-NN stats report.
+
+The IVF scripts map their field by model_id. The method comes from the
+trained model, so the IVF estimates use the method in the training request
+(ivf_training.py, ivf_pq_training.py).
+
+Usage:
+    python memory_estimator.py --docs 10000000 --replicas 1
+    python memory_estimator.py --methods hnsw sq on_disk --compare
+    python memory_estimator.py --field-file my_field.json --docs 50000000 --strict
+"""
+
+
+import approximate_faiss_sq
+import approximate_hnsw
+import approximate_on_disk
+import argparse
+import bench_utils
+import exact
+import index_utils
+import ivf_pq_training
+import ivf_training
+import json
+import logging
+import model_utils
+import movie_source
+from opensearchpy import OpenSearch
+from os_client_factory import OSClientFactory
+import re
+import vector_index_builder
+
+
+OVERHEAD = 1.1
+DEFAULT_HNSW_M = 16
+DEFAULT_NLIST = 4
+DEFAULT_CIRCUIT_BREAKER_LIMIT = '50%'
+CIRCUIT_BREAKER_SETTING = 'knn.memory.circuit_breaker.limit'
+NUMBER_OF_MOVIES = movie_source.TOTAL_MOVIES
+
+
+def _trained_field(training_request_body):
+  '''The knn_vector mapping equivalent to a field that uses the model the
+  training request creates.'''
+  return {"embedding": {
+    "type": "knn_vector",
+    "dimension": exact.KNN_FIELDS['embedding']['dimension'],
+    "space_type": training_request_body['space_type'],
+    "method": training_request_body['method']}}
+
+
+# The vector field mappings of the example scripts, by BENCH_TARGETS name.
+METHOD_FIELDS = {
+  "exact": exact.KNN_FIELDS,
+  "hnsw": approximate_hnsw.FAISS_HNSW_FIELD,
+  "sq": approximate_faiss_sq.FAISS_SQ_FIELD,
+  "on_disk": approximate_on_disk.ON_DISK_FIELD,
+  "ivf": _trained_field(ivf_training.TRAINING_REQUEST_BODY),
+  "ivf_pq": _trained_field(ivf_pq_training.TRAINING_REQUEST_BODY),
+}
+
+
+def _compression(field):
+  '''The field's compression level as a number, from compression_level or the
+  mode's default.'''
+  level = field.get('compression_level')
+  if level is None:
+    return 32 if field.get('mode') == 'on_disk' else 1
+  return int(str(level).rstrip('x'))
+
+
+def estimate(field, doc_count, dimension=None, segments=1):
+  '''Estimates the native memory of one knn_vector field mapping for
+  doc_count vectors. Returns a dict with the method description, the engine,
+  the bytes per vector and the total bytes.'''
+  dimension = dimension or field['dimension']
+  method = field.get('method', {})
+  name = method.get('name', 'hnsw')
+  parameters = method.get('parameters', {})
+  encoder = parameters.get('encoder', {})
+  compression = _compression(field)
+  engine = method.get('engine', 'lucene' if compression == 4 else 'faiss')
+
+  if encoder.get('name') == 'pq':
+    pq_m = encoder.get('parameters', {}).get('m', 1)
+    code_size = encoder.get('parameters', {}).get('code_size', 8)
+    code_bytes = pq_m * code_size / 8 + 24
+    codebook_bytes = 2**code_size * 4 * dimension
+    description = f"pq m={pq_m} code_size={code_size}"
+  elif encoder.get('name') == 'sq' or compression == 2:
+    code_bytes = 2 * dimension
+    codebook_bytes = 0
+    description = "sq fp16"
+  else:
+    code_bytes = dimension * 32 / compression / 8
+    codebook_bytes = 0
+    description = f"{compression}x" if compression > 1 else "float"
+
+  if name == 'ivf':
+    nlist = parameters.get('nlist', DEFAULT_NLIST)
+    per_vector = code_bytes
+    per_segment = codebook_bytes + 4 * nlist * dimension
+    description = f"ivf nlist={nlist}, {description}"
+  else:
+    m = parameters.get('m', DEFAULT_HNSW_M)
+    per_vector = code_bytes + 8 * m
+    per_segment = codebook_bytes
+    description = f"hnsw m={m}, {description}"
+
+  return {"method": description,
+          "engine": engine,
+          "dimension": dimension,
+          "docs": doc_count,
+          "bytes_per_vector": OVERHEAD * per_vector,
+          "bytes": OVERHEAD * (per_vector * doc_count + per_segment * segments)}
+
+
+def estimate_fields(fields, doc_count, dimension=None, segments=1):
+  '''Sums estimate() over the knn_vector fields of a mapping.'''
+  rows = [estimate(field, doc_count, dimension, segments)
+          for field in fields.values() if field.get('type') == 'knn_vector']
+  if not rows:
+    raise ValueError("The mapping has no knn_vector field")
+  total = dict(rows[0])
+  for row in rows[1:]:
+    total['method'] += f" + {row['method']}"
+    total['bytes_per_vector'] += row['bytes_per_vector']
+    total['bytes'] += row['bytes']
+  return total
+
+
+def parse_limit(value, native_bytes):
+  '''Bytes for a circuit breaker limit: a percentage of native_bytes, or a
+  byte size like 10gb.'''
+  value = str(value).strip().lower()
+  if value.endswith('%'):
+    return float(value[:-1]) / 100 * native_bytes
+  match = re.fullmatch(r'([\d.]+)\s*([kmgtp]?b?)', value)
+  if not match:
+    raise ValueError(f"Can't parse the circuit breaker limit '{value}'")
+  units = {'': 0, 'b': 0, 'k': 1, 'kb': 1, 'm': 2, 'mb': 2, 'g': 3, 'gb': 3,
+           't': 4, 'tb': 4, 'p': 5, 'pb': 5}
+  return float(match.group(1)) * 1024**units[match.group(2)]
+
+
+def circuit_breaker_limit(os_client: OpenSearch):
+  '''The cluster's knn.memory.circuit_breaker.limit setting.'''
+  settings = os_client.cluster.get_settings(include_defaults=True,
+                                            flat_settings=True)
+  for scope in ['transient', 'persistent', 'defaults']:
+    if CIRCUIT_BREAKER_SETTING in settings.get(scope, {}):
+      return settings[scope][CIRCUIT_BREAKER_SETTING]
+  return DEFAULT_CIRCUIT_BREAKER_LIMIT
+
+
+def node_budgets(os_client: OpenSearch):
+  '''One dict per data node, with its circuit breaker limit and the k-NN
+  graph memory it already uses, in bytes.'''
+  limit = circuit_breaker_limit(os_client)
+  stats = os_client.nodes.stats(metric='os,jvm')['nodes']
+  knn_nodes = vector_index_builder.knn_stats(os_client)['nodes']
+  nodes = []
+  for node_id, node in stats.items():
+    if 'data' not in node.get('roles', []):
+      continue
+    native_bytes = (node['os']['mem']['total_in_bytes']
+                    - node['jvm']['mem']['heap_max_in_bytes'])
+    nodes.append({"name": node['name'],
+                  "limit_bytes": parse_limit(limit, native_bytes),
+                  "used_bytes": knn_nodes.get(node_id, {}).get('graph_memory_usage', 0) * 1024})
+  return nodes
+
+
+def budget_problems(total_bytes, nodes):
+  '''Reasons total_bytes of new graphs, spread evenly over the data nodes,
+  don't fit under their circuit breakers. Empty when they fit.'''
+  if not nodes:
+    return ["no data nodes reported"]
+  problems = []
+  headroom = sum(node['limit_bytes'] - node['used_bytes'] for node in nodes)
+  if total_bytes > headroom:
+    problems.append(f"{total_bytes / 2**30:.2f} GB is more than the "
+                    f"{headroom / 2**30:.2f} GB left under the circuit breakers")
+  per_node = total_bytes / len(nodes)
+  for node in nodes:
+    left = node['limit_bytes'] - node['used_bytes']
+    if per_node > left:
+      problems.append(f"node {node['name']} has {left / 2**30:.2f} GB left "
+                      f"for its {per_node / 2**30:.2f} GB share")
+  return problems
+
+
+def check_fits(os_client: OpenSearch, fields, doc_count, replicas=1,
+               dimension=None):
+  '''Raises a RuntimeError when the mapping's estimated native memory, for
+  doc_count documents and replicas, doesn't fit under the data nodes' circuit
+  breakers. Returns the estimate otherwise.'''
+  row = estimate_fields(fields, doc_count, dimension)
+  if row['engine'] == 'lucene':
+    return row
+  problems = budget_problems(row['bytes'] * (1 + replicas), node_budgets(os_client))
+  if problems:
+    raise RuntimeError(f"{row['method']} for {doc_count} documents won't fit "
+                       f"in k-NN memory: {'; '.join(problems)}")
+  return row
+
+
+def compare(os_client: OpenSearch, target_name, fields, dimension):
+  '''Warms up the target's index and returns the estimate for its document
+  and segment counts next to the graph memory the k-NN stats report.'''
+  index_name = bench_utils.BENCH_TARGETS[target_name]['index']
+  targets = index_utils.alias_targets(os_client, index_name)
+  concrete = targets[0] if targets else index_name
+  # The stats cover every shard copy, and the native memory is per copy
+  stats = os_client.indices.stats(index=concrete, metric='docs,segments')['_all']['total']
+  row = estimate_fields(fields, stats['docs']['count'], dimension,
+                        stats['segments']['count'])
+  actual_kb = vector_index_builder.native_memory_kb(os_client, concrete)
+  row.update(index=concrete,
+             estimated_mb=row['bytes'] / 2**20,
+             actual_mb=actual_kb / 1024,
+             error_pct=(100 * (row['bytes'] / 1024 - actual_kb) / actual_kb
+                        if actual_kb else None))
+  return row
+
+
+def main(methods=None, field_file=None, docs=NUMBER_OF_MOVIES, replicas=1,
+         model=exact.MODEL_SHORT_NAME, compare_actual=False, strict=False,
+         output_path=None):
+  os_client = OSClientFactory().client()
+  dimension = model_utils.DENSE_MODELS_HF[model]['dimensions']
+  candidates = {}
+  if field_file:
+    with open(field_file, 'r') as f:
+      candidates[field_file] = json.load(f)
+  for method in methods or ([] if field_file else list(METHOD_FIELDS)):
+    candidates[method] = METHOD_FIELDS[method]
+
+  nodes = node_budgets(os_client)
+  rows = []
+  for name, fields in candidates.items():
+    # A mapping from --field-file keeps its own dimension
+    row = estimate_fields(fields, docs, None if name == field_file else dimension)
+    total_bytes = row['bytes'] * (1 + replicas)
+    row.update(name=name, replicas=replicas,
+               estimated_mb=row['bytes'] / 2**20,
+               total_gb=total_bytes / 2**30)
+    problems = [] if row['engine'] == 'lucene' else budget_problems(total_bytes, nodes)
+    row['fits'] = not problems
+    rows.append(row)
+    if problems:
+      message = f"{name} ({row['method']}) won't fit: {'; '.join(problems)}"
+      if strict:
+        raise RuntimeError(message)
+      logging.warning(message)
+
+  print(bench_utils.format_table(rows, [
+    'name', 'method', 'engine', 'dimension', 'docs', 'bytes_per_vector',
+    'estimated_mb', 'replicas', 'total_gb', 'fits']))
+  for node in nodes:
+    print(f"  {node['name']}: limit {node['limit_bytes'] / 2**30:.2f} GB, "
+          f"used {node['used_bytes'] / 2**30:.2f} GB")
+
+  comparisons = []
+  if compare_actual:
+    for name, fields in candidates.items():
+      if name not in bench_utils.BENCH_TARGETS:
+        continue
+      index_name = bench_utils.BENCH_TARGETS[name]['index']
+      if not os_client.indices.exists(index=index_name):
+        logging.warning(f"Index {index_name} does not exist, skipping {name}")
+        continue
+      logging.info(f"Comparing {name} with {index_name}")
+      comparisons.append(dict(compare(os_client, name, fields, dimension), name=name))
+    print()
+    print(bench_utils.format_table(comparisons, [
+      'name', 'index', 'docs', 'estimated_mb', 'actual_mb', 'error_pct']))
+
+  if output_path:
+    bench_utils.write_json(output_path, {"estimates": rows,
+                                         "comparisons": comparisons,
+                                         "nodes": nodes})
+  return rows, comparisons
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Estimates the native k-NN memory of each example mapping "
+      "and checks it against the circuit breaker.",
+  )
+  parser.add_argument("--methods", nargs='+', default=None,
+                      choices=sorted(METHOD_FIELDS))
+  parser.add_argument("--field-file", default=None, action="store",
+                      help="JSON file with the mapping properties to estimate")
+  parser.add_argument("--docs", default=NUMBER_OF_MOVIES, type=int)
+  parser.add_argument("--replicas", default=1, type=int)
+  parser.add_argument("--model", default=exact.MODEL_SHORT_NAME,
+                      choices=sorted(model_utils.DENSE_MODELS_HF),
+                      help="Sets the vector dimension")
+  parser.add_argument("--compare", default=False, action="store_true",
+                      help="Compare with the k-NN stats of the built indices")
+  parser.add_argument("--strict", default=False, action="store_true",
+                      help="Fail when an estimate exceeds the circuit breaker")
+  parser.add_argument("--output", default=None, action="store")
+  args = parser.parse_args()
+  main(methods=args.methods,
+       field_file=args.field_file,
+       docs=args.docs,
+       replicas=args.replicas,
+       model=args.model,
+       compare_actual=args.compare,
+       strict=args.strict,
+       output_path=args.output)
@@ -195,3 +195,43 @@ def create_embedding(os_client, model_id, input_text):
     }
   )
   return response['inference_results'][0]['output'][0]['data']
+
+
+# Use this to call the _predict API for a loaded, dense model with many texts
+# at once. Sends batch_size texts per _predict call, which is much faster than
+# one call per text.
+#
+# Returns the vectors for the texts, in the same order.
+def create_embeddings(os_client, model_id, input_texts, batch_size=32):
+  embeddings = []
+  for start in range(0, len(input_texts), batch_size):
+    response = os_client.transport.perform_request(
+      'POST', f'/_plugins/_ml/_predict/text_embedding/{model_id}',
+      body={
+        "text_docs": input_texts[start:start + batch_size],
+        "return_number": True,
+        "target_response": ["sentence_embedding"]
+      }
+    )
+    embeddings.extend(result['output'][0]['data']
+                      for result in response['inference_results'])
+  return embeddings
+
+
+# Use this to call the _predict API for a sparse model with many texts at once.
+# function_name is sparse_encoding for an encoder model, or sparse_tokenize for
+# a tokenizer model, which weights each token of the text by its IDF (doc-only
+# mode).
+#
+# Returns a {token: weight} map for each text, in the same order.
+def create_sparse_embeddings(os_client, model_id, input_texts,
+                             function_name='sparse_encoding', batch_size=32):
+  embeddings = []
+  for start in range(0, len(input_texts), batch_size):
+    response = os_client.transport.perform_request(
+      'POST', f'/_plugins/_ml/_predict/{function_name}/{model_id}',
+      body={"text_docs": input_texts[start:start + batch_size]}
+    )
+    embeddings.extend(result['output'][0]['dataAsMap']['response'][0]
+                      for result in response['inference_results'])
+  return embeddings
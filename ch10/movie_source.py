@@ -13,6 +13,10 @@ Generator Functions:
     movies(): Yields normalized movie records one at a time bulks(n_movies,
     index_name): Yields batches of n movies formatted for bulk indexing
 
+Sampling Functions:
+    sample_movies(n_movies, seed): A uniform random sample of n movies from
+    the whole file, in one pass
+
 Utility Functions:
     safe_int(val): Safely converts values to integers safe_float(val): Safely
     converts values to floats split_and_strip_whitespace(str): Processes
@@ -25,6 +29,7 @@ JSON movie record per line.
 
 
 import json
+import random
 
 
 MOVIES_FILE_PATH = 'movies_reduced.ndjson'
@@ -109,4 +114,21 @@ def bulks(n_movies, index_name):
       yield buffer
       buffer = []
   if buffer:
-    yield buffer
\ No newline at end of file
+    yield buffer
+
+
+# Reservoir sampling (Algorithm R). Returns n_movies normalized movies chosen
+# uniformly at random from the whole file, reading it once and holding only the
+# sample in memory. Taking the first n lines instead would bias the sample to
+# whatever order the file is in.
+def sample_movies(n_movies, seed=None):
+  rng = random.Random(seed)
+  sample = []
+  for i, movie in enumerate(movies()):
+    if i < n_movies:
+      sample.append(movie)
+    else:
+      j = rng.randint(0, i)
+      if j < n_movies:
+        sample[j] = movie
+  return sample
@@ -0,0 +1,167 @@
+"""
+Compression and rescoring sweep for on-disk k-NN indices.
+
+approximate_on_disk.py uses mode on_disk with compression_level 32x and the
+default rescoring. On-disk mode keeps quantized vectors in memory for the
+graph search, then rescores the candidates with the full precision vectors
+read from disk. Two knobs decide the cost:
+
+    - compression_level (an index setting): how far the in-memory vectors are
+      quantized. 2x is fp16, 8x to 32x are binary quantization with 4, 2 or 1
+      bits per dimension. 4x (byte quantization) uses the Lucene engine,
+      whose memory doesn't show in the k-NN stats
+    - rescore.oversample_factor (a query setting): the search gathers
+      k * oversample_factor candidates and rescores them from disk. More
+      candidates raise recall, at the cost of disk reads
+
+This sweep builds one index per compression level from the cached corpus
+vectors and queries each one at every oversample factor (0 turns rescoring
+off). It records off-heap memory, latency and recall for each pair, and picks
+the setting with the least memory that meets --min-recall, breaking ties on
+p99 latency.
+
+Usage:
+    python on_disk_sweep.py --queries-file queries.txt --min-recall 0.95
+    python on_disk_sweep.py --queries-file queries.txt --compression 8x 32x \\
+        --oversample 1 2 5 10
+"""
+
+
+import argparse
+import batch_search
+import bench_utils
+import logging
+import opensearchpy.exceptions
+from os_client_factory import OSClientFactory
+import recall_benchmark
+import vector_cache
+import vector_index_builder
+
+
+INDEX_PREFIX = 'on_disk_sweep'
+SPACE_TYPE = 'l2'
+DEFAULT_COMPRESSION = ['2x', '8x', '16x', '32x']
+DEFAULT_OVERSAMPLE = [0, 1, 2, 3, 5, 10]
+
+
+def on_disk_field(dimension, compression_level):
+  '''The knn_vector mapping for one compression level, like ON_DISK_FIELD in
+  approximate_on_disk.py.'''
+  return {
+    vector_index_builder.FIELD_NAME: {
+      "type": "knn_vector",
+      "dimension": dimension,
+      "space_type": SPACE_TYPE,
+      "data_type": "float",
+      "mode": "on_disk",
+      "compression_level": compression_level
+  }}
+
+
+def rescore_for(oversample_factor):
+  '''The rescore query parameter. 0 turns rescoring off.'''
+  if not oversample_factor:
+    return False
+  return {"oversample_factor": oversample_factor}
+
+
+def cheapest(rows, min_recall):
+  '''The row with the least memory that reaches min_recall, breaking ties on
+  p99 latency. Rows with unknown memory are skipped. Returns None if no row
+  reaches min_recall.'''
+  passing = [row for row in rows
+             if row['recall'] >= min_recall and row['memory_mb'] is not None]
+  if not passing:
+    return None
+  return min(passing, key=lambda row: (row['memory_mb'], row['latency_p99']))
+
+
+def main(queries_file, compression_levels=DEFAULT_COMPRESSION,
+         oversample_factors=DEFAULT_OVERSAMPLE, k=10, min_recall=None,
+         source_index=None, keep_indices=False, output_path=None):
+  os_client = OSClientFactory().client()
+  corpus_ids, corpus = vector_cache.corpus_vectors(
+    os_client, index_name=source_index or vector_cache.DEFAULT_SOURCE_INDEX)
+  texts = [query['query'] for query in batch_search.read_queries(queries_file)]
+  query_matrix = vector_cache.query_vectors(os_client, texts)
+  truth = recall_benchmark.ground_truth(corpus_ids, corpus, query_matrix, k,
+                                        SPACE_TYPE)
+
+  rows = []
+  for compression_level in compression_levels:
+    index_name = f'{INDEX_PREFIX}_{compression_level}'
+    try:
+      build = vector_index_builder.build_index(
+        os_client, index_name, on_disk_field(corpus.shape[1], compression_level),
+        corpus_ids, corpus)
+    except opensearchpy.exceptions.RequestError as e:
+      logging.warning(f"Skipping compression {compression_level}: {e}")
+      continue
+    memory_kb = vector_index_builder.native_memory_kb(os_client, index_name)
+    if not memory_kb:
+      logging.warning(f"{index_name} reports no native memory, its memory is "
+                      "left blank")
+    for oversample_factor in oversample_factors:
+      logging.info(f"Measuring {index_name} at oversample_factor={oversample_factor}")
+      metrics = recall_benchmark.measure_knn(
+        os_client, index_name, query_matrix, truth, k,
+        rescore=rescore_for(oversample_factor))
+      row = {"compression": compression_level,
+             "oversample_factor": oversample_factor,
+             "index_seconds": build['index_seconds'],
+             "memory_mb": memory_kb / 1024 if memory_kb else None}
+      row.update(metrics)
+      rows.append(row)
+    if not keep_indices:
+      os_client.indices.delete(index=index_name)
+
+  columns = ['compression', 'oversample_factor', 'memory_mb', 'latency_p50',
+             'latency_p99', 'recall', 'ndcg']
+  print(bench_utils.format_table(rows, columns))
+  best = None
+  if min_recall is not None:
+    best = cheapest(rows, min_recall)
+    if best:
+      print(f"\nCheapest setting with recall@{k} >= {min_recall}")
+      print(bench_utils.format_table([best], columns))
+    else:
+      print(f"\nNo setting reaches recall@{k} {min_recall}")
+  if output_path:
+    bench_utils.write_json(output_path, {"k": k, "min_recall": min_recall,
+                                         "rows": rows, "cheapest": best})
+  return rows, best
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Builds on-disk k-NN indices at each compression level, "
+      "measures memory, latency and recall at each rescore oversample factor, "
+      "and picks the cheapest setting that meets a recall target.",
+  )
+  parser.add_argument("--queries-file", required=True, action="store")
+  parser.add_argument("--compression", nargs='+', default=DEFAULT_COMPRESSION,
+                      choices=['2x', '4x', '8x', '16x', '32x'])
+  parser.add_argument("--oversample", nargs='+', type=float,
+                      default=DEFAULT_OVERSAMPLE,
+                      help="rescore oversample_factor values, 0 disables rescoring")
+  parser.add_argument("--k", default=10, type=int)
+  parser.add_argument("--min-recall", default=None, type=float)
+  parser.add_argument("--source-index", default=None, action="store")
+  parser.add_argument("--keep-indices", default=False, action="store_true")
+  parser.add_argument("--output", default=None, action="store")
+  args = parser.parse_args()
+  main(queries_file=args.queries_file,
+       compression_levels=args.compression,
+       oversample_factors=args.oversample,
+       k=args.k,
+       min_recall=args.min_recall,
+       source_index=args.source_index,
+       keep_indices=args.keep_indices,
+       output_path=args.output)
@@ -39,6 +39,23 @@ OPENSEARCH_AUTH = (os.environ.get('OPENSEARCH_ADMIN_USER', 'admin'),
 AWS_REGION = os.environ.get('AWS_REGION', 'us-west-2')
 
 
+TRUSTED_ENDPOINTS_SETTING = 'plugins.ml_commons.trusted_connector_endpoints_regex'
+BEDROCK_ENDPOINT_REGEX = "^https://bedrock-runtime\\..*[a-z0-9-]\\.amazonaws\\.com/.*$"
+
+
+def trusted_endpoints(os_client):
+  '''The persistent trusted connector endpoint regexes. Flat settings show a
+  list either as one key or as one key per element, depending on the
+  version.'''
+  settings = os_client.cluster.get_settings(flat_settings=True)['persistent']
+  if TRUSTED_ENDPOINTS_SETTING in settings:
+    return list(settings[TRUSTED_ENDPOINTS_SETTING])
+  prefix = f'{TRUSTED_ENDPOINTS_SETTING}.'
+  return [settings[key] for key in sorted(
+            (key for key in settings if key.startswith(prefix)),
+            key=lambda key: int(key[len(prefix):]))]
+
+
 class OSClientFactory:
   """
   Factory class for creating and configuring OpenSearch clients.
@@ -56,9 +73,13 @@ class OSClientFactory:
 
   Example:
       client = OSClientFactory().client()
+
+  Pass extra keyword arguments to forward them to the OpenSearch client, e.g.
+  pool_maxsize to allow more concurrent requests from a multi-threaded
+  benchmark.
   """
 
-  def __init__(self):
+  def __init__(self, **client_args):
     # Validate that there's a password in the environment
     if not os.environ.get('OPENSEARCH_ADMIN_PASSWORD', ''):
       raise ValueError('OPENSEARCH_ADMIN_PASSWORD must be set in the environment')
@@ -69,18 +90,23 @@ class OSClientFactory:
       verify_certs = False,
       ssl_assert_hostname = False,
       ssl_show_warn = False,
+      **client_args
     )
 
 
+    # Adds Bedrock to the trusted endpoints rather than replacing them, so
+    # that starting a script doesn't untrust an endpoint another one added
+    # (converse.py --stub-llm-url)
+    trusted = trusted_endpoints(self.os_client)
+    if BEDROCK_ENDPOINT_REGEX not in trusted:
+      trusted.append(BEDROCK_ENDPOINT_REGEX)
     self.os_client.cluster.put_settings(body={
       "persistent": {
         "plugins.ml_commons.memory_feature_enabled": True,
         "plugins.ml_commons.rag_pipeline_feature_enabled": True,
         "plugins.ml_commons.allow_registering_model_via_url": True,
         "plugins.ml_commons.only_run_on_ml_node": True,
-        "plugins.ml_commons.trusted_connector_endpoints_regex": [
-            "^https://bedrock-runtime\\..*[a-z0-9-]\\.amazonaws\\.com/.*$"
-        ]
+        TRUSTED_ENDPOINTS_SETTING: trusted
       }
     })
 
@@ -0,0 +1,208 @@
+"""
+Compares PQ and scalar quantization settings for the ch10 movies vectors.
+
+approximate_ivf_pq.py encodes with PQ m=8, code_size=8, and
+approximate_faiss_sq.py with fp16 SQ and clip. Each is one point in a much
+larger space, and the encoder is the biggest lever on native memory. This
+harness builds one index per encoder setting from the cached corpus vectors:
+
+    - flat: HNSW with full float32 vectors, the baseline
+    - sq_fp16, sq_fp16_clip: HNSW with the fp16 scalar quantizer. Without clip,
+      vectors with components outside the fp16 range fail to index. With clip,
+      those components are clamped
+    - pq<m>x<code_size>: IVF-PQ, one model per (m, code_size). m splits each
+      vector into m sub-vectors, each encoded in code_size bits, so a vector
+      takes m * code_size / 8 bytes. m has to divide the dimension
+
+For each one it records training and indexing time, native memory per vector,
+query latency and recall@k, and projects the native memory to 10M and 100M
+vectors. The projection scales the measured bytes per vector linearly, which
+includes the graph or inverted lists along with the codes.
+
+Usage:
+    python quantization_sweep.py --queries-file queries.txt
+    python quantization_sweep.py --queries-file queries.txt --pq-m 16 32 \\
+        --pq-code-size 4 8 --no-sq
+"""
+
+
+import argparse
+import batch_search
+import bench_utils
+import ivf_tuning
+import logging
+import math
+import numpy as np
+from os_client_factory import OSClientFactory
+import recall_benchmark
+import vector_cache
+import vector_index_builder
+
+
+INDEX_PREFIX = 'quantization_sweep'
+SPACE_TYPE = 'l2'
+DEFAULT_PQ_M = [8, 16, 32, 48]
+DEFAULT_PQ_CODE_SIZE = [8]
+# The HNSW graph for the flat and SQ indices, and the query-time parameters.
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 128
+DEFAULT_EF_SEARCH = 100
+DEFAULT_NPROBES = 8
+PROJECTED_VECTORS = [10_000_000, 100_000_000]
+
+SQ_ENCODERS = {
+  "sq_fp16": {"name": "sq", "parameters": {"type": "fp16", "clip": False}},
+  "sq_fp16_clip": {"name": "sq", "parameters": {"type": "fp16", "clip": True}},
+}
+
+
+def code_bytes(dimension, encoder, pq_m=None, pq_code_size=None):
+  '''Bytes per vector for the encoded vector alone, without graph links or
+  list overhead.'''
+  if encoder == 'pq':
+    return pq_m * pq_code_size / 8
+  if encoder.startswith('sq_fp16'):
+    return dimension * 2
+  return dimension * 4
+
+
+def _hnsw_field(dimension, encoder=None):
+  parameters = {"m": HNSW_M, "ef_construction": HNSW_EF_CONSTRUCTION}
+  if encoder:
+    parameters['encoder'] = encoder
+  return {vector_index_builder.FIELD_NAME: {
+    "type": "knn_vector",
+    "dimension": dimension,
+    "method": {"name": "hnsw", "engine": "faiss", "space_type": SPACE_TYPE,
+               "parameters": parameters}}}
+
+
+def _row(name, n_vectors, dimension, build, memory_kb, metrics, train_seconds=0.0,
+         **config):
+  bytes_per_vector = memory_kb * 1024 / n_vectors
+  row = {"config": name,
+         "code_bytes": code_bytes(dimension, **config),
+         "bytes_per_vector": bytes_per_vector,
+         "train_seconds": train_seconds,
+         "index_seconds": build['index_seconds'],
+         "merge_seconds": build['merge_seconds']}
+  row.update(metrics)
+  for projected in PROJECTED_VECTORS:
+    row[f"gb_at_{projected // 1_000_000}m"] = bytes_per_vector * projected / 2**30
+  return row
+
+
+def main(queries_file, pq_ms=DEFAULT_PQ_M, pq_code_sizes=DEFAULT_PQ_CODE_SIZE,
+         include_sq=True, nlist=None, nprobes=DEFAULT_NPROBES,
+         ef_search=DEFAULT_EF_SEARCH, k=10, source_index=None, seed=0,
+         output_path=None):
+  os_client = OSClientFactory().client()
+  corpus_ids, corpus = vector_cache.corpus_vectors(
+    os_client, index_name=source_index or vector_cache.DEFAULT_SOURCE_INDEX)
+  texts = [query['query'] for query in batch_search.read_queries(queries_file)]
+  query_matrix = vector_cache.query_vectors(os_client, texts)
+  truth = recall_benchmark.ground_truth(corpus_ids, corpus, query_matrix, k,
+                                        SPACE_TYPE)
+  n_vectors, dimension = corpus.shape
+  rows = []
+
+  # HNSW with float32 vectors, and with each SQ encoder
+  hnsw_encoders = [('flat', None)]
+  if include_sq:
+    hnsw_encoders.extend(SQ_ENCODERS.items())
+  for name, encoder in hnsw_encoders:
+    index_name = f'{INDEX_PREFIX}_{name}'
+    build = vector_index_builder.build_index(
+      os_client, index_name, _hnsw_field(dimension, encoder), corpus_ids, corpus)
+    memory_kb = vector_index_builder.native_memory_kb(os_client, index_name)
+    logging.info(f"Measuring {index_name}")
+    metrics = recall_benchmark.measure_knn(
+      os_client, index_name, query_matrix, truth, k,
+      method_parameters={"ef_search": ef_search})
+    rows.append(_row(name, n_vectors, dimension, build, memory_kb, metrics,
+                     encoder=name))
+    os_client.indices.delete(index=index_name)
+
+  # IVF-PQ, one trained model per (m, code_size)
+  nlist = nlist or int(round(math.sqrt(n_vectors)))
+  rng = np.random.default_rng(seed)
+  for pq_m in pq_ms:
+    if dimension % pq_m:
+      logging.warning(f"Skipping PQ m={pq_m}, it doesn't divide {dimension}")
+      continue
+    for pq_code_size in pq_code_sizes:
+      name = f'pq{pq_m}x{pq_code_size}'
+      index_name = f'{INDEX_PREFIX}_{name}'
+      _, train_seconds = ivf_tuning.train_ivf_model(
+        os_client, index_name, corpus_ids, corpus, nlist, pq_m, pq_code_size,
+        rng, training_index=f'{INDEX_PREFIX}_training')
+      build = vector_index_builder.build_index(
+        os_client, index_name,
+        {vector_index_builder.FIELD_NAME: {"type": "knn_vector",
+                                           "model_id": index_name}},
+        corpus_ids, corpus)
+      memory_kb = vector_index_builder.native_memory_kb(os_client, index_name)
+      logging.info(f"Measuring {index_name}")
+      metrics = recall_benchmark.measure_knn(
+        os_client, index_name, query_matrix, truth, k,
+        method_parameters={"nprobes": nprobes})
+      rows.append(_row(name, n_vectors, dimension, build, memory_kb, metrics,
+                       train_seconds, encoder='pq', pq_m=pq_m,
+                       pq_code_size=pq_code_size))
+      os_client.indices.delete(index=index_name)
+      vector_index_builder.delete_knn_model(os_client, index_name)
+  if os_client.indices.exists(index=f'{INDEX_PREFIX}_training'):
+    os_client.indices.delete(index=f'{INDEX_PREFIX}_training')
+
+  columns = ['config', 'code_bytes', 'bytes_per_vector', 'train_seconds',
+             'index_seconds', 'latency_p50', 'latency_p99', 'recall'] + \
+            [f"gb_at_{n // 1_000_000}m" for n in PROJECTED_VECTORS]
+  print(f"\n{n_vectors} vectors, dimension {dimension}, IVF-PQ nlist={nlist} "
+        f"nprobes={nprobes}, HNSW ef_search={ef_search}")
+  print(bench_utils.format_table(rows, columns))
+  if output_path:
+    bench_utils.write_json(output_path, {"k": k, "nlist": nlist,
+                                         "nprobes": nprobes,
+                                         "ef_search": ef_search, "rows": rows})
+  return rows
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Builds indices with PQ and SQ encoder settings and reports "
+      "memory per vector, indexing time, latency, recall, and projected memory "
+      "at 10M and 100M vectors.",
+  )
+  parser.add_argument("--queries-file", required=True, action="store")
+  parser.add_argument("--pq-m", nargs='*', type=int, default=DEFAULT_PQ_M)
+  parser.add_argument("--pq-code-size", nargs='+', type=int,
+                      default=DEFAULT_PQ_CODE_SIZE)
+  parser.add_argument("--no-sq", default=False, action="store_true",
+                      help="Skip the SQ encoders")
+  parser.add_argument("--nlist", default=None, type=int,
+                      help="IVF lists for the PQ models, defaults to sqrt(N)")
+  parser.add_argument("--nprobes", default=DEFAULT_NPROBES, type=int)
+  parser.add_argument("--ef-search", default=DEFAULT_EF_SEARCH, type=int)
+  parser.add_argument("--k", default=10, type=int)
+  parser.add_argument("--source-index", default=None, action="store")
+  parser.add_argument("--seed", default=0, type=int)
+  parser.add_argument("--output", default=None, action="store")
+  args = parser.parse_args()
+  main(queries_file=args.queries_file,
+       pq_ms=args.pq_m,
+       pq_code_sizes=args.pq_code_size,
+       include_sq=not args.no_sq,
+       nlist=args.nlist,
+       nprobes=args.nprobes,
+       ef_search=args.ef_search,
+       k=args.k,
+       source_index=args.source_index,
+       seed=args.seed,
+       output_path=args.output)
@@ -0,0 +1,98 @@
+'''
+Client-side cache of sparse query tokens.
+
+A neural_sparse query with query_text and model_id makes OpenSearch run the
+model on the query text for every request: the tokenizer in doc-only mode, the
+encoder in bi-encoder mode. The query can instead carry the token weights
+itself, in query_tokens. QueryTokenCache computes those weights with batched
+_predict calls and keeps them in an LRU cache, so a repeated query costs no
+model call at all.
+
+Cache keys are normalized query text (lower case, whitespace collapsed). In
+doc-only mode that doesn't change the tokens, since the tokenizer is
+uncased. For a cased encoder model, use a cache per casing, or pass
+normalize=False.
+'''
+
+
+from collections import OrderedDict
+import logging
+import model_utils
+from opensearchpy import OpenSearch
+
+
+DEFAULT_MAX_SIZE = 10000
+
+
+def normalize_text(text):
+  '''The cache key for a query text.'''
+  return ' '.join(text.lower().split())
+
+
+class QueryTokenCache:
+  '''
+  LRU cache of {token: weight} maps for query texts.
+
+  Args:
+      os_client (OpenSearch): Client for the _predict calls
+      model_id (str): The tokenizer model (doc-only) or the sparse encoder
+      function_name (str): sparse_tokenize for a tokenizer, sparse_encoding
+          for an encoder
+      max_size (int): Query texts to keep
+      normalize (bool): Key the cache by normalized text
+  '''
+  def __init__(self, os_client: OpenSearch, model_id,
+               function_name='sparse_tokenize', max_size=DEFAULT_MAX_SIZE,
+               normalize=True):
+    self.os_client = os_client
+    self.model_id = model_id
+    self.function_name = function_name
+    self.max_size = max_size
+    self.normalize = normalize
+    self.hits = 0
+    self.misses = 0
+    self._tokens = OrderedDict()
+
+  def _key(self, text):
+    return normalize_text(text) if self.normalize else text
+
+  def _put(self, key, tokens):
+    self._tokens[key] = tokens
+    self._tokens.move_to_end(key)
+    while len(self._tokens) > self.max_size:
+      self._tokens.popitem(last=False)
+
+  def get(self, text):
+    '''The query tokens for one text.'''
+    return self.get_many([text])[0]
+
+  def get_many(self, texts):
+    '''The query tokens for each text, in order. Texts that aren't cached are
+    sent to the model together, in batched _predict calls.'''
+    keys = [self._key(text) for text in texts]
+    missing = []
+    seen = set()
+    for key in keys:
+      if key in self._tokens or key in seen:
+        self.hits += 1
+        if key in self._tokens:
+          self._tokens.move_to_end(key)
+      else:
+        missing.append(key)
+        seen.add(key)
+    if missing:
+      self.misses += len(missing)
+      logging.info(f"Tokenizing {len(missing)} queries, "
+                   f"{len(keys) - len(missing)} cached")
+      for key, tokens in zip(missing, model_utils.create_sparse_embeddings(
+          self.os_client, self.model_id, missing, self.function_name)):
+        self._put(key, tokens)
+    # With more texts than max_size, early texts may already be evicted
+    return [self._tokens[key] if key in self._tokens else self._fetch(key)
+            for key in keys]
+
+  def _fetch(self, key):
+    tokens = model_utils.create_sparse_embeddings(
+      self.os_client, self.model_id, [key], self.function_name)[0]
+    self._put(key, tokens)
+    return tokens
@@ -0,0 +1,124 @@
+'''
+Context trimming for the converse.py RAG prompt.
+
+The retrieval_augmented_generation processor puts the full title and plot of
+each of the context_size hits into the LLM prompt. LLM latency and cost grow
+with the prompt, and most of each plot has nothing to do with the question.
+This module builds the prompt on the client instead, from snippets:
+
+    - highlight: the plot fragments that OpenSearch highlights for the query
+    - sentences: the plot sentences that share the most terms with the
+      question, top sentences_per_hit per hit
+
+Snippets are added hit by hit, in rank order, until the prompt reaches the
+token budget. Tokens are estimated at 4 characters each, which is close
+enough for English text and the usual BPE tokenizers.
+
+Functions:
+    estimate_tokens(text): Approximate token count
+    top_sentences(text, question, n): The n sentences that best match
+    hit_snippets(hit, question, mode, sentences_per_hit): Snippets for a hit
+    full_context(hits): Untrimmed context, for comparison
+    build_context(hits, question, mode, token_budget): Trimmed context
+    build_prompt(context, question, history): The prompt for the LLM
+'''
+
+
+import math
+import re
+
+
+CHARS_PER_TOKEN = 4
+DEFAULT_TOKEN_BUDGET = 400
+DEFAULT_SENTENCES_PER_HIT = 2
+TRIM_MODES = ['highlight', 'sentences']
+
+# Highlighting for the plot field, for the highlight mode.
+HIGHLIGHT = {
+  "pre_tags": [""],
+  "post_tags": [""],
+  "fields": {
+    "plot": {"fragment_size": 150, "number_of_fragments": 3, "order": "score"}
+  }
+}
+
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+_WORD = re.compile(r'\w+')
+
+
+def estimate_tokens(text):
+  '''Approximate number of LLM tokens in text.'''
+  return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _terms(text):
+  return {term.lower() for term in _WORD.findall(text) if len(term) > 2}
+
+
+def top_sentences(text, question, n=DEFAULT_SENTENCES_PER_HIT):
+  '''The n sentences of text that share the most terms with question, in
+  their original order. Sentences with no terms in common are left out,
+  unless none match, and then it's the first sentence.'''
+  sentences = [sentence for sentence in _SENTENCE_END.split(text or '') if sentence]
+  query_terms = _terms(question)
+  overlap = [len(_terms(sentence) & query_terms) for sentence in sentences]
+  ranked = sorted((i for i in range(len(sentences)) if overlap[i]),
+                  key=lambda i: overlap[i], reverse=True)
+  if not ranked:
+    return sentences[:1]
+  return [sentences[i] for i in sorted(ranked[:n])]
+
+
+def hit_snippets(hit, question, mode, sentences_per_hit=DEFAULT_SENTENCES_PER_HIT):
+  '''The plot snippets for one hit. A hit with no highlight falls back to its
+  best sentences.'''
+  if mode not in TRIM_MODES:
+    raise ValueError(f'Unknown trim mode {mode}')
+  if mode == 'highlight' and hit.get('highlight', {}).get('plot'):
+    return hit['highlight']['plot']
+  return top_sentences(hit['_source'].get('plot'), question, sentences_per_hit)
+
+
+def _result(position, title, text):
+  return f"SEARCH RESULT {position}: {title}\n{text}"
+
+
+def full_context(hits):
+  '''The context as the processor builds it, with full titles and plots.'''
+  return '\n'.join(_result(position, hit['_source'].get('title'),
+                           hit['_source'].get('plot'))
+                   for position, hit in enumerate(hits, start=1))
+
+
+def build_context(hits, question, mode, token_budget=DEFAULT_TOKEN_BUDGET,
+                  sentences_per_hit=DEFAULT_SENTENCES_PER_HIT):
+  '''The context from each hit's title and snippets, in rank order, stopping
+  at the first snippet that would go over token_budget.'''
+  results = []
+  used = 0
+  for position, hit in enumerate(hits, start=1):
+    snippets = []
+    title = hit['_source'].get('title') or ''
+    for snippet in hit_snippets(hit, question, mode, sentences_per_hit):
+      cost = estimate_tokens(snippet) + (0 if snippets else estimate_tokens(title))
+      if used + cost > token_budget:
+        break
+      snippets.append(snippet)
+      used += cost
+    if not snippets:
+      break
+    results.append(_result(position, title, ' ... '.join(snippets)))
+  return '\n'.join(results)
+
+
+def build_prompt(context, question, system_prompt, user_instructions, history=()):
+  '''The prompt for the LLM, laid out like the
+  retrieval_augmented_generation processor's. history is a list of
+  (question, answer) pairs, oldest first.'''
+  parts = [system_prompt, user_instructions, "SEARCH RESULTS:", context]
+  if history:
+    parts.append("CONVERSATION HISTORY:")
+    parts.extend(f"QUESTION: {past_question}\nANSWER: {answer}"
+                 for past_question, answer in history)
+  parts.append(f"QUESTION: {question}")
+  return '\n\n'.join(parts)
@@ -0,0 +1,279 @@
+"""
+Recall@k benchmark for the ch10 approximate kNN indices.
+
+The approximate methods (HNSW, IVF, IVF-PQ, Faiss SQ, on-disk with 32x
+compression) trade accuracy for speed and memory. This benchmark measures how
+much accuracy. It computes the exact top k for each query locally, with blocked
+NumPy matrix products over the corpus vectors, and scores each index's knn
+results against that ground truth with recall@k and nDCG@k.
+
+The ground truth uses each index's space_type (read from its mapping, or from
+the trained model for the IVF indices), so an l2 index is compared with exact
+l2 neighbors and a cosinesimil index with exact cosine neighbors.
+
+Documents are matched across indices by the movie id field (see
+vector_cache.py), since every index has its own _ids.
+
+Usage:
+    python recall_benchmark.py --queries-file queries.txt
+    python recall_benchmark.py --queries-file queries.txt --targets hnsw ivf_pq \\
+        --k 10 100 --output recall.json
+
+Functions:
+    exact_top_k(corpus, queries, k, space_type): Indices of the exact top k
+    recall_at_k(truth, results, k): Mean recall@k
+    ndcg_at_k(truth, results, k): Mean nDCG@k
+    search_ids(os_client, index_name, bodies): Movie ids for each query
+    measure_knn(os_client, index_name, query_matrix, truth, k): Recall and
+        latency for one index configuration, used by the parameter sweeps
+    measure_bodies(os_client, index_name, bodies, truth, k): The same, for
+        prebuilt query bodies
+"""
+
+
+import argparse
+import batch_search
+from bench_utils import BENCH_TARGETS
+import bench_utils
+import logging
+import math
+import numpy as np
+from opensearchpy import OpenSearch
+from os_client_factory import OSClientFactory
+import vector_cache
+
+
+# Rows of queries and corpus vectors per matrix product. The score matrix for
+# one block is QUERY_BLOCK x CORPUS_BLOCK float32s, 64MB with these values.
+QUERY_BLOCK = 1024
+CORPUS_BLOCK = 16384
+DEFAULT_TARGETS = ['hnsw', 'ivf', 'ivf_pq', 'sq', 'on_disk']
+
+
+def _normalize(vectors):
+  norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+  norms[norms == 0] = 1.0
+  return vectors / norms
+
+
+def exact_top_k(corpus, queries, k, space_type='l2',
+                query_block=QUERY_BLOCK, corpus_block=CORPUS_BLOCK):
+  '''Returns an int64 matrix with the row numbers in corpus of the exact k
+  nearest neighbors of each query, nearest first. space_type is l2,
+  cosinesimil or innerproduct. Works through the corpus in blocks, keeping a
+  running top k per query, so memory stays bounded for large corpora.'''
+  k = min(k, len(corpus))
+  if space_type == 'cosinesimil':
+    corpus = _normalize(corpus)
+    queries = _normalize(queries)
+  elif space_type not in ('l2', 'innerproduct'):
+    raise ValueError(f'Unsupported space_type {space_type}')
+  # For l2, ||q||^2 is the same for every candidate of a query, so ranking by
+  # 2 q.c - ||c||^2 is the same as ranking by smallest distance.
+  corpus_norms = (corpus * corpus).sum(axis=1) if space_type == 'l2' else None
+
+  result = np.empty((len(queries), k), dtype=np.int64)
+  for q_start in range(0, len(queries), query_block):
+    q = queries[q_start:q_start + query_block]
+    best_scores = np.full((len(q), k), -np.inf, dtype=np.float32)
+    best_rows = np.zeros((len(q), k), dtype=np.int64)
+    for c_start in range(0, len(corpus), corpus_block):
+      block = corpus[c_start:c_start + corpus_block]
+      scores = q @ block.T
+      if corpus_norms is not None:
+        scores = 2 * scores - corpus_norms[c_start:c_start + len(block)]
+      rows = np.broadcast_to(np.arange(c_start, c_start + len(block)),
+                             scores.shape)
+      merged_scores = np.concatenate([best_scores, scores], axis=1)
+      merged_rows = np.concatenate([best_rows, rows], axis=1)
+      top = np.argpartition(-merged_scores, k - 1, axis=1)[:, :k]
+      best_scores = np.take_along_axis(merged_scores, top, axis=1)
+      best_rows = np.take_along_axis(merged_rows, top, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    result[q_start:q_start + len(q)] = np.take_along_axis(best_rows, order, axis=1)
+  return result
+
+
+def recall_at_k(truth, results, k):
+  '''Mean fraction of the true top k that appears in the returned top k.
+  truth and results are lists of id lists, one per query. A query with no true
+  neighbors counts as full recall.'''
+  total = 0.0
+  for true_ids, result_ids in zip(truth, results):
+    # A filtered query can have fewer than k true neighbors.
+    expected = min(k, len(true_ids))
+    if expected:
+      total += len(set(true_ids[:k]) & set(result_ids[:k])) / expected
+    else:
+      total += 1.0
+  return total / len(truth) if truth else None
+
+
+def ndcg_at_k(truth, results, k):
+  '''Mean nDCG@k. A document's gain is k minus its rank in the true top k (so
+  the true nearest neighbor has gain k), and 0 outside the true top k.'''
+  discounts = [1.0 / math.log2(rank + 2) for rank in range(k)]
+  total = 0.0
+  for true_ids, result_ids in zip(truth, results):
+    gains = {doc_id: k - rank for rank, doc_id in enumerate(true_ids[:k])}
+    ideal = sum((k - rank) * discounts[rank] for rank in range(len(gains)))
+    dcg = sum(gains.get(doc_id, 0) * discounts[rank]
+              for rank, doc_id in enumerate(result_ids[:k]))
+    total += dcg / ideal if ideal else 1.0
+  return total / len(truth) if truth else None
+
+
+def space_type_for(os_client: OpenSearch, index_name, field=vector_cache.DEFAULT_FIELD):
+  '''Reads the space_type for a knn_vector field from the index mapping, or
+  from the trained model for model-based (IVF) fields. Defaults to l2, the
+  k-NN plugin's default.'''
+  mapping = os_client.indices.get_mapping(index=index_name)
+  # The response is keyed by the concrete index, which differs from
+  # index_name when index_name is an alias.
+  properties = next(iter(mapping.values()))['mappings']['properties']
+  field_mapping = properties.get(field, {})
+  if 'space_type' in field_mapping:
+    return field_mapping['space_type']
+  if 'space_type' in field_mapping.get('method', {}):
+    return field_mapping['method']['space_type']
+  if 'model_id' in field_mapping:
+    model = os_client.transport.perform_request(
+      'GET', f"/_plugins/_knn/models/{field_mapping['model_id']}")
+    return model.get('space_type', 'l2')
+  return 'l2'
+
+
+def search_ids(os_client: OpenSearch, index_name, bodies,
+               batch_size=batch_search.MSEARCH_BATCH_SIZE):
+  '''Runs the query bodies with _msearch and returns (ids, tooks): the movie
+  ids of each query's hits, in rank order, and each query's took in ms.'''
+  ids = []
+  tooks = []
+  for response in batch_search.msearch(os_client, index_name, bodies, batch_size):
+    if 'error' in response:
+      raise RuntimeError(f"Query against {index_name} failed: {response['error']}")
+    ids.append([hit['fields']['id'][0] for hit in response['hits']['hits']])
+    tooks.append(response['took'])
+  return ids, tooks
+
+
+def id_query_bodies(os_client: OpenSearch, target, query_matrix, k, **slot_values):
+  '''Query bodies for the target that return k hits with just the movie id.
+  slot_values go to bench_utils.KNN_QUERY, e.g. method_parameters.'''
+  bodies = bench_utils.query_bodies(os_client, target, None, k=k,
+                                    vectors=query_matrix.tolist(), **slot_values)
+  return [dict(body, size=k, _source=False, docvalue_fields=["id"])
+          for body in bodies]
+
+
+def ground_truth(corpus_ids, corpus, query_matrix, k, space_type='l2'):
+  '''Returns the movie ids of the exact top k for each query.'''
+  return corpus_ids[exact_top_k(corpus, query_matrix, k, space_type)].tolist()
+
+
+def measure_knn(os_client: OpenSearch, index_name, query_matrix, truth, k,
+                **slot_values):
+  '''Runs knn queries against index_name one at a time and returns recall@k,
+  nDCG@k, client latency and server took (ms). The parameter sweeps use this
+  to score each configuration. slot_values go to bench_utils.KNN_QUERY.'''
+  bodies = id_query_bodies(os_client, BENCH_TARGETS['hnsw'], query_matrix, k,
+                           **slot_values)
+  return measure_bodies(os_client, index_name, bodies, truth, k)
+
+
+def measure_bodies(os_client: OpenSearch, index_name, bodies, truth, k):
+  '''measure_knn for query bodies you've built yourself. Each body has to
+  return the movie id in docvalue_fields, see id_query_bodies.'''
+  responses, latencies = bench_utils.timed_searches(os_client, index_name, bodies)
+  results = [[hit['fields']['id'][0] for hit in response['hits']['hits']]
+             for response in responses]
+  latency = bench_utils.latency_summary(latencies)
+  took = bench_utils.latency_summary([response['took'] for response in responses])
+  return {"recall": recall_at_k(truth, results, k),
+          "ndcg": ndcg_at_k(truth, results, k),
+          "latency_mean": latency['mean'],
+          "latency_p50": latency['p50'],
+          "latency_p99": latency['p99'],
+          "took_mean": took['mean'],
+          "took_p99": took['p99']}
+
+
+def evaluate(os_client: OpenSearch, index_name, target, corpus_ids, corpus,
+             query_matrix, ks, space_type=None):
+  '''Runs the queries against index_name at each k and returns one row per k
+  with recall, nDCG and took. Pass space_type to skip reading it from the
+  index.'''
+  if space_type is None:
+    space_type = (target['space_type'] if target['query_type'] == 'script'
+                  else space_type_for(os_client, index_name))
+  truth = ground_truth(corpus_ids, corpus, query_matrix, max(ks), space_type)
+  rows = []
+  for k in ks:
+    results, tooks = search_ids(os_client, index_name,
+                                id_query_bodies(os_client, target, query_matrix, k))
+    took = bench_utils.latency_summary(tooks)
+    rows.append({"index": index_name, "space_type": space_type, "k": k,
+                 "queries": len(results),
+                 "recall": recall_at_k(truth, results, k),
+                 "ndcg": ndcg_at_k(truth, results, k),
+                 "took_mean": took['mean'], "took_p99": took['p99']})
+  return rows
+
+
+def main(queries_file, targets=None, ks=(10,), source_index=None,
+         refresh_cache=False, output_path=None):
+  os_client = OSClientFactory().client()
+  corpus_ids, corpus = vector_cache.corpus_vectors(
+    os_client, index_name=source_index or vector_cache.DEFAULT_SOURCE_INDEX,
+    refresh=refresh_cache)
+  texts = [query['query'] for query in batch_search.read_queries(queries_file)]
+  query_matrix = vector_cache.query_vectors(os_client, texts, refresh=refresh_cache)
+  logging.info(f"{len(corpus)} corpus vectors, {len(query_matrix)} queries")
+
+  report = {}
+  for target_name in targets or DEFAULT_TARGETS:
+    target = BENCH_TARGETS[target_name]
+    if not os_client.indices.exists(index=target['index']):
+      logging.warning(f"Index {target['index']} does not exist, skipping {target_name}")
+      continue
+    rows = evaluate(os_client, target['index'], target, corpus_ids, corpus,
+                    query_matrix, sorted(ks))
+    report[target_name] = rows
+    print(f"\n{target_name} ({target['index']})")
+    print(bench_utils.format_table(
+      rows, ['k', 'space_type', 'queries', 'recall', 'ndcg', 'took_mean', 'took_p99']))
+  if output_path:
+    bench_utils.write_json(output_path, report)
+  return report
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Measures recall@k and nDCG@k of the approximate kNN "
+      "indices against exact nearest neighbors computed locally.",
+  )
+  parser.add_argument("--queries-file", required=True, action="store")
+  parser.add_argument("--targets", nargs='+', default=DEFAULT_TARGETS,
+                      choices=sorted(t for t, v in BENCH_TARGETS.items()
+                                     if v['query_type'] != 'neural_sparse'))
+  parser.add_argument("--k", nargs='+', type=int, default=[10])
+  parser.add_argument("--source-index", default=None, action="store",
+                      help="Index to read the corpus vectors from, defaults to "
+                      f"{vector_cache.DEFAULT_SOURCE_INDEX}")
+  parser.add_argument("--refresh-cache", default=False, action="store_true",
+                      help="Re-read the corpus and re-embed the queries")
+  parser.add_argument("--output", default=None, action="store")
+  args = parser.parse_args()
+  main(queries_file=args.queries_file,
+       targets=args.targets,
+       ks=args.k,
+       source_index=args.source_index,
+       refresh_cache=args.refresh_cache,
+       output_path=args.output)
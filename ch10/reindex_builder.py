@@ -0,0 +1,255 @@
+"""
+Builds approximate k-NN index variants from an index that already holds the
+vectors.
+
+Each approximate script builds its index from raw text, running the embedding
+model on every document through the ingest pipeline. When you only want to try
+a different knn_vector method (another HNSW setting, an encoder, on-disk mode,
+a trained IVF model), the vectors don't change. This script creates the new
+index and fills it from an existing one (exact_movies, say, or the IVF training
+index) with _reindex, so building the variant is pure graph construction.
+
+The reindex:
+    - runs sliced, splitting the copy into parallel sub-tasks, one per
+      processor on the data nodes by default. slices=auto would pick one
+      slice per source shard, and the example indices have a single shard
+      (index_utils.BASE_SETTINGS), so it would copy sequentially
+    - sets the destination pipeline to _none, which skips the index's
+      default_pipeline. Without that, an index created by one of the example
+      scripts would run the embedding model again for every document
+    - runs as a task, which the script polls to log progress and throughput
+
+Reindex copies _source, so the new index gets only the fields the source keeps
+in _source. index_utils.BASE_SETTINGS excludes id and most of the movie
+metadata from _source, so those don't carry over for the example indices.
+Documents keep their _id from the source index, so you can still line up
+results between the two.
+
+Usage:
+    python reindex_builder.py --dest-index movies_hnsw16 --method hnsw
+    python reindex_builder.py --source-index ivf_training --dest-index \\
+        movies_on_disk --method on_disk --vector-only
+    python reindex_builder.py --dest-index movies_ivf --model-id ivf_model
+"""
+
+
+import argparse
+import index_utils
+import json
+import logging
+from opensearchpy import OpenSearch
+from os_client_factory import OSClientFactory
+import shard_planner
+import time
+import vector_cache
+
+
+DEFAULT_SOURCE_INDEX = vector_cache.DEFAULT_SOURCE_INDEX
+DEFAULT_FIELD = vector_cache.DEFAULT_FIELD
+POLL_SECONDS = 5
+# Documents each slice reads per scroll batch. Larger batches mean fewer bulk
+# requests, but each carries size x dimension floats.
+BATCH_SIZE = 1000
+
+# knn_vector method definitions you can build by name. The dimension comes from
+# the source index.
+METHODS = {
+  "hnsw": {
+    "method": {"name": "hnsw", "engine": "faiss", "space_type": "l2",
+               "parameters": {"m": 16, "ef_construction": 128}}},
+  "hnsw_sq": {
+    "method": {"name": "hnsw", "engine": "faiss", "space_type": "l2",
+               "parameters": {"m": 16, "ef_construction": 128,
+                              "encoder": {"name": "sq",
+                                          "parameters": {"type": "fp16"}}}}},
+  "hnsw_lucene": {
+    "method": {"name": "hnsw", "engine": "lucene", "space_type": "l2",
+               "parameters": {"m": 16, "ef_construction": 128}}},
+  "on_disk": {"space_type": "l2", "data_type": "float", "mode": "on_disk",
+              "compression_level": "32x"},
+}
+
+
+def source_dimension(os_client: OpenSearch, index_name, field=DEFAULT_FIELD):
+  '''Reads the dimension of a knn_vector field from the index mapping, or from
+  the trained model for model-based fields.'''
+  mapping = os_client.indices.get_mapping(index=index_name)
+  field_mapping = next(iter(mapping.values()))['mappings']['properties'][field]
+  if 'dimension' in field_mapping:
+    return field_mapping['dimension']
+  model = os_client.transport.perform_request(
+    'GET', f"/_plugins/_knn/models/{field_mapping['model_id']}")
+  return model['dimension']
+
+
+def vector_field(dimension=None, method=None, model_id=None):
+  '''The knn_vector mapping for the destination. Pass a trained model's id,
+  or a method (a name from METHODS or a field definition dict) and the
+  dimension.'''
+  if model_id:
+    return {"type": "knn_vector", "model_id": model_id}
+  definition = METHODS[method] if isinstance(method, str) else method
+  return dict({"type": "knn_vector", "dimension": dimension}, **definition)
+
+
+def cluster_slices(os_client: OpenSearch):
+  '''One slice per data node processor, whatever the source's shard count.'''
+  nodes = shard_planner.data_nodes(os_client)
+  return max(1, sum(node['processors'] or 1 for node in nodes))
+
+
+def parse_slices(value):
+  '''--slices: a slice count, or auto for one slice per source shard.'''
+  return value if value == 'auto' else int(value)
+
+
+def _task_status(os_client: OpenSearch, task_id):
+  response = os_client.tasks.get(task_id=task_id)
+  return response.get('completed', False), response['task']['status'], response
+
+
+def reindex(os_client: OpenSearch, source_index, dest_index, fields=None,
+            slices=None, requests_per_second=None, batch_size=BATCH_SIZE,
+            poll_seconds=POLL_SECONDS, script=None):
+  '''
+  Copies source_index into dest_index with a sliced _reindex task that skips
+  the destination's default_pipeline, logging progress until it completes.
+  dest_index must already exist with the mapping you want.
+
+  Args:
+      fields (list): Copy only these _source fields, e.g. just the vector.
+          Defaults to the whole _source
+      slices: Parallel slices, an int or 'auto' (one per source shard).
+          Defaults to cluster_slices
+      requests_per_second (float): Throttle, defaults to unthrottled
+      script (dict): A Painless script to transform each document on the
+          way, e.g. to prune sparse vectors
+
+  Returns:
+      dict: docs, seconds, docs_per_second
+  '''
+  source = {"index": source_index, "size": batch_size}
+  if fields:
+    source['_source'] = fields
+  if slices is None:
+    slices = cluster_slices(os_client)
+  params = {"wait_for_completion": "false", "slices": slices, "refresh": "true"}
+  if requests_per_second:
+    params['requests_per_second'] = requests_per_second
+
+  start = time.perf_counter()
+  body = {"source": source,
+          "dest": {"index": dest_index, "pipeline": "_none"}}
+  if script:
+    body['script'] = script
+  task = os_client.transport.perform_request('POST', '/_reindex', params=params,
+                                             body=body)
+  task_id = task['task']
+  logging.info(f"Reindexing {source_index} into {dest_index} with {slices} "
+               f"slices, task {task_id}")
+
+  completed, status, response = _task_status(os_client, task_id)
+  while not completed:
+    time.sleep(poll_seconds)
+    completed, status, response = _task_status(os_client, task_id)
+    done = status.get('created', 0) + status.get('updated', 0)
+    total = status.get('total') or 0
+    elapsed = time.perf_counter() - start
+    logging.info(f"Reindexed {done} / {total} docs "
+                 f"({100 * done / total if total else 0:.0f}%), "
+                 f"{done / elapsed:.0f} docs/s")
+
+  seconds = time.perf_counter() - start
+  result = response.get('response', {})
+  if response.get('error') or result.get('failures'):
+    raise Exception(f"Reindex into {dest_index} failed: "
+                    f"{response.get('error') or result['failures'][:5]}")
+  docs = result.get('created', 0) + result.get('updated', 0)
+  logging.info(f"Reindexed {docs} docs in {seconds:.1f}s, "
+               f"{docs / seconds:.0f} docs/s")
+  return {"docs": docs, "seconds": seconds, "docs_per_second": docs / seconds}
+
+
+def build_from_index(os_client: OpenSearch, source_index, dest_index,
+                     method=None, model_id=None, field=DEFAULT_FIELD,
+                     vector_only=False, force_merge=False, settings=None,
+                     **reindex_args):
+  '''Creates dest_index with the base movie mapping and a knn_vector field
+  built with method (or model_id), and fills it from source_index. Returns the
+  reindex timings, plus merge_seconds if you force merge.'''
+  field_mapping = vector_field(
+    dimension=None if model_id else source_dimension(os_client, source_index, field),
+    method=method, model_id=model_id)
+  index_utils.delete_then_create_index(os_client=os_client,
+                                       index_name=dest_index,
+                                       additional_fields={field: field_mapping},
+                                       additional_settings=settings)
+  result = reindex(os_client, source_index, dest_index,
+                   fields=[field] if vector_only else None, **reindex_args)
+  result['merge_seconds'] = None
+  if force_merge:
+    start = time.perf_counter()
+    os_client.indices.forcemerge(index=dest_index, max_num_segments=1,
+                                 request_timeout=3600)
+    result['merge_seconds'] = time.perf_counter() - start
+  return result
+
+
+def main(dest_index, source_index=DEFAULT_SOURCE_INDEX, method=None,
+         method_json=None, model_id=None, field=DEFAULT_FIELD,
+         vector_only=False, slices=None, requests_per_second=None,
+         force_merge=False):
+  os_client = OSClientFactory().client()
+  if method_json:
+    method = json.loads(method_json)
+  result = build_from_index(os_client, source_index, dest_index,
+                            method=method, model_id=model_id, field=field,
+                            vector_only=vector_only, force_merge=force_merge,
+                            slices=slices,
+                            requests_per_second=requests_per_second)
+  print(json.dumps(result, indent=2))
+  return result
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Creates a k-NN index with a new knn_vector method and fills "
+      "it from an existing vector index with a sliced _reindex, without "
+      "running the embedding model.",
+  )
+  parser.add_argument("--dest-index", required=True, action="store")
+  parser.add_argument("--source-index", default=DEFAULT_SOURCE_INDEX,
+                      action="store")
+  method_group = parser.add_mutually_exclusive_group(required=True)
+  method_group.add_argument("--method", choices=sorted(METHODS))
+  method_group.add_argument("--method-json", action="store",
+                            help="knn_vector field definition as JSON, without "
+                            "type and dimension")
+  method_group.add_argument("--model-id", action="store",
+                            help="Trained model (IVF, IVF-PQ) for the field")
+  parser.add_argument("--field", default=DEFAULT_FIELD, action="store")
+  parser.add_argument("--vector-only", default=False, action="store_true",
+                      help="Copy only the vector field")
+  parser.add_argument("--slices", default=None, type=parse_slices,
+                      help="Slice count, or auto for one per source shard. "
+                      "Defaults to the data nodes' processors")
+  parser.add_argument("--requests-per-second", default=None, type=float)
+  parser.add_argument("--force-merge", default=False, action="store_true")
+  args = parser.parse_args()
+  main(dest_index=args.dest_index,
+       source_index=args.source_index,
+       method=args.method,
+       method_json=args.method_json,
+       model_id=args.model_id,
+       field=args.field,
+       vector_only=args.vector_only,
+       slices=args.slices,
+       requests_per_second=args.requests_per_second,
+       force_merge=args.force_merge)
@@ -0,0 +1,265 @@
+"""
+Shard and replica planner for the movie indices.
+
+index_utils.BASE_SETTINGS (and ch5/load.py) create every index with one
+primary shard and one replica. A query runs on one thread per shard copy it
+searches, so a one-shard index uses one core per query no matter how large
+the index or the cluster is. Replicas add copies for queries to spread across.
+This planner sizes both from measurements:
+
+    1. It samples --sample-size movies from the source file and indexes them,
+       with a vector of the model's dimension in the embedding field (random
+       unit vectors, so no model is needed), into a scratch index with the
+       mapping of one of the example scripts. It force merges the index and
+       divides the primary store size by the document count to get the
+       indexed bytes per document.
+    2. It projects the primary size for --target-docs documents, and
+       recommends the number of primary shards that keeps each shard at or
+       under --max-shard-gb. When the data nodes' processors (from _nodes)
+       outnumber those shards, it adds shards, up to one per processor and
+       down to --min-shard-gb each, so a query uses more cores. That holds on
+       a single node too. Added shards come in multiples of the data nodes so
+       every node holds the same number of primaries; when the index is too
+       small for one --min-shard-gb shard per node, it adds none.
+    3. It recommends replicas from the data node count (from _nodes) and
+       --target-qps / --copy-qps, the query throughput one full copy of the
+       index sustains (measure it with load_generator.py). A replica can't
+       share a node with its primary, so replicas are capped at data nodes -
+       1. With more than one data node, it keeps at least one replica for
+       availability.
+
+It also checks the projected size with replicas against the data nodes' free
+disk, below the 85% low watermark.
+
+The planner samples ch10's movie_source with ch10's mappings only. ch5/load.py
+loads a different source file (movies_100k_LLM_generated.json) with its own
+mapping, so it is out of scope here: run ch5/load.py --benchmark, which
+reports the store size per mapping profile, and divide by the document count
+to get its bytes per document.
+
+Usage:
+    python shard_planner.py --target-docs 10000000
+    python shard_planner.py --target-docs 50000000 --method sq \\
+        --target-qps 400 --copy-qps 120 --model all-mpnet-base-v2
+"""
+
+
+import approximate_faiss_sq
+import approximate_hnsw
+import approximate_on_disk
+import argparse
+import bench_utils
+from copy import deepcopy
+import exact
+import index_utils
+import logging
+import math
+import model_utils
+import movie_source
+import numpy as np
+from opensearchpy import OpenSearch
+import opensearchpy.helpers
+from os_client_factory import OSClientFactory
+
+
+SAMPLE_INDEX_NAME = 'shard_planner_sample'
+DEFAULT_SAMPLE_SIZE = 2000
+DEFAULT_MAX_SHARD_GB = 30
+DEFAULT_MIN_SHARD_GB = 1
+DISK_WATERMARK = 0.85
+BULK_SIZE = 500
+
+# The vector field mappings of the example scripts. The IVF methods need a
+# trained model, so they aren't here; their size is close to sq's.
+METHOD_FIELDS = {
+  "exact": exact.KNN_FIELDS,
+  "hnsw": approximate_hnsw.FAISS_HNSW_FIELD,
+  "sq": approximate_faiss_sq.FAISS_SQ_FIELD,
+  "on_disk": approximate_on_disk.ON_DISK_FIELD,
+  "none": {},
+}
+
+
+def vector_fields(method, dimension):
+  '''The method's vector field mapping, at dimension.'''
+  fields = deepcopy(METHOD_FIELDS[method])
+  for mapping in fields.values():
+    if 'dimension' in mapping:
+      mapping['dimension'] = dimension
+  return fields
+
+
+def measure_bytes_per_doc(os_client: OpenSearch, method, dimension,
+                          sample_size=DEFAULT_SAMPLE_SIZE, seed=0):
+  '''Indexes a sample of the movies into a scratch index with the method's
+  mapping and returns its force merged primary store bytes per document. The
+  scratch index is deleted afterwards.'''
+  fields = vector_fields(method, dimension)
+  logging.info(f"Sampling {sample_size} movies")
+  sample = movie_source.sample_movies(sample_size, seed=seed)
+  rng = np.random.default_rng(seed)
+  vectors = rng.standard_normal((len(sample), dimension)).astype(np.float32)
+  vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+  index_utils.delete_then_create_index(
+    os_client=os_client,
+    index_name=SAMPLE_INDEX_NAME,
+    additional_fields=fields,
+    additional_settings={"number_of_replicas": 0})
+  try:
+    actions = []
+    for movie, vector in zip(sample, vectors.tolist()):
+      document = dict(movie, _index=SAMPLE_INDEX_NAME)
+      for field in fields:
+        document[field] = vector
+      actions.append(document)
+    logging.info(f"Indexing the sample into {SAMPLE_INDEX_NAME}")
+    opensearchpy.helpers.bulk(os_client, actions, chunk_size=BULK_SIZE,
+                              timeout=600, max_retries=10)
+    os_client.indices.refresh(index=SAMPLE_INDEX_NAME)
+    os_client.indices.forcemerge(index=SAMPLE_INDEX_NAME, max_num_segments=1,
+                                 request_timeout=3600)
+    stats = os_client.indices.stats(index=SAMPLE_INDEX_NAME, metric='store,docs')
+    primaries = stats['_all']['primaries']
+    return primaries['store']['size_in_bytes'] / primaries['docs']['count']
+  finally:
+    os_client.indices.delete(index=SAMPLE_INDEX_NAME)
+
+
+def data_nodes(os_client: OpenSearch):
+  '''One dict per data node, with its processors and available disk bytes.'''
+  info = os_client.nodes.info(metric='os')['nodes']
+  stats = os_client.nodes.stats(metric='fs')['nodes']
+  nodes = []
+  for node_id, node in info.items():
+    if 'data' not in node.get('roles', []):
+      continue
+    fs = stats.get(node_id, {}).get('fs', {}).get('total', {})
+    nodes.append({"name": node['name'],
+                  "processors": node['os'].get('allocated_processors',
+                                               node['os'].get('available_processors')),
+                  "total_bytes": fs.get('total_in_bytes', 0),
+                  "available_bytes": fs.get('available_in_bytes', 0)})
+  return nodes
+
+
+def plan(bytes_per_doc, target_docs, node_count, target_qps=None, copy_qps=None,
+         max_shard_gb=DEFAULT_MAX_SHARD_GB, min_shard_gb=DEFAULT_MIN_SHARD_GB,
+         processors_per_node=1):
+  '''Recommends shards and replicas. Returns a dict with the projected sizes,
+  the recommendation and the reasons for it. processors_per_node is the
+  smallest data node's processor count; concurrent queries share those cores,
+  so past one shard per processor more shards only add overhead.'''
+  primary_gb = bytes_per_doc * target_docs / 2**30
+  reasons = []
+  shards = max(1, math.ceil(primary_gb / max_shard_gb))
+  reasons.append(f"{shards} shard(s) keep each shard under {max_shard_gb} GB")
+  parallel = node_count * max(processors_per_node, 1)
+  raised = min(parallel, math.floor(primary_gb / min_shard_gb))
+  # Round down to a multiple of the data nodes. Fewer than one shard per node
+  # rounds to 0, so the index keeps its shards
+  raised -= raised % node_count
+  if raised > shards:
+    shards = raised
+    reasons.append(f"raised to {shards} so a query uses up to {parallel} "
+                   f"processor(s) on {node_count} data node(s), at "
+                   f"{min_shard_gb} GB or more per shard")
+  elif node_count > 1 and shards % node_count:
+    balanced = math.ceil(shards / node_count) * node_count
+    if primary_gb / balanced >= min_shard_gb:
+      shards = balanced
+      reasons.append(f"rounded up to {shards}, a multiple of the data nodes")
+
+  copies = 1
+  if target_qps and copy_qps:
+    copies = math.ceil(target_qps / copy_qps)
+    reasons.append(f"copies for {target_qps} qps at {copy_qps} qps each: {copies}")
+  replicas = copies - 1
+  if node_count > 1 and replicas < 1:
+    replicas = 1
+    reasons.append("1 replica for availability")
+  if replicas > max(node_count - 1, 0):
+    replicas = max(node_count - 1, 0)
+    reasons.append(f"capped at {replicas} replica(s): a replica can't share a "
+                   "node with its primary. Add nodes for more throughput")
+  return {"bytes_per_doc": bytes_per_doc,
+          "target_docs": target_docs,
+          "primary_gb": primary_gb,
+          "total_gb": primary_gb * (1 + replicas),
+          "data_nodes": node_count,
+          "processors_per_node": processors_per_node,
+          "shards": shards,
+          "shard_gb": primary_gb / shards,
+          "replicas": replicas,
+          "reasons": reasons}
+
+
+def main(target_docs, method='hnsw', model=exact.MODEL_SHORT_NAME,
+         sample_size=DEFAULT_SAMPLE_SIZE, target_qps=None, copy_qps=None,
+         max_shard_gb=DEFAULT_MAX_SHARD_GB, min_shard_gb=DEFAULT_MIN_SHARD_GB,
+         output_path=None):
+  os_client = OSClientFactory().client()
+  dimension = model_utils.DENSE_MODELS_HF[model]['dimensions']
+  bytes_per_doc = measure_bytes_per_doc(os_client, method, dimension, sample_size)
+  logging.info(f"Measured {bytes_per_doc:.0f} bytes per document ({method}, "
+               f"dimension {dimension})")
+  nodes = data_nodes(os_client)
+  processors = min((node['processors'] or 1 for node in nodes), default=1)
+  result = plan(bytes_per_doc, target_docs, max(len(nodes), 1), target_qps,
+                copy_qps, max_shard_gb, min_shard_gb, processors)
+  result.update(method=method, model=model, dimension=dimension)
+
+  available_gb = sum(node['available_bytes'] - node['total_bytes'] * (1 - DISK_WATERMARK)
+                     for node in nodes) / 2**30
+  result['available_gb'] = available_gb
+  if nodes and result['total_gb'] > available_gb:
+    logging.warning(f"The projected {result['total_gb']:.1f} GB with replicas is "
+                    f"more than the {available_gb:.1f} GB free below the disk "
+                    "watermark")
+
+  print(bench_utils.format_table([result], [
+    'method', 'dimension', 'bytes_per_doc', 'target_docs', 'primary_gb',
+    'total_gb', 'data_nodes', 'processors_per_node', 'shards', 'shard_gb', 'replicas']))
+  for reason in result['reasons']:
+    print(f"  - {reason}")
+  print(f'\nSettings: {{"number_of_shards": {result["shards"]}, '
+        f'"number_of_replicas": {result["replicas"]}}}')
+  if output_path:
+    bench_utils.write_json(output_path, result)
+  return result
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Measures indexed bytes per movie and recommends shard and "
+      "replica counts for a target document count and query load.",
+  )
+  parser.add_argument("--target-docs", required=True, type=int)
+  parser.add_argument("--method", default='hnsw', choices=sorted(METHOD_FIELDS))
+  parser.add_argument("--model", default=exact.MODEL_SHORT_NAME,
+                      choices=sorted(model_utils.DENSE_MODELS_HF),
+                      help="Sets the vector dimension")
+  parser.add_argument("--sample-size", default=DEFAULT_SAMPLE_SIZE, type=int)
+  parser.add_argument("--target-qps", default=None, type=float)
+  parser.add_argument("--copy-qps", default=None, type=float,
+                      help="Queries per second one copy of the index sustains")
+  parser.add_argument("--max-shard-gb", default=DEFAULT_MAX_SHARD_GB, type=float)
+  parser.add_argument("--min-shard-gb", default=DEFAULT_MIN_SHARD_GB, type=float)
+  parser.add_argument("--output", default=None, action="store")
+  args = parser.parse_args()
+  main(target_docs=args.target_docs,
+       method=args.method,
+       model=args.model,
+       sample_size=args.sample_size,
+       target_qps=args.target_qps,
+       copy_qps=args.copy_qps,
+       max_shard_gb=args.max_shard_gb,
+       min_shard_gb=args.min_shard_gb,
+       output_path=args.output)
@@ -1,12 +1,16 @@
 import argparse
 from auto_incrementing_counter import AutoIncrementingCounter
+import batch_search
 from copy import deepcopy
 import index_utils
 import logging
 import model_utils
 import movie_source
 from os_client_factory import OSClientFactory
+import opensearchpy.exceptions
 import opensearchpy.helpers
+from query_templates import QueryTemplate, Slot
+from query_token_cache import QueryTokenCache
 
 
 # NOTE: Much of the code is duplicated across the various examples. Better
@@ -15,8 +19,10 @@ import opensearchpy.helpers
 # and for the examples to be self-contained
 
 
-# Defines the index and pipelines created by the script.
+# Defines the index and pipelines created by the script. With --approximate,
+# the script builds SEISMIC_INDEX_NAME instead.
 INDEX_NAME = 'sparse_movies'
+SEISMIC_INDEX_NAME = 'sparse_movies_seismic'
 
 # Set the bulk size. If your indexing requests are timing out, make this
 # smaller.
@@ -55,6 +61,30 @@ KNN_FIELDS = {
 }
 
 
+# With --approximate, the embedding field is a sparse_vector with the seismic
+# approximate method instead (OpenSearch 3.3 and later, with the neural-search
+# plugin). Seismic clusters each token's postings list, keeping only its top
+# n_postings documents, and summarizes each cluster, so a query scores only
+# the clusters whose summaries look promising, rather than every posting of
+# every query token. Segments with fewer than approximate_threshold documents
+# are scored exactly. The index needs the index.sparse setting.
+SEISMIC_FIELDS = {
+  "embedding": {
+    "type": "sparse_vector",
+    "method": {
+      "name": "seismic",
+      "parameters": {
+        "n_postings": 300,
+        "cluster_ratio": 0.1,
+        "summary_prune_ratio": 0.4,
+        "approximate_threshold": 1000
+      }
+    }
+  }
+}
+SEISMIC_SETTINGS = {"sparse": True}
+
+
 # Definition for the ingest pipeline. Maps the EMBEDDING_SOURCE_FIELD to the
 # EMBEDDING_FIELD. OpenSearch neural plugin uses these fields for creating the
 # embedding as you ingest data.
@@ -89,23 +119,59 @@ search_pipeline_definition = {
 }
 
 
-sparse_query = {
+sparse_query = QueryTemplate({
   "query": {
     "neural_sparse": {
       EMBEDDING_FIELD_NAME: {
-        "query_text": "",
+        "query_text": Slot('query_text'),
         # This model id can be either the encoder model or the tokenizer model
-        "model_id": ""
+        "model_id": Slot('model_id')
       }
     }
   }
-}
+})
+
+
+# The query for the seismic index. top_n is the number of query tokens (by
+# weight) that select the clusters to visit, and heap_factor widens (above
+# 1.0) or narrows the search. Larger values raise recall and latency.
+sparse_ann_query = QueryTemplate({
+  "query": {
+    "neural_sparse": {
+      EMBEDDING_FIELD_NAME: {
+        "query_text": Slot('query_text'),
+        "model_id": Slot('model_id'),
+        "method_parameters": {
+          "k": Slot('k', default=10),
+          "top_n": Slot('top_n', default=10),
+          "heap_factor": Slot('heap_factor', default=1.0)
+        }
+      }
+    }
+  }
+})
+
+
+# The same query with the token weights precomputed on the client (see
+# query_token_cache.py), so that OpenSearch doesn't run the model per query.
+sparse_tokens_query = QueryTemplate({
+  "query": {
+    "neural_sparse": {
+      EMBEDDING_FIELD_NAME: {
+        "query_tokens": Slot('query_tokens')
+      }
+    }
+  }
+})
 
 
 # Main function. Finds or loads the embedding model, creates the index (unless
 # --skip-indexing is a command-line paramater), creates an embedding for the
 # query and then runs the exact query and prints the search response.
-def main(skip_indexing=False, bi_encoder=False, doc_only=False, user_query=None):
+def main(skip_indexing=False, bi_encoder=False, doc_only=False, user_query=None,
+         query_tokens=False, approximate=False,
+         queries_file=None, batch_size=batch_search.MSEARCH_BATCH_SIZE,
+         output_path='-', retain=index_utils.RETAINED_VERSIONS):
   logging.info(f"Query: {user_query}")
 
   # See os_client_factory.py for details on the set up for the opensearch-py
@@ -128,6 +194,10 @@ def main(skip_indexing=False, bi_encoder=False, doc_only=False, user_query=None)
     body=TOKENIZER_REGISTER_BODY
   )
 
+  # --approximate swaps in the seismic index and its query.
+  index_name = SEISMIC_INDEX_NAME if approximate else INDEX_NAME
+  text_query = sparse_ann_query if approximate else sparse_query
+
   # If you did not disable indexing, this will create a new index, set up an
   # ingest pipeline for automatically generating vector embeddings on ingest,
   # read the movies data (movie_source.py) and send it to the index.
@@ -143,37 +213,77 @@ def main(skip_indexing=False, bi_encoder=False, doc_only=False, user_query=None)
       'PUT', f'/_search/pipeline/{SEARCH_PIPELINE_NAME}',
       body=search_pipeline_definition)
 
-    # Create an index with the pipeline
-    logging.info(f"Creating index {INDEX_NAME}")
-    index_utils.delete_then_create_index(
-      os_client=os_client,
-      index_name=INDEX_NAME,
-      ingest_pipeline_name=INGEST_PIPELINE_NAME,
-      search_pipeline_name=SEARCH_PIPELINE_NAME,
-      additional_fields=KNN_FIELDS
-    )
+    # Create a new version of the index, with the pipeline, next to the live
+    # one. The two-phase search pipeline applies to rank_features only,
+    # seismic does its own pruning.
+    logging.info(f"Creating a new version of index {index_name}")
+    if approximate:
+      try:
+        version_name = index_utils.create_next_version(
+          os_client=os_client,
+          alias_name=index_name,
+          ingest_pipeline_name=INGEST_PIPELINE_NAME,
+          additional_fields=SEISMIC_FIELDS,
+          additional_settings=SEISMIC_SETTINGS
+        )
+      except opensearchpy.exceptions.RequestError as e:
+        raise RuntimeError(f"Could not create {index_name}. The sparse_vector "
+                           "field needs OpenSearch 3.3 or later with the "
+                           f"neural-search plugin: {e}") from e
+    else:
+      version_name = index_utils.create_next_version(
+        os_client=os_client,
+        alias_name=index_name,
+        ingest_pipeline_name=INGEST_PIPELINE_NAME,
+        search_pipeline_name=SEARCH_PIPELINE_NAME,
+        additional_fields=KNN_FIELDS
+      )
 
     # Read and add documents to the index with the opensearch-py bulk helper.
     logging.info(f"Indexing documents")
     counter = AutoIncrementingCounter()
-    for bulk in movie_source.bulks(BULK_SIZE, INDEX_NAME):
+    for bulk in movie_source.bulks(BULK_SIZE, version_name):
       logging.info(f"Indexing bulk {str(counter)} / {TOTAL_NUMBER_OF_BULKS}")
       opensearchpy.helpers.bulk(os_client, bulk, timeout=600, max_retries=10)
+
+    # Point the index_name alias, which all queries use, at the new version,
+    # and delete old versions (see index_utils.py)
+    index_utils.publish_version(os_client, index_name, version_name, retain)
   else:
     logging.info(f"Skipping indexing")
 
+  # With --query-tokens, the script computes the query's token weights itself,
+  # with the tokenizer in doc-only mode or the encoder in bi-encoder mode, and
+  # caches them by query text. Otherwise OpenSearch encodes the query text with
+  # the model_id model on every query.
+  token_cache = None
+  if query_tokens:
+    token_cache = QueryTokenCache(
+      os_client, tokenizer_id if doc_only else model_id,
+      function_name='sparse_tokenize' if doc_only else 'sparse_encoding')
+
+  # With --queries-file, run every query in the file as batched _msearch
+  # requests and write the results as NDJSON, instead of the single query.
+  if queries_file:
+    batch_search.run_queries_file(
+      os_client=os_client, index_name=index_name,
+      template=sparse_tokens_query if query_tokens else text_query,
+      queries_file=queries_file, output_path=output_path,
+      batch_size=batch_size, model_id=tokenizer_id if doc_only else model_id,
+      token_cache=token_cache)
+    return
+
   # Run a query. 
   logging.info(f"Running query")
-  if doc_only:
-    query = deepcopy(sparse_query)
-    query['query']['neural_sparse'][EMBEDDING_FIELD_NAME]['model_id'] = tokenizer_id
-  elif bi_encoder:
-    query = deepcopy(sparse_query)
-    query['query']['neural_sparse'][EMBEDDING_FIELD_NAME]['model_id'] = model_id
-  query['query']['neural_sparse'][EMBEDDING_FIELD_NAME]['query_text'] = \
-    user_query if user_query else "Sci-fi about the force and jedis"
+  user_query = user_query if user_query else "Sci-fi about the force and jedis"
+  if query_tokens:
+    query = sparse_tokens_query.build(query_tokens=token_cache.get(user_query))
+  else:
+    query = text_query.build(
+      query_text=user_query,
+      model_id=tokenizer_id if doc_only else model_id)
 
-  response = os_client.search(index=INDEX_NAME, body=query)
+  response = os_client.search(index=index_name, body=query)
 
   # Print the search response.
   logging.info(f"Query response")
@@ -199,8 +309,26 @@ if __name__ == "__main__":
   parser.add_argument("--skip-indexing", default=False, action="store_true")
   parser.add_argument("--bi-encoder", default=False, action="store_true")
   parser.add_argument("--doc-only", default=False, action="store_true")
+  parser.add_argument("--approximate", default=False, action="store_true",
+                      help="Use a seismic sparse_vector field for approximate "
+                      "sparse retrieval, in the sparse_movies_seismic index")
+  parser.add_argument("--query-tokens", default=False, action="store_true",
+                      help="Compute and cache the query tokens on the client, "
+                      "and send them as query_tokens")
   parser.add_argument("--query", default="Sci-fi about the force and jedis",
                       action="store")
+  parser.add_argument("--queries-file", default=None, action="store",
+                      help="Run every query in this file (one per line) with "
+                      "_msearch, instead of --query")
+  parser.add_argument("--batch-size", default=batch_search.MSEARCH_BATCH_SIZE,
+                      type=int, action="store",
+                      help="Queries per _msearch request for --queries-file")
+  parser.add_argument("--output", default="-", action="store",
+                      help="NDJSON results file for --queries-file, - for stdout")
+  parser.add_argument("--retain", default=index_utils.RETAINED_VERSIONS,
+                      type=int, action="store",
+                      help="Index versions to keep after the alias swap, "
+                      "including the live one")
   args = parser.parse_args()
   
   if (not args.bi_encoder and not args.doc_only) or \
@@ -212,4 +340,10 @@ if __name__ == "__main__":
   main(skip_indexing=args.skip_indexing,
        bi_encoder=args.bi_encoder,
        doc_only=args.doc_only,
-       user_query=args.query)
+       user_query=args.query,
+       query_tokens=args.query_tokens,
+       approximate=args.approximate,
+       queries_file=args.queries_file,
+       batch_size=args.batch_size,
+       output_path=args.output,
+       retain=args.retain)
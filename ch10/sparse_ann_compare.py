@@ -0,0 +1,130 @@
+"""
+Side-by-side latency and recall of approximate (seismic) and rank_features
+sparse retrieval.
+
+sparse.py builds the sparse_movies index with a rank_features field, which
+scores every posting of every query token. sparse.py --approximate builds
+sparse_movies_seismic with a sparse_vector field and the seismic method, which
+visits only the most promising clusters of each token's postings. Both
+indices use the same ingest pipeline, so the documents carry the same
+expansions.
+
+This script runs the same queries against both. The rank_features results
+without the two-phase search pipeline are the ground truth. For each top_n and
+heap_factor in the grid, it reports the seismic query latency and recall@k
+against that ground truth, next to the rank_features latency with and without
+two-phase search.
+
+The two indices have generated _ids, so results are matched by movie id.
+
+Usage:
+    python sparse.py
+    python sparse.py --approximate
+    python sparse_ann_compare.py --queries-file queries.txt
+    python sparse_ann_compare.py --queries-file queries.txt --top-n 5 10 20 \\
+        --heap-factor 0.8 1.0 1.2
+"""
+
+
+import argparse
+import batch_search
+import bench_utils
+import logging
+import model_utils
+from opensearchpy import OpenSearch
+from os_client_factory import OSClientFactory
+import recall_benchmark
+import sparse
+
+
+DEFAULT_TOP_N = [5, 10, 20]
+DEFAULT_HEAP_FACTORS = [0.8, 1.0, 1.2]
+
+
+def _search_movie_ids(os_client: OpenSearch, index_name, bodies, **search_args):
+  bodies = [dict(body, _source=False, docvalue_fields=["id"]) for body in bodies]
+  responses, latencies = bench_utils.timed_searches(os_client, index_name, bodies,
+                                                    **search_args)
+  return ([[hit['fields']['id'][0] for hit in response['hits']['hits']]
+           for response in responses], latencies)
+
+
+def _row(index, setting, latencies, truth, results, k):
+  latency = bench_utils.latency_summary(latencies)
+  return {"index": index, "setting": setting,
+          "latency_p50": latency['p50'], "latency_p99": latency['p99'],
+          "recall": recall_benchmark.recall_at_k(truth, results, k)}
+
+
+def main(queries_file, top_ns=DEFAULT_TOP_N, heap_factors=DEFAULT_HEAP_FACTORS,
+         k=10, output_path=None):
+  os_client = OSClientFactory().client()
+  model_id = model_utils.model_id_for(os_client, bench_utils.SPARSE_MODEL_NAME)
+  if model_id is None:
+    raise ValueError(f'Model {bench_utils.SPARSE_MODEL_NAME} is not deployed. Run '
+                     'sparse.py first.')
+  for index_name, command in [(sparse.INDEX_NAME, 'sparse.py'),
+                              (sparse.SEISMIC_INDEX_NAME, 'sparse.py --approximate')]:
+    if not os_client.indices.exists(index=index_name):
+      raise ValueError(f'Index {index_name} does not exist. Run {command} first.')
+
+  texts = [query['query'] for query in batch_search.read_queries(queries_file)]
+  bodies = [dict(sparse.sparse_query.build(query_text=text, model_id=model_id),
+                 size=k) for text in texts]
+  # A warm-up pass, so neither index pays for loading its postings first.
+  for index_name in [sparse.INDEX_NAME, sparse.SEISMIC_INDEX_NAME]:
+    _search_movie_ids(os_client, index_name, bodies, search_pipeline='_none')
+
+  # "_none" overrides the index's default two-phase pipeline.
+  logging.info(f"Measuring {sparse.INDEX_NAME}")
+  truth, latencies = _search_movie_ids(os_client, sparse.INDEX_NAME, bodies,
+                                       search_pipeline='_none')
+  rows = [_row('rank_features', 'exact', latencies, truth, truth, k)]
+  results, latencies = _search_movie_ids(os_client, sparse.INDEX_NAME, bodies)
+  rows.append(_row('rank_features', 'two_phase', latencies, truth, results, k))
+
+  for top_n in top_ns:
+    for heap_factor in heap_factors:
+      logging.info(f"Measuring {sparse.SEISMIC_INDEX_NAME}, top_n {top_n}, "
+                   f"heap_factor {heap_factor}")
+      seismic_bodies = [dict(sparse.sparse_ann_query.build(
+        query_text=text, model_id=model_id, k=k, top_n=top_n,
+        heap_factor=heap_factor), size=k) for text in texts]
+      results, latencies = _search_movie_ids(os_client, sparse.SEISMIC_INDEX_NAME,
+                                             seismic_bodies)
+      rows.append(_row('seismic', f'top_n={top_n} heap_factor={heap_factor:g}',
+                       latencies, truth, results, k))
+
+  print(bench_utils.format_table(
+    rows, ['index', 'setting', 'latency_p50', 'latency_p99', 'recall']))
+  if output_path:
+    bench_utils.write_json(output_path, {"k": k, "rows": rows})
+  return rows
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Compares approximate (seismic) sparse retrieval with the "
+      "rank_features index on latency and recall.",
+  )
+  parser.add_argument("--queries-file", required=True, action="store")
+  parser.add_argument("--top-n", nargs='+', type=int, default=DEFAULT_TOP_N,
+                      help="Query tokens that select the clusters to visit")
+  parser.add_argument("--heap-factor", nargs='+', type=float,
+                      default=DEFAULT_HEAP_FACTORS,
+                      help="Above 1.0 visits more clusters")
+  parser.add_argument("--k", default=10, type=int)
+  parser.add_argument("--output", default=None, action="store")
+  args = parser.parse_args()
+  main(queries_file=args.queries_file,
+       top_ns=args.top_n,
+       heap_factors=args.heap_factor,
+       k=args.k,
+       output_path=args.output)
@@ -0,0 +1,247 @@
+"""
+Pruning and two-phase search sweep for the sparse (rank_features) index.
+
+sparse.py prunes document expansions with prune_type max_ratio and prune_ratio
+0.1 in the ingest pipeline, and searches through the two-phase processor with
+its defaults. Pruning drops every token whose weight is below prune_ratio
+times the document's largest weight, so it trades index size and query cost
+against recall. Two-phase search first scores documents with only the query's
+high-weight tokens, then rescores the top max_window_size (or k *
+expansion_rate) documents with all of them.
+
+The sweep:
+
+    1. Builds an unpruned baseline index, sparse_sweep_baseline, encoding the
+       movies with the sparse model once. Later runs reuse it unless you pass
+       --rebuild-baseline.
+    2. For each --prune-ratio, fills a new index from the baseline with a
+       sliced _reindex whose script applies max_ratio pruning, so the model
+       doesn't run again (see reindex_builder.py).
+    3. Measures each index's store size and mean terms per document, and for
+       each two-phase setting, query latency and recall@k against the
+       baseline's top k without two-phase.
+
+A two-phase setting is prune_ratio:expansion_rate:max_window_size, or off.
+
+Usage:
+    python sparse_sweep.py --queries-file queries.txt
+    python sparse_sweep.py --queries-file queries.txt --prune-ratio 0.1 0.3 \\
+        --two-phase off 0.4:5:10000 0.6:2:1000
+"""
+
+
+import argparse
+import batch_search
+import bench_utils
+from copy import deepcopy
+import index_utils
+import logging
+import model_utils
+import movie_source
+from opensearchpy import OpenSearch
+import opensearchpy.helpers
+from os_client_factory import OSClientFactory
+import recall_benchmark
+import reindex_builder
+import sparse
+
+
+INDEX_PREFIX = 'sparse_sweep'
+BASELINE_INDEX_NAME = 'sparse_sweep_baseline'
+BASELINE_PIPELINE_NAME = 'sparse_sweep_baseline_pipeline'
+DEFAULT_PRUNE_RATIOS = [0.05, 0.1, 0.2, 0.3, 0.5]
+DEFAULT_TWO_PHASE = ['off', '0.4:5.0:10000', '0.2:5.0:10000', '0.6:5.0:10000',
+                     '0.4:2.0:10000']
+# Documents sampled to count terms per document.
+TERMS_SAMPLE_SIZE = 1000
+
+# Applies max_ratio pruning to the sparse field during _reindex, the same rule
+# the sparse_encoding processor uses.
+PRUNE_SCRIPT = {
+  "lang": "painless",
+  "source": """
+    Map tokens = ctx._source[params.field];
+    if (tokens != null && !tokens.isEmpty()) {
+      double top = 0.0;
+      for (def weight : tokens.values()) { top = Math.max(top, (double) weight); }
+      double cutoff = top * params.prune_ratio;
+      tokens.values().removeIf(weight -> (double) weight < cutoff);
+    }
+  """
+}
+
+
+def build_baseline(os_client: OpenSearch, model_id, rebuild=False):
+  '''Creates the unpruned baseline index with the sparse model, unless it
+  already exists, and force merges it like the pruned indices, so its size
+  and latency compare fairly with theirs.'''
+  if os_client.indices.exists(index=BASELINE_INDEX_NAME) and not rebuild:
+    logging.info(f"Using the existing baseline {BASELINE_INDEX_NAME}")
+  else:
+    _index_baseline(os_client, model_id)
+  # A no-op when a reused baseline is already merged
+  os_client.indices.forcemerge(index=BASELINE_INDEX_NAME, max_num_segments=1,
+                               request_timeout=3600)
+
+
+def _index_baseline(os_client: OpenSearch, model_id):
+  pipeline_definition = deepcopy(sparse.ingest_pipeline_definition)
+  processor = pipeline_definition['processors'][0]['sparse_encoding']
+  processor['model_id'] = model_id
+  processor.pop('prune_type', None)
+  processor.pop('prune_ratio', None)
+  os_client.ingest.put_pipeline(id=BASELINE_PIPELINE_NAME, body=pipeline_definition)
+  index_utils.delete_then_create_index(os_client=os_client,
+                                       index_name=BASELINE_INDEX_NAME,
+                                       ingest_pipeline_name=BASELINE_PIPELINE_NAME,
+                                       additional_fields=sparse.KNN_FIELDS)
+  logging.info(f"Indexing the unpruned baseline {BASELINE_INDEX_NAME}")
+  for bulk in movie_source.bulks(sparse.BULK_SIZE, BASELINE_INDEX_NAME):
+    opensearchpy.helpers.bulk(os_client, bulk, timeout=600, max_retries=10)
+  os_client.indices.refresh(index=BASELINE_INDEX_NAME)
+
+
+def build_pruned(os_client: OpenSearch, index_name, prune_ratio):
+  '''Creates index_name from the baseline with max_ratio pruning, without an
+  ingest pipeline, and force merges it so sizes compare fairly.'''
+  index_utils.delete_then_create_index(os_client=os_client,
+                                       index_name=index_name,
+                                       additional_fields=sparse.KNN_FIELDS)
+  script = dict(PRUNE_SCRIPT, params={"field": sparse.EMBEDDING_FIELD_NAME,
+                                      "prune_ratio": prune_ratio})
+  result = reindex_builder.reindex(os_client, BASELINE_INDEX_NAME, index_name,
+                                   script=script)
+  os_client.indices.forcemerge(index=index_name, max_num_segments=1,
+                               request_timeout=3600)
+  return result
+
+
+def store_mb(os_client: OpenSearch, index_name):
+  '''Primary store size in MB.'''
+  stats = os_client.indices.stats(index=index_name, metric='store')
+  return stats['_all']['primaries']['store']['size_in_bytes'] / 2**20
+
+
+def terms_per_doc(os_client: OpenSearch, index_name, sample_size=TERMS_SAMPLE_SIZE):
+  '''Mean number of tokens in the sparse field, over a random sample.'''
+  response = os_client.search(index=index_name, body={
+    "size": sample_size,
+    "_source": [sparse.EMBEDDING_FIELD_NAME],
+    "query": {"function_score": {"random_score": {"seed": 0, "field": "_seq_no"}}}})
+  counts = [len(hit['_source'].get(sparse.EMBEDDING_FIELD_NAME) or {})
+            for hit in response['hits']['hits']]
+  return sum(counts) / len(counts) if counts else 0.0
+
+
+def parse_two_phase(setting):
+  '''Parses prune_ratio:expansion_rate:max_window_size, or off (None).'''
+  if setting == 'off':
+    return None
+  prune_ratio, expansion_rate, max_window_size = setting.split(':')
+  return {"prune_ratio": float(prune_ratio),
+          "expansion_rate": float(expansion_rate),
+          "max_window_size": int(max_window_size)}
+
+
+def put_two_phase_pipeline(os_client: OpenSearch, name, parameters):
+  '''Writes a search pipeline with the two-phase processor at parameters.'''
+  definition = deepcopy(sparse.search_pipeline_definition)
+  definition['request_processors'][0]['neural_sparse_two_phase_processor'] \
+    ['two_phase_parameter'] = parameters
+  os_client.transport.perform_request('PUT', f'/_search/pipeline/{name}',
+                                      body=definition)
+
+
+def _search_ids(os_client: OpenSearch, index_name, bodies, **search_args):
+  responses, latencies = bench_utils.timed_searches(os_client, index_name, bodies,
+                                                    **search_args)
+  return ([[hit['_id'] for hit in response['hits']['hits']] for response in responses],
+          latencies)
+
+
+def main(queries_file, prune_ratios=DEFAULT_PRUNE_RATIOS,
+         two_phase_settings=DEFAULT_TWO_PHASE, k=10, rebuild_baseline=False,
+         keep_indices=False, output_path=None):
+  os_client = OSClientFactory().client()
+  model_id = model_utils.model_id_for(os_client, bench_utils.SPARSE_MODEL_NAME)
+  if model_id is None:
+    raise ValueError(f'Model {bench_utils.SPARSE_MODEL_NAME} is not deployed. Run '
+                     'sparse.py first.')
+  build_baseline(os_client, model_id, rebuild_baseline)
+
+  texts = [query['query'] for query in batch_search.read_queries(queries_file)]
+  bodies = [dict(sparse.sparse_query.build(query_text=text, model_id=model_id),
+                 size=k, _source=False) for text in texts]
+  truth, _ = _search_ids(os_client, BASELINE_INDEX_NAME, bodies)
+
+  pipelines = {}
+  for position, setting in enumerate(two_phase_settings):
+    parameters = parse_two_phase(setting)
+    if parameters:
+      pipelines[setting] = f'{INDEX_PREFIX}_two_phase_{position}'
+      put_two_phase_pipeline(os_client, pipelines[setting], parameters)
+
+  rows = []
+  for prune_ratio in [0.0] + list(prune_ratios):
+    if prune_ratio:
+      index_name = f'{INDEX_PREFIX}_prune{prune_ratio:g}'
+      build = build_pruned(os_client, index_name, prune_ratio)
+    else:
+      index_name = BASELINE_INDEX_NAME
+      build = None
+    size = store_mb(os_client, index_name)
+    terms = terms_per_doc(os_client, index_name)
+    for setting in two_phase_settings:
+      logging.info(f"Measuring {index_name}, two-phase {setting}")
+      search_args = {"search_pipeline": pipelines[setting]} if setting in pipelines else {}
+      results, latencies = _search_ids(os_client, index_name, bodies, **search_args)
+      latency = bench_utils.latency_summary(latencies)
+      rows.append({"prune_ratio": prune_ratio, "two_phase": setting,
+                   "store_mb": size, "terms_per_doc": terms,
+                   "reindex_seconds": build['seconds'] if build else None,
+                   "latency_p50": latency['p50'], "latency_p99": latency['p99'],
+                   "recall": recall_benchmark.recall_at_k(truth, results, k)})
+    if prune_ratio and not keep_indices:
+      os_client.indices.delete(index=index_name)
+
+  for name in pipelines.values():
+    os_client.transport.perform_request('DELETE', f'/_search/pipeline/{name}')
+
+  columns = ['prune_ratio', 'two_phase', 'store_mb', 'terms_per_doc',
+             'latency_p50', 'latency_p99', 'recall']
+  print(bench_utils.format_table(rows, columns))
+  if output_path:
+    bench_utils.write_json(output_path, {"k": k, "rows": rows})
+  return rows
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Builds sparse indices at several prune ratios from an "
+      "unpruned baseline and measures size, terms per document, latency and "
+      "recall for each two-phase search setting.",
+  )
+  parser.add_argument("--queries-file", required=True, action="store")
+  parser.add_argument("--prune-ratio", nargs='+', type=float,
+                      default=DEFAULT_PRUNE_RATIOS)
+  parser.add_argument("--two-phase", nargs='+', default=DEFAULT_TWO_PHASE,
+                      help="prune_ratio:expansion_rate:max_window_size, or off")
+  parser.add_argument("--k", default=10, type=int)
+  parser.add_argument("--rebuild-baseline", default=False, action="store_true")
+  parser.add_argument("--keep-indices", default=False, action="store_true")
+  parser.add_argument("--output", default=None, action="store")
+  args = parser.parse_args()
+  main(queries_file=args.queries_file,
+       prune_ratios=args.prune_ratio,
+       two_phase_settings=args.two_phase,
+       k=args.k,
+       rebuild_baseline=args.rebuild_baseline,
+       keep_indices=args.keep_indices,
+       output_path=args.output)
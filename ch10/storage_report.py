@@ -0,0 +1,213 @@
+"""
+Storage and memory report for the ch10 indices.
+
+For each index the example scripts build (see bench_utils.BENCH_TARGETS), the
+report collects:
+
+    - documents, primary and total store size, and primary segment count
+    - disk use by structure, from the primaries' segment file sizes: stored
+      fields (_source), terms and postings, doc values, points, norms and
+      vectors (Lucene vector files and the k-NN plugin's native files)
+    - k-NN native memory: the graph memory and graph count that the k-NN
+      stats report for the index, with --warmup loading the graphs first
+    - an estimate of what excluding the vector field from _source would save:
+      the vector's share of the JSON _source, from a sample of documents,
+      times the stored fields size
+
+The node level k-NN cache counters (hits, misses, evictions, and whether the
+cache or the circuit breaker is full) don't break down by index, so they're
+reported once for the cluster.
+
+Per-field disk usage comes from the _disk_usage API where the cluster has
+it. OpenSearch doesn't (it's an Elasticsearch API), so the report usually
+falls back on the segment file sizes, which break the store down by structure
+rather than by field. In these indices the vector field dominates the vector
+and stored fields rows, so the breakdown answers much the same question.
+
+Excluding a vector from _source saves its stored fields bytes, but then the
+vector can't be read back for a reindex (see reindex_builder.py), an update,
+or a rebuild with another method. Keep a source of truth elsewhere first.
+
+Usage:
+    python storage_report.py
+    python storage_report.py --targets hnsw sq on_disk --warmup --output report.json
+"""
+
+
+import argparse
+from bench_utils import BENCH_TARGETS
+import bench_utils
+import index_utils
+import json
+import logging
+from opensearchpy import OpenSearch
+import opensearchpy.exceptions
+from os_client_factory import OSClientFactory
+import vector_cache
+import vector_index_builder
+
+
+SOURCE_SAMPLE_SIZE = 100
+
+# Segment file extensions by the structure they hold. Extensions that aren't
+# here (segment metadata, live docs, compound file entries) count as other.
+FILE_CATEGORIES = {
+  "stored_fields": ['fdt', 'fdx', 'fdm'],
+  "terms": ['tim', 'tip', 'tmd', 'doc', 'pos', 'pay'],
+  "doc_values": ['dvd', 'dvm'],
+  "points": ['kdd', 'kdi', 'kdm', 'dii', 'dim'],
+  "norms": ['nvd', 'nvm'],
+  "vectors": ['vec', 'vex', 'vem', 'veq', 'vemq', 'vemf',
+              'faiss', 'faissc', 'hnsw', 'hnswc', 'nmslib', 'nmslibc'],
+}
+CATEGORY_FOR = {extension: category for category, extensions in FILE_CATEGORIES.items()
+                for extension in extensions}
+MB = 2**20
+
+
+def concrete_index(os_client: OpenSearch, index_name):
+  '''The index behind an alias, or index_name itself. The k-NN stats are
+  keyed by concrete index.'''
+  targets = index_utils.alias_targets(os_client, index_name)
+  return targets[0] if targets else index_name
+
+
+def field_disk_usage(os_client: OpenSearch, index_name):
+  '''{field: bytes} from the _disk_usage API, or None when the cluster
+  doesn't have it.'''
+  try:
+    response = os_client.transport.perform_request(
+      'POST', f'/{index_name}/_disk_usage', params={"run_expensive_tasks": "true"})
+  except opensearchpy.exceptions.TransportError as e:
+    # An unknown endpoint is a 400, 404 or 405, depending on the version
+    if e.status_code in (400, 404, 405):
+      return None
+    raise
+  usage = response.get(index_name, {})
+  return {field: stats.get('total_in_bytes', 0)
+          for field, stats in usage.get('fields', {}).items()}
+
+
+def segment_profile(os_client: OpenSearch, index_name):
+  '''Documents, store sizes, segment count and MB per structure, for the
+  primaries.'''
+  stats = os_client.indices.stats(index=index_name, metric='docs,store,segments',
+                                  include_segment_file_sizes=True)['_all']
+  primaries = stats['primaries']
+  row = {"docs": primaries['docs']['count'],
+         "store_mb": primaries['store']['size_in_bytes'] / MB,
+         "total_store_mb": stats['total']['store']['size_in_bytes'] / MB,
+         "segments": primaries['segments']['count']}
+  for category in list(FILE_CATEGORIES) + ['other']:
+    row[f"{category}_mb"] = 0.0
+  for extension, size in primaries['segments'].get('file_sizes', {}).items():
+    category = CATEGORY_FOR.get(extension, 'other')
+    row[f"{category}_mb"] += size['size_in_bytes'] / MB
+  return row
+
+
+def source_vector_share(os_client: OpenSearch, index_name,
+                        field=vector_cache.DEFAULT_FIELD,
+                        sample_size=SOURCE_SAMPLE_SIZE):
+  '''The fraction of the JSON _source that is the vector field, over a sample
+  of documents. 0 when the field isn't in _source.'''
+  response = os_client.search(index=index_name, body={"size": sample_size})
+  total = vector = 0
+  for hit in response['hits']['hits']:
+    source = hit.get('_source') or {}
+    total += len(json.dumps(source))
+    if field in source:
+      vector += len(json.dumps(source[field]))
+  return vector / total if total else 0.0
+
+
+def knn_memory(os_client: OpenSearch):
+  '''Per index {graph_memory_kb, graph_count} and the cluster cache
+  counters, from the k-NN stats.'''
+  stats = vector_index_builder.knn_stats(os_client)
+  indices = {}
+  cluster = {"graph_memory_kb": 0, "hit_count": 0, "miss_count": 0,
+             "eviction_count": 0, "cache_capacity_reached": False,
+             "circuit_breaker_triggered": stats.get('circuit_breaker_triggered', False)}
+  for node in stats['nodes'].values():
+    for index_name, index_stats in node.get('indices_in_cache', {}).items():
+      totals = indices.setdefault(index_name, {"graph_memory_kb": 0, "graph_count": 0})
+      totals['graph_memory_kb'] += index_stats.get('graph_memory_usage', 0)
+      totals['graph_count'] += index_stats.get('graph_count', 0)
+    cluster['graph_memory_kb'] += node.get('graph_memory_usage', 0)
+    for counter in ['hit_count', 'miss_count', 'eviction_count']:
+      cluster[counter] += node.get(counter, 0)
+    cluster['cache_capacity_reached'] |= bool(node.get('cache_capacity_reached'))
+  return indices, cluster
+
+
+def profile(os_client: OpenSearch, target_name, warmup=False):
+  '''One report row for a BENCH_TARGETS entry.'''
+  index_name = BENCH_TARGETS[target_name]['index']
+  concrete = concrete_index(os_client, index_name)
+  if warmup and BENCH_TARGETS[target_name]['query_type'] != 'neural_sparse':
+    vector_index_builder.native_memory_kb(os_client, concrete)
+  row = dict(target=target_name, index=concrete,
+             **segment_profile(os_client, concrete))
+  fields = field_disk_usage(os_client, concrete)
+  row['breakdown'] = 'fields' if fields is not None else 'segments'
+  if fields is not None:
+    row['field_mb'] = {field: size / MB for field, size in fields.items()}
+  share = source_vector_share(os_client, concrete)
+  row['source_vector_share'] = share
+  row['source_exclusion_saves_mb'] = row['stored_fields_mb'] * share
+  return row
+
+
+def main(targets=None, warmup=False, output_path=None):
+  os_client = OSClientFactory().client()
+  rows = []
+  for target_name in targets or list(BENCH_TARGETS):
+    if not os_client.indices.exists(index=BENCH_TARGETS[target_name]['index']):
+      logging.warning(f"Index {BENCH_TARGETS[target_name]['index']} does not "
+                      f"exist, skipping {target_name}")
+      continue
+    logging.info(f"Profiling {target_name}")
+    rows.append(profile(os_client, target_name, warmup))
+
+  memory, cluster = knn_memory(os_client)
+  for row in rows:
+    row.update(memory.get(row['index'], {"graph_memory_kb": 0, "graph_count": 0}))
+    row['graph_memory_mb'] = row.pop('graph_memory_kb') / 1024
+
+  print(bench_utils.format_table(rows, [
+    'target', 'docs', 'segments', 'store_mb', 'total_store_mb', 'stored_fields_mb',
+    'terms_mb', 'doc_values_mb', 'points_mb', 'norms_mb', 'vectors_mb',
+    'other_mb', 'graph_memory_mb', 'graph_count', 'source_exclusion_saves_mb']))
+  print(f"\nk-NN cache: {cluster['graph_memory_kb'] / 1024:.1f} MB, "
+        f"{cluster['hit_count']} hits, {cluster['miss_count']} misses, "
+        f"{cluster['eviction_count']} evictions, capacity reached: "
+        f"{cluster['cache_capacity_reached']}, circuit breaker triggered: "
+        f"{cluster['circuit_breaker_triggered']}")
+  if output_path:
+    bench_utils.write_json(output_path, {"indices": rows, "knn_cache": cluster})
+  return rows, cluster
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Reports disk use by structure, segment counts and k-NN "
+      "native memory for each ch10 index.",
+  )
+  parser.add_argument("--targets", nargs='+', default=None,
+                      choices=sorted(BENCH_TARGETS))
+  parser.add_argument("--warmup", default=False, action="store_true",
+                      help="Load each index's k-NN graphs before reading "
+                      "the memory stats")
+  parser.add_argument("--output", default=None, action="store")
+  args = parser.parse_args()
+  main(targets=args.targets,
+       warmup=args.warmup,
+       output_path=args.output)
@@ -0,0 +1,124 @@
+"""
+A stand-in LLM HTTP server for load testing the RAG pipeline offline.
+
+converse.py --stub-llm-url points the ML connector at this server instead of
+Amazon Bedrock. The server accepts the connector's Bedrock Claude request
+body ({"prompt": ...}) on any path and answers like Bedrock does, with
+{"completion": ...}, after a configurable delay:
+
+    latency-ms + ms-per-prompt-token * estimated prompt tokens, +/- jitter-ms
+
+The prompt term makes the stub's latency grow with the prompt, as a real
+LLM's prefill does, so the effect of context trimming (converse.py --trim)
+shows up in the measurements. Requests are served on a thread each, so
+concurrent requests overlap like they would against a hosted model. Use
+--max-concurrent to model a provider's concurrency limit; requests beyond it
+wait.
+
+The OpenSearch node must be able to reach the server, so run it on a host the
+node can connect to (not localhost, when OpenSearch runs in a container).
+
+Usage:
+    python stub_llm_server.py --port 8088 --latency-ms 1500 --jitter-ms 300
+    python converse.py --skip-indexing --stub-llm-url http://<host>:8088 \\
+        --questions-file questions.txt --concurrency 8
+"""
+
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import random
+import threading
+import time
+
+
+CHARS_PER_TOKEN = 4
+STUB_ANSWER = "This is a stub answer. The search results mention {titles}."
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+  '''Answers every POST with a canned completion after a delay.'''
+
+  def do_POST(self):
+    length = int(self.headers.get('Content-Length', 0))
+    try:
+      prompt = json.loads(self.rfile.read(length) or b'{}').get('prompt', '')
+    except json.JSONDecodeError:
+      self.send_error(400, 'Request body is not JSON')
+      return
+
+    server = self.server
+    delay_ms = (server.latency_ms
+                + server.ms_per_prompt_token * len(prompt) / CHARS_PER_TOKEN
+                + random.uniform(-server.jitter_ms, server.jitter_ms))
+    with server.slots:
+      time.sleep(max(delay_ms, 0) / 1000)
+
+    titles = [line.split(':', 1)[1].strip() for line in prompt.splitlines()
+              if line.startswith('SEARCH RESULT ')]
+    body = json.dumps({
+      "completion": " " + STUB_ANSWER.format(titles=', '.join(titles[:3]) or 'nothing'),
+      "stop_reason": "stop_sequence"
+    }).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    logging.debug(format % args)
+
+
+class StubLLMServer(ThreadingHTTPServer):
+  # A larger listen backlog than the default 5, so bursts of concurrent
+  # connections aren't refused and retried.
+  request_queue_size = 1024
+  daemon_threads = True
+
+
+def serve(port, latency_ms=1000, jitter_ms=0, ms_per_prompt_token=0.0,
+          max_concurrent=1000, host='0.0.0.0'):
+  '''Runs the stub server until interrupted.'''
+  server = StubLLMServer((host, port), StubLLMHandler)
+  server.latency_ms = latency_ms
+  server.jitter_ms = jitter_ms
+  server.ms_per_prompt_token = ms_per_prompt_token
+  server.slots = threading.BoundedSemaphore(max_concurrent)
+  logging.info(f"Stub LLM listening on {host}:{port}, latency {latency_ms}ms "
+               f"+/- {jitter_ms}ms, {ms_per_prompt_token}ms per prompt token")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
+if __name__ == "__main__":
+  # Info level logging.
+  logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO)
+
+  parser = argparse.ArgumentParser(
+      prog="main",
+      description="Serves canned LLM completions with a configurable latency, "
+      "in place of Amazon Bedrock.",
+  )
+  parser.add_argument("--host", default='0.0.0.0', action="store")
+  parser.add_argument("--port", default=8088, type=int)
+  parser.add_argument("--latency-ms", default=1000, type=float)
+  parser.add_argument("--jitter-ms", default=0, type=float)
+  parser.add_argument("--ms-per-prompt-token", default=0.0, type=float)
+  parser.add_argument("--max-concurrent", default=1000, type=int)
+  args = parser.parse_args()
+  serve(port=args.port,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        ms_per_prompt_token=args.ms_per_prompt_token,
+        max_concurrent=args.max_concurrent,
+        host=args.host)
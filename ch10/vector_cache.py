@@ -0,0 +1,124 @@
+'''
+Local cache of corpus and query vectors for the ch10 benchmarks.
+
+The benchmarks need the raw vectors on the client: to compute exact nearest
+neighbors with NumPy, and to build index variants without running the
+embedding model again. Pulling 100k vectors out of OpenSearch, or embedding a
+few thousand queries, takes long enough that it's worth doing only once. The
+vectors are kept in .npz files next to the scripts.
+
+Corpus vectors are keyed by the movie id field, not by _id. Every index gets
+its own random _ids, but the movie id is the same in all of them, so it's the
+key for comparing results across indices. The id field is excluded from
+_source by index_utils.BASE_SETTINGS, so it's read from doc values.
+
+Functions:
+    corpus_vectors(os_client, index_name, field, cache_path, refresh): Movie
+        ids and vectors for every document in an index
+    query_vectors(os_client, texts, cache_path, refresh): Embeddings for a list
+        of query texts
+    movie_embeddings(os_client, model_id, movies, cache_path): Embeddings of
+        movies' embedding_source, cached by movie id
+'''
+
+
+import exact
+import hashlib
+import logging
+import model_utils
+import numpy as np
+from opensearchpy import OpenSearch
+import opensearchpy.helpers
+import os
+
+
+# The exact index stores every vector in a flat knn_vector field, so it's the
+# default place to read the corpus from.
+DEFAULT_SOURCE_INDEX = exact.INDEX_NAME
+DEFAULT_FIELD = exact.EMBEDDING_FIELD_NAME
+SCROLL_SIZE = 1000
+
+
+def _load(cache_path):
+  with np.load(cache_path) as data:
+    return data['ids'], data['vectors']
+
+
+def _save(cache_path, ids, vectors):
+  np.savez(cache_path, ids=ids, vectors=vectors)
+  logging.info(f"Cached {len(ids)} vectors in {cache_path}")
+
+
+def corpus_vectors(os_client: OpenSearch, index_name=DEFAULT_SOURCE_INDEX,
+                   field=DEFAULT_FIELD, cache_path=None, refresh=False):
+  '''Returns (ids, vectors) for every document in index_name, as an int64
+  array of movie ids and a float32 matrix with one row per id, sorted by id.
+  Reads from cache_path if it exists, unless refresh is set.'''
+  cache_path = cache_path or f'corpus_{index_name}_{field}.npz'
+  if os.path.exists(cache_path) and not refresh:
+    logging.info(f"Loading corpus vectors from {cache_path}")
+    return _load(cache_path)
+
+  logging.info(f"Reading {field} vectors from {index_name}")
+  ids = []
+  vectors = []
+  for hit in opensearchpy.helpers.scan(
+      os_client, index=index_name, size=SCROLL_SIZE,
+      query={"_source": [field], "docvalue_fields": ["id"],
+             "query": {"match_all": {}}}):
+    vector = hit['_source'].get(field)
+    if vector is None:
+      continue
+    ids.append(hit['fields']['id'][0])
+    vectors.append(vector)
+  order = np.argsort(np.array(ids, dtype=np.int64), kind='stable')
+  ids = np.array(ids, dtype=np.int64)[order]
+  vectors = np.array(vectors, dtype=np.float32)[order]
+  _save(cache_path, ids, vectors)
+  return ids, vectors
+
+
+def query_vectors(os_client: OpenSearch, texts, cache_path=None, refresh=False):
+  '''Returns a float32 matrix with the embedding of each text, in order. The
+  cache file name is derived from the texts, so a different query set gets a
+  different cache.'''
+  if cache_path is None:
+    digest = hashlib.sha1('\n'.join(texts).encode('utf-8')).hexdigest()[:12]
+    cache_path = f'queries_{digest}.npz'
+  if os.path.exists(cache_path) and not refresh:
+    logging.info(f"Loading query vectors from {cache_path}")
+    return _load(cache_path)[1]
+
+  model_name = model_utils.DENSE_MODELS_HF[exact.MODEL_SHORT_NAME]['name']
+  model_id = model_utils.model_id_for(os_client, model_name)
+  if model_id is None:
+    raise ValueError(f'Model {model_name} is not deployed. Run one of the '
+                     'example scripts first.')
+  logging.info(f"Embedding {len(texts)} queries")
+  vectors = np.array(model_utils.create_embeddings(os_client, model_id, texts),
+                     dtype=np.float32)
+  _save(cache_path, np.arange(len(texts), dtype=np.int64), vectors)
+  return vectors
+
+
+def movie_embeddings(os_client: OpenSearch, model_id, movies, cache_path=None):
+  '''Returns a float32 matrix with the embedding of each movie's
+  embedding_source field (see movie_source.py), in order. Embeddings are cached
+  by movie id, so a later call only runs the model for movies it hasn't seen
+  before.'''
+  cache_path = cache_path or f'embeddings_{model_id}.npz'
+  cached = {}
+  if os.path.exists(cache_path):
+    ids, vectors = _load(cache_path)
+    cached = dict(zip(ids.tolist(), vectors))
+  missing = [movie for movie in movies if movie['id'] not in cached]
+  if missing:
+    logging.info(f"Embedding {len(missing)} movies, {len(movies) - len(missing)} "
+                 "found in the cache")
+    embeddings = model_utils.create_embeddings(
+      os_client, model_id, [movie['embedding_source'] for movie in missing])
+    for movie, embedding in zip(missing, embeddings):
+      cached[movie['id']] = np.asarray(embedding, dtype=np.float32)
+    ids = np.array(sorted(cached), dtype=np.int64)
+    _save(cache_path, ids, np.stack([cached[doc_id] for doc_id in ids.tolist()]))
+  return np.stack([cached[movie['id']] for movie in movies])
@@ -0,0 +1,156 @@
+'''
+Builds k-NN indices from pre-computed vectors for the ch10 parameter sweeps.
+
+The example scripts build their indices from raw text, with an ingest pipeline
+that runs the embedding model for every document. A parameter sweep builds
+many indices from the same vectors, so running inference each time would
+swamp the measurement. The functions here bulk load cached vectors (see
+vector_cache.py) directly, with no ingest pipeline, and time the build.
+
+Functions:
+    build_index(os_client, index_name, field_mapping, ids, vectors): Creates
+        the index, loads the vectors and returns build timings
+    native_memory_kb(os_client, index_name): Warms up the index and returns
+        its native (off-heap) k-NN memory from the stats API
+    knn_stats(os_client): The k-NN stats API response
+    train_knn_model(os_client, model_name, training_index, dimension, method):
+        Trains a k-NN model (IVF, PQ) and waits for it
+    delete_knn_model(os_client, model_name): Deletes a trained k-NN model
+'''
+
+
+import index_utils
+import logging
+from opensearchpy import OpenSearch
+import opensearchpy.exceptions
+import opensearchpy.helpers
+import time
+import vector_cache
+
+
+BULK_SIZE = 1000
+FIELD_NAME = vector_cache.DEFAULT_FIELD
+
+
+def _actions(index_name, ids, vectors, field_name):
+  for doc_id, vector in zip(ids, vectors):
+    yield {
+      "_op_type": "index",
+      "_index": index_name,
+      "_source": {"id": int(doc_id), field_name: vector.tolist()}
+    }
+
+
+def build_index(os_client: OpenSearch, index_name, field_mapping, ids, vectors,
+                force_merge=True, settings=None, field_name=FIELD_NAME):
+  '''
+  Creates index_name with the knn field in field_mapping, bulk loads the
+  vectors, refreshes, and optionally force merges to one segment.
+
+  The index gets the base movie mapping from index_utils, but no ingest
+  pipeline. Each document holds only the movie id and its vector.
+
+  Args:
+      field_mapping (dict): {field_name: {"type": "knn_vector", ...}}
+      ids, vectors: Movie ids and float32 matrix, from vector_cache
+      force_merge (bool): Merge to one segment after loading, so that every
+          configuration is queried with the same segment layout
+      settings (dict): Extra index settings, e.g. {"knn.algo_param.ef_search":
+          100}
+
+  Returns:
+      dict: docs, index_seconds (bulk + refresh), docs_per_second and
+          merge_seconds
+  '''
+  index_utils.delete_then_create_index(os_client=os_client,
+                                       index_name=index_name,
+                                       additional_fields=field_mapping,
+                                       additional_settings=settings)
+
+  logging.info(f"Loading {len(ids)} vectors into {index_name}")
+  start = time.perf_counter()
+  opensearchpy.helpers.bulk(os_client, _actions(index_name, ids, vectors, field_name),
+                            chunk_size=BULK_SIZE, timeout=600, max_retries=10,
+                            request_timeout=600)
+  os_client.indices.refresh(index=index_name, request_timeout=600)
+  index_seconds = time.perf_counter() - start
+
+  merge_seconds = None
+  if force_merge:
+    start = time.perf_counter()
+    os_client.indices.forcemerge(index=index_name, max_num_segments=1,
+                                 request_timeout=3600)
+    os_client.indices.refresh(index=index_name)
+    merge_seconds = time.perf_counter() - start
+
+  logging.info(f"Indexed {index_name} at {len(ids) / index_seconds:.0f} docs/s")
+  return {"docs": len(ids),
+          "index_seconds": index_seconds,
+          "docs_per_second": len(ids) / index_seconds,
+          "merge_seconds": merge_seconds}
+
+
+def knn_stats(os_client: OpenSearch):
+  '''Returns the k-NN plugin stats for every node.'''
+  return os_client.transport.perform_request('GET', '/_plugins/_knn/stats')
+
+
+def native_memory_kb(os_client: OpenSearch, index_name):
+  '''Loads index_name's native k-NN structures with the warmup API, then
+  returns the memory they use across all nodes, in KB. Indices that keep
+  vectors in Lucene rather than native memory report 0.'''
+  os_client.transport.perform_request('GET', f'/_plugins/_knn/warmup/{index_name}',
+                                      params={"request_timeout": 600})
+  total = 0.0
+  for node in knn_stats(os_client)['nodes'].values():
+    for cached_index, stats in node.get('indices_in_cache', {}).items():
+      if cached_index == index_name:
+        total += stats.get('graph_memory_usage', 0)
+  return total
+
+
+def _knn_model_state(os_client: OpenSearch, model_name):
+  try:
+    response = os_client.transport.perform_request(
+      'GET', f'/_plugins/_knn/models/{model_name}',
+      params={"filter_path": "state,error"})
+    return response.get('state'), response.get('error')
+  except opensearchpy.exceptions.NotFoundError:
+    return None, None
+
+
+def delete_knn_model(os_client: OpenSearch, model_name):
+  '''Deletes a trained k-NN model if it exists. Delete the indices that use
+  the model first, OpenSearch refuses to delete a model that is in use.'''
+  try:
+    os_client.transport.perform_request('DELETE', f'/_plugins/_knn/models/{model_name}')
+  except opensearchpy.exceptions.NotFoundError:
+    pass
+
+
+def train_knn_model(os_client: OpenSearch, model_name, training_index, dimension,
+                    method, space_type='l2', training_field=FIELD_NAME,
+                    description=None):
+  '''Deletes any existing model with this name, trains a new one from the
+  vectors in training_index with the given method (e.g. {"name": "ivf",
+  "engine": "faiss", "parameters": {...}}), and busy waits until training
+  finishes. Returns the seconds training took.'''
+  delete_knn_model(os_client, model_name)
+  start = time.perf_counter()
+  os_client.transport.perform_request(
+    'POST', f'/_plugins/_knn/models/{model_name}/_train',
+    body={
+      "training_index": training_index,
+      "training_field": training_field,
+      "dimension": dimension,
+      "description": description or f"Model {model_name}",
+      "space_type": space_type,
+      "method": method
+    })
+  state, error = _knn_model_state(os_client, model_name)
+  while state == 'training':
+    time.sleep(1)
+    state, error = _knn_model_state(os_client, model_name)
+  if state != 'created':
+    raise Exception(f"Training failed for {model_name}: {error}")
+  return time.perf_counter() - start
@@ -1,5 +1,8 @@
+import argparse
+from copy import deepcopy
 import os
 import json
+import time
 
 
 from opensearchpy import OpenSearch
@@ -62,121 +65,235 @@ def clean_data(data):
   return data
 
 
-if __name__=='__main__':
-  os_client.indices.delete(index='movies', ignore=[400, 404])
-  os_client.indices.create(index='movies', body=
-  {
-    "settings": {
-      "number_of_shards": 1,
-      "number_of_replicas": 1,
-      "max_ngram_diff": 7,
-      "analysis": {
-        "filter": {
-          "reverse_filter": {
-            "type": "reverse"
-          },
-          "shingle_filter": {
-            "type": "shingle",
-            "min_shingle_size": 2,
-            "max_shingle_size": 3
-          }
-        },
-        "tokenizer": {
-          "ngram_tokenizer": {
-            "type": "ngram",
-            "min_gram": 3,
-            "max_gram": 10,
-            "token_chars": ["letter", "digit" ]
-          },
-          "edge_ngram_tokenizer": {
-            "type": "edge_ngram",
-            "min_gram": 3,
-            "max_gram": 10,
-            "token_chars": ["letter", "digit" ]
-          }
-        },
-        "analyzer": {
-          "my_reverse_analyzer": {
-            "type": "custom",
-            "tokenizer": "standard",
-            "filter": [ "lowercase", "reverse_filter" ]
-          },
-          "edge_ngram_analyzer": {
-            "tokenizer": "edge_ngram_tokenizer",
-            "filter": [ "lowercase" ]
-          },
-          "trigram_analyzer": {
-            "type": "custom",
-            "tokenizer": "standard",
-            "filter": [
-              "lowercase",
-              "shingle"
-            ]
-          }
-        }
+# The analyzers are defined in every profile. An analyzer that no field uses
+# costs nothing at indexing time.
+SETTINGS = {
+  "number_of_shards": 1,
+  "number_of_replicas": 1,
+  "max_ngram_diff": 7,
+  "analysis": {
+    "filter": {
+      "reverse_filter": {
+        "type": "reverse"
+      },
+      "shingle_filter": {
+        "type": "shingle",
+        "min_shingle_size": 2,
+        "max_shingle_size": 3
+      }
+    },
+    "tokenizer": {
+      "ngram_tokenizer": {
+        "type": "ngram",
+        "min_gram": 3,
+        "max_gram": 10,
+        "token_chars": ["letter", "digit" ]
+      },
+      "edge_ngram_tokenizer": {
+        "type": "edge_ngram",
+        "min_gram": 3,
+        "max_gram": 10,
+        "token_chars": ["letter", "digit" ]
       }
     },
-    "mappings": {
-      "properties": {
-        "id": {"type": "integer"},
-        "title": {"type": "text",
-                  "copy_to": ["reverse_title", "completions_title", "sayt_title"],
-                   "fields": {
-                      "keyword": {"type": "keyword", 
-                                  "ignore_above": 256},
-                      "trigram": {
-                        "type": "text",
-                        "analyzer": "trigram_analyzer"
-                      }
-                   }},
-        "reverse_title": {"type": "text",
-                          "analyzer": "my_reverse_analyzer"},
-        "sayt_title": {"type": "search_as_you_type"},
-        "completions_title": {"type": "completion"},
-        "year": {"type": "integer"},
-        "duration": {"type": "integer"},
-        "genres1": {"type": "keyword"},
-        "genres2": {"type": "keyword"},
-        "genres": {"type": "text",
-                   "fields": {
-                    "keyword": {"type": "keyword", "ignore_above": 256}
-                   }},
-        "plot": {"type": "text"},
-        "rating": {"type": "float"},
-        "vote": {"type": "integer"},
-        "revenue": {"type": "float"},
-        "thumbnail": {"type": "keyword"},
-        "directors": {"type": "text",
-                      "fields": {
-                        "keyword": {"type": "keyword", "ignore_above": 256}
-                   }},
-        "actors": {"type": "text",
-                   "fields": {
-                    "keyword": {"type": "keyword", "ignore_above": 256}
-                   }, "copy_to": ["completions_actors", "edge_ngram_actors"]},
-        "completions_actors": {"type": "completion"},
-        "edge_ngram_actors": {"type": "text", "analyzer": "edge_ngram_analyzer"},
-        "saved_query": {"type": "percolator"},
-        "saved_query_user_id": {"type": "keyword"},
-    }}})
+    "analyzer": {
+      "my_reverse_analyzer": {
+        "type": "custom",
+        "tokenizer": "standard",
+        "filter": [ "lowercase", "reverse_filter" ]
+      },
+      "edge_ngram_analyzer": {
+        "tokenizer": "edge_ngram_tokenizer",
+        "filter": [ "lowercase" ]
+      },
+      "trigram_analyzer": {
+        "type": "custom",
+        "tokenizer": "standard",
+        "filter": [
+          "lowercase",
+          "shingle"
+        ]
+      }
+    }
+  }
+}
+
+
+# The fields every profile has: the movie data, the keyword subfields for
+# sorting and aggregations, and the percolator fields ch6 uses.
+LEAN_PROPERTIES = {
+  "id": {"type": "integer"},
+  "title": {"type": "text",
+            "fields": {
+              "keyword": {"type": "keyword",
+                          "ignore_above": 256}
+            }},
+  "year": {"type": "integer"},
+  "duration": {"type": "integer"},
+  "genres1": {"type": "keyword"},
+  "genres2": {"type": "keyword"},
+  "genres": {"type": "text",
+             "fields": {
+              "keyword": {"type": "keyword", "ignore_above": 256}
+             }},
+  "plot": {"type": "text"},
+  "rating": {"type": "float"},
+  "vote": {"type": "integer"},
+  "revenue": {"type": "float"},
+  "thumbnail": {"type": "keyword"},
+  "directors": {"type": "text",
+                "fields": {
+                  "keyword": {"type": "keyword", "ignore_above": 256}
+             }},
+  "actors": {"type": "text",
+             "fields": {
+              "keyword": {"type": "keyword", "ignore_above": 256}
+             }},
+  "saved_query": {"type": "percolator"},
+  "saved_query_user_id": {"type": "keyword"},
+}
+
+
+# Each feature adds fields that the title or actors field copies into, or
+# subfields of it. Every copy is analyzed and indexed again, so each feature
+# costs indexing time and disk whether or not anything queries it.
+FEATURES = {
+  # Shingles, for phrase suggestions (ch5)
+  "title_trigram": {
+    "source": "title",
+    "subfields": {"trigram": {"type": "text", "analyzer": "trigram_analyzer"}}},
+  # Reversed tokens, for suffix queries (ch5)
+  "reverse_title": {
+    "source": "title",
+    "copy_to": {"reverse_title": {"type": "text",
+                                  "analyzer": "my_reverse_analyzer"}}},
+  # Search as you type: a subfield per shingle size and an edge ngram subfield
+  # (ch5)
+  "sayt_title": {
+    "source": "title",
+    "copy_to": {"sayt_title": {"type": "search_as_you_type"}}},
+  # An FST for the completion suggester, held in heap (ch5)
+  "completions_title": {
+    "source": "title",
+    "copy_to": {"completions_title": {"type": "completion"}}},
+  # No example queries these two
+  "completions_actors": {
+    "source": "actors",
+    "copy_to": {"completions_actors": {"type": "completion"}}},
+  "edge_ngram_actors": {
+    "source": "actors",
+    "copy_to": {"edge_ngram_actors": {"type": "text",
+                                      "analyzer": "edge_ngram_analyzer"}}},
+}
+
 
+# lean: match, filter, sort and aggregate on the movie fields, and percolate
+# search: lean plus every title feature the example queries use
+# full: every feature, the mapping this script used to create and the default
+PROFILES = {
+  "lean": [],
+  "search": ["title_trigram", "reverse_title", "sayt_title", "completions_title"],
+  "full": list(FEATURES),
+}
 
+
+def index_body(profile):
+  properties = deepcopy(LEAN_PROPERTIES)
+  for feature_name in PROFILES[profile]:
+    feature = FEATURES[feature_name]
+    source = properties[feature['source']]
+    if 'subfields' in feature:
+      source['fields'].update(deepcopy(feature['subfields']))
+    if 'copy_to' in feature:
+      source.setdefault('copy_to', []).extend(feature['copy_to'])
+      properties.update(deepcopy(feature['copy_to']))
+  return {"settings": deepcopy(SETTINGS),
+          "mappings": {"properties": properties}}
+
+
+def create_index(index_name, profile, settings=None):
+  body = index_body(profile)
+  body['settings'].update(settings or {})
+  os_client.indices.delete(index=index_name, ignore=[400, 404])
+  os_client.indices.create(index=index_name, body=body)
+
+
+def load(index_name, max_docs=None, bulk_size=5000, verbose=True):
   with open('movies_100k_LLM_generated.json', 'r') as f:
     nline = 0
     buffer = []
     for line in f:
-      if not line:
+      if not line or (max_docs and nline >= max_docs):
         break
       data = json.loads(line)
       buffer.append(
-          { 
+          {
             "_op_type": "create",
-            "_index": 'movies',
+            "_index": index_name,
             "_source": clean_data(data)
           }
         )
       nline += 1
-      if nline % 5000 == 0:
-        print(nline, ' lines processed')
+      if nline % bulk_size == 0:
+        if verbose:
+          print(nline, ' lines processed')
         bulk(os_client, buffer)
         buffer = []
+    if buffer:
+      bulk(os_client, buffer)
+  return nline
+
+
+# Loads the movies into a scratch index per profile and measures the cost.
+# Scheduled refreshes are off while loading, so the load mostly measures
+# indexing. refresh_s is the total refresh time from the index stats, which
+# includes refreshes the engine triggers when the indexing buffer fills;
+# final_refresh_s is the wall-clock time of the refresh at the end.
+def benchmark(profiles, max_docs=None):
+  results = []
+  for profile in profiles:
+    index_name = f'movies_bench_{profile}'
+    create_index(index_name, profile, {"number_of_replicas": 0,
+                                       "refresh_interval": "-1"})
+    start = time.perf_counter()
+    docs = load(index_name, max_docs, verbose=False)
+    load_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    os_client.indices.refresh(index=index_name)
+    final_refresh_seconds = time.perf_counter() - start
+    stats = os_client.indices.stats(
+      index=index_name, metric='store,segments,indexing,refresh')['_all']['primaries']
+    results.append({
+      "profile": profile,
+      "docs": docs,
+      "docs_per_sec": docs / load_seconds,
+      "index_time_s": stats['indexing']['index_time_in_millis'] / 1000,
+      "refresh_s": stats['refresh']['total_time_in_millis'] / 1000,
+      "final_refresh_s": final_refresh_seconds,
+      "store_mb": stats['store']['size_in_bytes'] / 2**20,
+      "segments": stats['segments']['count'],
+    })
+    os_client.indices.delete(index=index_name)
+
+  columns = list(results[0]) if results else []
+  print('  '.join(f'{column:>15}' for column in columns))
+  for result in results:
+    print('  '.join(f'{value:>15.2f}' if isinstance(value, float) else f'{value:>15}'
+                    for value in result.values()))
+  return results
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--profile', default='full', choices=list(PROFILES))
+  parser.add_argument('--benchmark', nargs='*', choices=list(PROFILES),
+                      help='Load each profile (all by default) into a scratch '
+                      'index and report docs/sec, size and refresh time')
+  parser.add_argument('--max-docs', type=int, default=None)
+  args = parser.parse_args()
+
+  if args.benchmark is not None:
+    benchmark(args.benchmark or list(PROFILES), args.max_docs)
+  else:
+    create_index('movies', args.profile)
+    load('movies', args.max_docs)